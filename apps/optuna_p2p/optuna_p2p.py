@@ -33,6 +33,10 @@ def optuna_p2p_argparse():
                         help="unique id of the seed used to bootstrap the P2P overlay (default is our own uid)")
     parser.add_argument("-d", "--seedaddress", type=str, required=False,
                         help="network address of the seed to bootstrap the P2P overlay (default is our own address)")
+    parser.add_argument("-g", "--gossip", action="store_true", required=False,
+                        help="broadcast the best trials to the whole overlay through a gossip tree instead of the known peers only")
+    parser.add_argument("-p", "--peers", type=str, required=False,
+                        help="file where the known peers are saved, a restarted agent rejoins them instead of a single seed")
 
     return parser.parse_args()
 
@@ -70,7 +74,10 @@ class OptunaP2P():
                  bind=None,
                  address=None,
                  seeduid=None,
-                 seedaddress=None):
+                 seedaddress=None,
+                 max_pending_trials=1024,
+                 gossip=False,
+                 peers=None):
 
         if parse:
             args = optuna_p2p_argparse()
@@ -82,6 +89,8 @@ class OptunaP2P():
             self.address = args.address
             self.seeduid = args.seeduid
             self.seedaddress = args.seedaddress
+            self.gossip = args.gossip
+            self.peers = args.peers
         else:
             self.nrounds = nrounds
             self.ntrials = ntrials
@@ -91,11 +100,15 @@ class OptunaP2P():
             self.address = address
             self.seeduid = seeduid
             self.seedaddress = seedaddress
+            self.gossip = gossip
+            self.peers = peers
 
         self.objective_function = objective_function
         self.objective_object = objective_object
         self.study = study
-        self.pending_trials = queue.Queue()
+        # trials received from the peers, senders are asked to back off
+        # when it is full
+        self.pending_trials = queue.Queue(maxsize=max_pending_trials)
         LTS_Common()
         self.overlay = LTS_Agent(agent_uuid=self.uid,
                                  name=self.name,
@@ -103,7 +116,9 @@ class OptunaP2P():
                                  zmq_address=self.address,
                                  zmq_seed_uuid=self.seeduid,
                                  zmq_seed_address=self.seedaddress,
-                                 dispatch_handler=self)
+                                 dispatch_handler=self,
+                                 gossip=self.gossip,
+                                 dht_snapshot=self.peers)
         self.ntrials_per_round = self.ntrials
         self.nrounds = self.nrounds
         print(self.overlay.toJSON())
@@ -124,7 +139,10 @@ class OptunaP2P():
 
     def dispatchMessage(self, message):
         content_json = json.loads(message.content)
-        self.pending_trials.put(content_json)
+        try:
+            self.pending_trials.put_nowait(content_json)
+        except queue.Full:
+            return self.overlay.busyMessage(message)
         print("Received", content_json, "from", message.from_uuid)
         return None
 
@@ -169,7 +187,7 @@ class OptunaP2P():
             if self.overlay.getRunning():
                 content = '{"best_value": ' + str(self.study.best_value) + ', "best_params": ' + str(self.study.best_params).replace("'", "\"") + ', "param_types": ' + str(self.bestParamsTypes(self.study.best_params)).replace("'", "\"") + '}'
                 print("Broadcast", content, "to neighbors")
-                self.overlay.communicator.broadcast(content)
+                self.overlay.communicator.gossipBroadcast(content)
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,139 @@
+import threading
+
+from time import monotonic
+
+from src.core.common import *
+from src.core.message import *
+
+# ------------------------------------------------------------------------------
+
+# the class of a message type is its prefix, e.g. RPC for RPC_CALL
+
+def lts_message_class(message_type):
+    return str(getattr(message_type, "value", message_type)).split("_")[0]
+
+# ------------------------------------------------------------------------------
+
+# bound on the inbound work of an agent, per message class. A message is
+# admitted while fewer than limit messages of its class are queued or being
+# handled, otherwise the sender gets a CORE_BUSY reply with a retry_after_ms
+# hint. Classes without a limit are not bounded.
+
+LTS_ADMISSION_LIMITS = {"USER": 256, "RPC": 64}
+
+class LTS_Admission(LTS_BaseClass):
+
+    def __init__(self, admission_uuid, limits=None, retry_after_ms=100):
+        super().__init__("LTS_Admission")
+        self.uuid = admission_uuid
+        self.limits = dict(LTS_ADMISSION_LIMITS if limits is None else limits)
+        self.retry_after_ms = retry_after_ms
+
+        # message class : str -> admitted messages not done yet : int
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+
+        self.nb_rejected = 0
+
+
+    def toJSON(self):
+        self.pending_lock.acquire()
+        res = json.dumps({"class_name": "LTS_Admission", "uuid": self.uuid,
+                          "limits": self.limits, "pending": self.pending,
+                          "retry_after_ms": self.retry_after_ms,
+                          "rejected": self.nb_rejected})
+        self.pending_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def getLimit(self, message_class):
+        return self.limits.get(message_class)
+
+    def admit(self, message_type):
+        message_class = lts_message_class(message_type)
+        limit = self.limits.get(message_class)
+        self.pending_lock.acquire()
+        pending = self.pending.get(message_class, 0)
+        res = limit is None or pending < limit
+        if res:
+            self.pending[message_class] = pending + 1
+        else:
+            self.nb_rejected = self.nb_rejected + 1
+        self.pending_lock.release()
+        if not res:
+            logging.warning("[ADM] "+self.uuid+" Rejecting " + str(getattr(message_type, "value", message_type)) + ", " + str(pending) + " " + message_class + " messages pending")
+        return res
+
+    def done(self, message_type):
+        message_class = lts_message_class(message_type)
+        self.pending_lock.acquire()
+        if message_class in self.pending:
+            self.pending[message_class] = self.pending[message_class] - 1
+        self.pending_lock.release()
+
+    # reply asking the sender to back off, peers that predate CORE_BUSY get
+    # an empty response instead
+    def busyMessage(self, message, min_wire_version):
+        if message.wire_version < min_wire_version:
+            return LTS_Message(LTS_MessageType.CORE_NONE)
+        return LTS_Message(LTS_MessageType.CORE_BUSY,
+                           content={"retry_after_ms": self.retry_after_ms},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+# ------------------------------------------------------------------------------
+
+# sender side: peers that answered CORE_BUSY are not sent new requests until
+# their retry_after_ms hint is over, capped to max_delay_ms
+
+class LTS_Backoff(LTS_BaseClass):
+
+    def __init__(self, backoff_uuid, max_delay_ms=10000):
+        super().__init__("LTS_Backoff")
+        self.uuid = backoff_uuid
+        self.max_delay_sec = max_delay_ms / 1000
+
+        # peer uuid : str -> end of the back off : float (monotonic)
+        self.busy_until = dict()
+        self.busy_lock = threading.Lock()
+
+
+    def setBusy(self, uuid, retry_after_ms):
+        delay = min(retry_after_ms / 1000, self.max_delay_sec)
+        logging.info("[BOF] "+self.uuid+" Agent " + uuid + " busy, backing off " + str(int(delay * 1000)) + " milliseconds")
+        self.busy_lock.acquire()
+        self.busy_until[uuid] = monotonic() + delay
+        self.busy_lock.release()
+
+    # seconds to wait before sending to the peer again
+    def getDelay(self, uuid):
+        res = 0
+        self.busy_lock.acquire()
+        if uuid in self.busy_until:
+            res = self.busy_until[uuid] - monotonic()
+            if res <= 0:
+                res = 0
+                del self.busy_until[uuid]
+        self.busy_lock.release()
+        return res
+
+    def processResponse(self, uuid, response):
+        if response.message_type == LTS_MessageType.CORE_BUSY:
+            content = response.getContentObject() or dict()
+            self.setBusy(uuid, content.get('retry_after_ms', 0))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    admission = LTS_Admission("alice", limits={"USER": 2})
+    print([admission.admit(LTS_MessageType.USER_DEFINED) for i in range(3)])
+    admission.done(LTS_MessageType.USER_DEFINED)
+    print(admission.admit(LTS_MessageType.USER_DEFINED), admission.admit(LTS_MessageType.DHT_GET_PEER))
+    print(admission.toJSON())
+
+    backoff = LTS_Backoff("bob")
+    backoff.processResponse("alice", admission.busyMessage(LTS_Message(LTS_MessageType.USER_DEFINED, from_uuid="bob"), 0))
+    print(backoff.getDelay("alice") > 0, backoff.getDelay("charles"))
+
+    exit(0)
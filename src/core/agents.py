@@ -1,5 +1,6 @@
 
 import uuid
+import queue
 import threading
 
 from time import sleep
@@ -7,7 +8,14 @@ from time import sleep
 from src.core.common import *
 from src.core.communicator import *
 from src.core.dsm import LTS_DSM
+from src.core.memory import LTS_MEMORY_CAPACITY
 from src.core.rpc import LTS_RPC
+from src.core.dispatch import LTS_HandlerRegistry
+from src.core.admission import LTS_Admission
+from src.core.membership import LTS_Membership
+from src.core.view import LTS_PartialView
+from src.core.gossip import LTS_GossipBroadcast
+from src.core.wire import LTS_WIRE_VERSION, LTS_WIRE_BUSY, LTS_WIRE_TYPE_CODES, lts_wire_split_envelope
 
 # ------------------------------------------------------------------------------
 
@@ -19,7 +27,35 @@ class LTS_Agent(LTS_BaseClass):
                  running = True,
                  dispatch_handler = None,
                  heartbeat_timer_sec = 8,
-                 broadcast_terminate = True):
+                 broadcast_terminate = True,
+                 zmq_pool_idle_sec = 60,
+                 zmq_server_workers = 4,
+                 zmq_broadcast_parallel = True,
+                 zmq_broadcast_deadline_sec = None,
+                 zmq_wire_version = LTS_WIRE_VERSION,
+                 codec = "json",
+                 zmq_coalesce_linger_ms = 0,
+                 zmq_coalesce_max = 64,
+                 zmq_compress_threshold = None,
+                 zmq_compressor = None,
+                 zmq_inproc = True,
+                 inbound_limits = None,
+                 busy_retry_after_ms = 100,
+                 zmq_busy_retries = 2,
+                 zmq_seeds = None,
+                 terminate_deadline_sec = 1,
+                 zmq_breaker_open_sec = 5,
+                 zmq_min_timeout_ms = 1000,
+                 dht_bucket_size = None,
+                 membership = True,
+                 membership_period_sec = 1,
+                 dht_active_size = None,
+                 dht_passive_size = 30,
+                 gossip = False,
+                 dht_snapshot = None,
+                 dht_snapshot_sec = 60,
+                 dsm_capacity = LTS_MEMORY_CAPACITY,
+                 dsm_policy = "lru"):
 
         super().__init__("LTS_Agent")
         self.uuid = agent_uuid or str(uuid.uuid4())
@@ -31,20 +67,81 @@ class LTS_Agent(LTS_BaseClass):
                                              zmq_bind or "tcp://*:5555",
                                              zmq_address or "tcp://localhost:5555",
                                              zmq_seed_uuid, zmq_seed_address,
-                                             zmq_recv_timeout_sec)
-
-        self.dsm = LTS_DSM(dsm_uuid=self.uuid, communicator=self.communicator)
-
-        self.rpc = LTS_RPC(rpc_uuid=self.uuid, communicator=self.communicator)
-
+                                             zmq_recv_timeout_sec,
+                                             zmq_pool_idle_sec,
+                                             zmq_server_workers,
+                                             zmq_broadcast_parallel,
+                                             zmq_broadcast_deadline_sec,
+                                             zmq_wire_version,
+                                             codec,
+                                             zmq_coalesce_linger_ms,
+                                             zmq_coalesce_max,
+                                             zmq_compress_threshold,
+                                             zmq_compressor,
+                                             zmq_inproc,
+                                             zmq_busy_retries,
+                                             zmq_seeds,
+                                             zmq_breaker_open_sec,
+                                             zmq_min_timeout_ms,
+                                             dht_bucket_size,
+                                             dht_active_size,
+                                             dht_passive_size,
+                                             dht_snapshot,
+                                             dht_snapshot_sec)
+
+        # bounded inbound work per message class, see LTS_ADMISSION_LIMITS
+        self.admission = LTS_Admission(self.uuid, inbound_limits, busy_retry_after_ms)
+
+        # the partial view is maintained every heartbeat and replaces the
+        # gossip membership, which knows every member
+        self.view = None
+        if dht_active_size:
+            self.view = LTS_PartialView(self.uuid, self.communicator)
+            self.communicator.view = self.view
+            membership = False
+
+        # membership False falls back to asking one peer for another one
+        # every heartbeat
+        self.membership = None
+        if membership:
+            self.membership = LTS_Membership(self.uuid, self.communicator,
+                                             period_sec=membership_period_sec)
+            self.communicator.membership = self.membership
+
+        # multi-hop broadcast over the peers of the DHT, its messages are
+        # delivered like the batched ones
+        self.gossip = None
+        if gossip:
+            self.gossip = LTS_GossipBroadcast(self.uuid, self.communicator, self.submitMessage)
+            self.communicator.gossip = self.gossip
+
+        self.dsm = LTS_DSM(dsm_uuid=self.uuid, communicator=self.communicator,
+                           memory_capacity=dsm_capacity, memory_policy=dsm_policy)
+
+        self.rpc = LTS_RPC(rpc_uuid=self.uuid, rpc_timeout_sec=zmq_recv_timeout_sec,
+                           communicator=self.communicator,
+                           rpc_max_pending=self.admission.getLimit("RPC"))
+
+        self.handlers = LTS_HandlerRegistry(self.uuid)
+        self.registerHandlers()
         
         self.heartbeat_timer_sec = heartbeat_timer_sec
 
         self.broadcast_terminate = broadcast_terminate
+        # peers that are already gone never answer the terminate broadcast,
+        # it is not worth waiting for them as long as for other requests
+        self.terminate_deadline_sec = terminate_deadline_sec
         
         self.pid_agt = None
         self.pid_net = None
+        self.pid_wrk_list = list()
 
+        # requests waiting for a worker : Queue((envelope, LTS_Message)), the
+        # envelope is None when no reply is expected
+        self.inbound_queue = queue.Queue()
+
+        # set when the agent stops, wakes the network thread up
+        self.stopped = threading.Event()
         self.running_lock = threading.Lock()
         self.setRunning(running)
         
@@ -69,81 +166,230 @@ class LTS_Agent(LTS_BaseClass):
         self.running_lock.acquire()
         self.running = running
         self.running_lock.release()
+        if running:
+            self.stopped.clear()
+        else:
+            self.stopped.set()
+            self.communicator.wakeServer()
 
 
     def run_agt(self):
         logging.info("[AGT] "+self.uuid+" Agent running on " + self.communicator.zmq_address)
-        while self.getRunning():
-            self.communicator.zmq_socket_rep.RCVTIMEO = self.communicator.zmq_recv_timeout
-            data_recv = None
-            try:
-                data_recv = self.communicator.zmq_socket_rep.recv_string()
-            except zmq.ZMQError as e:
-                if e.errno == zmq.EAGAIN:
-                    logging.info("[AGT] "+self.uuid+" Agent recv timeout")
+        if self.communicator.zmq_socket_router:
+            self.run_router()
+        else:
+            self.run_rep()
 
-            if data_recv:
-                message = self.communicator.processMessage(data_recv)
-                response = self.dispatchMessage(message)
-                self.communicator.zmq_socket_rep.send_string(response.toJSON())
+        if self.communicator.outbound:
+            self.communicator.outbound.terminate()
+
+        if self.gossip:
+            self.gossip.terminate()
+
+        self.communicator.saveSnapshot(force=True)
+
+        if self.membership:
+            self.membership.leave()
 
         if self.broadcast_terminate:
             logging.info("[AGT] "+self.uuid+" Agent broadcast terminate")
             message = LTS_Message(LTS_MessageType.CORE_TERMINATE,
                                   from_uuid=self.uuid)
-            self.communicator.broadcastMessage(message)
+            self.communicator.scatterMessage(message, deadline_ms=self.terminate_deadline_sec * 1000)
 
         self.pid_net.join()
-        self.communicator.zmq_socket_rep.close()
+        self.communicator.pool.close()
+        self.communicator.closeServer()
         logging.info("[AGT] "+self.uuid+" Agent terminating")
 
 
+    # handlers of the core message types, applications add their own
+    # with registerHandler
+    def registerHandlers(self):
+        self.handlers.register(LTS_MessageType.CORE_NONE, self.dispatchNone, inline=True)
+        self.handlers.register(LTS_MessageType.CORE_TERMINATE, self.dispatchTerminate)
+        self.handlers.register(LTS_MessageType.CORE_BATCH, self.dispatchBatch, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_GET_PEER, self.communicator.dht.dispatchGetPeer, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_SUBSCRIBE, self.dispatchSubscribe, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_SEARCH_PEER, self.communicator.dht.dispatchSearchPeer, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_PING_REQ, self.dispatchPingReq)
+        self.handlers.register(LTS_MessageType.DHT_FORWARD_JOIN, self.dispatchForwardJoin, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_DISCONNECT, self.dispatchDisconnect, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_SHUFFLE, self.dispatchShuffle, inline=True)
+        self.handlers.register(LTS_MessageType.GOSSIP_PUSH, self.dispatchGossipPush, inline=True)
+        self.handlers.register(LTS_MessageType.GOSSIP_IHAVE, self.dispatchGossipIHave, inline=True)
+        self.handlers.register(LTS_MessageType.GOSSIP_GRAFT, self.dispatchGossipGraft, inline=True)
+        self.handlers.register(LTS_MessageType.RPC_CALL, self.dispatchRPCCall, inline=True)
+        self.handlers.register(LTS_MessageType.RPC_RESULTS, self.dispatchRPCResults, inline=True)
+        self.handlers.register(LTS_MessageType.DSM_CHUNK_ADVERTIZE, self.dsm.dispatchMessage, inline=True)
+        self.handlers.register(LTS_MessageType.DSM_CHUNK_GET, self.dsm.dispatchMessage, inline=True)
+        self.handlers.register(LTS_MessageType.DSM_CHUNK_INVALIDATE, self.dsm.dispatchMessage, inline=True)
+        self.handlers.register(LTS_MessageType.DSM_CHUNK_PUT, self.dsm.dispatchMessage)
+        self.handlers.register(LTS_MessageType.USER_DEFINED, self.dispatchUser)
+
+    def registerHandler(self, message_type, handler, inline=False):
+        self.handlers.register(message_type, handler, inline)
+
+
+    def run_rep(self):
+        rep = self.communicator.zmq_socket_rep
+        control = self.communicator.zmq_socket_control
+        poller = zmq.Poller()
+        poller.register(rep, zmq.POLLIN)
+        poller.register(control, zmq.POLLIN)
+        while self.getRunning():
+            events = dict(poller.poll(self.communicator.zmq_recv_timeout))
+            if not events:
+                logging.info("[AGT] "+self.uuid+" Agent recv timeout")
+            if control in events:
+                self.communicator.drainControl()
+            if rep in events:
+                data_recv = rep.recv_multipart(copy=False)
+                message = self.communicator.processMessage(data_recv)
+                response = self.dispatchMessage(message)
+                rep.send_multipart(self.communicator.wire.encodeReply(response, message), copy=False)
+
+
+    # requests are received on the ROUTER socket and queued for the workers,
+    # replies come back on the inproc PULL socket with the identity envelope
+    # of the requester and are routed back through the ROUTER socket
+    def run_router(self):
+        router = self.communicator.zmq_socket_router
+        reply = self.communicator.zmq_socket_reply
+        control = self.communicator.zmq_socket_control
+
+        for i in range(self.communicator.zmq_server_workers):
+            pid_wrk = threading.Thread(target=self.run_wrk)
+            pid_wrk.start()
+            self.pid_wrk_list.append(pid_wrk)
+
+        poller = zmq.Poller()
+        poller.register(router, zmq.POLLIN)
+        poller.register(reply, zmq.POLLIN)
+        poller.register(control, zmq.POLLIN)
+        while self.getRunning():
+            events = dict(poller.poll(self.communicator.zmq_recv_timeout))
+            if not events:
+                logging.info("[AGT] "+self.uuid+" Agent recv timeout")
+            if control in events:
+                self.communicator.drainControl()
+            if reply in events:
+                self.forwardReplies(router, reply)
+            if router in events:
+                while True:
+                    try:
+                        frames = router.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.serveRequest(router, *lts_wire_split_envelope(frames))
+
+        for pid_wrk in self.pid_wrk_list:
+            self.inbound_queue.put(None)
+        for pid_wrk in self.pid_wrk_list:
+            pid_wrk.join()
+        self.forwardReplies(router, reply)
+
+
+    # inline handlers are run right away, the others are queued for the
+    # workers
+    def serveRequest(self, router, envelope, frames):
+        message = self.communicator.processMessage(frames)
+        handler = self.handlers.get(message.message_type)
+        if handler is None or handler.inline:
+            response = self.dispatchMessage(message)
+            router.send_multipart(envelope + self.communicator.wire.encodeReply(response, message), copy=False)
+        elif self.admission.admit(message.message_type):
+            self.queueRequest(envelope, message)
+        else:
+            response = self.busyMessage(message)
+            router.send_multipart(envelope + self.communicator.wire.encodeReply(response, message), copy=False)
+
+    # envelope is None when no reply is expected
+    def queueRequest(self, envelope, message):
+        self.inbound_queue.put((envelope, message))
+
+    # dispatch a message whose response is not needed, on a worker unless
+    # its handler is inline
+    def submitMessage(self, message):
+        handler = self.handlers.get(message.message_type)
+        if self.pid_wrk_list and handler is not None and not handler.inline:
+            if self.admission.admit(message.message_type):
+                self.queueRequest(None, message)
+            else:
+                logging.warning("[AGT] "+self.uuid+" Agent dropping batched message " + str(message.message_type) + " from " + str(message.from_uuid))
+        else:
+            self.dispatchMessage(message)
+
+
+    def forwardReplies(self, router, reply):
+        while True:
+            try:
+                frames = reply.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            router.send_multipart(frames, copy=False)
+
+
+    def run_wrk(self):
+        push = self.communicator.zmq_context.socket(zmq.PUSH)
+        push.connect(self.communicator.zmq_reply_address)
+        while True:
+            request = self.inbound_queue.get()
+            if request is None:
+                break
+            envelope, message = request
+            response = self.runRequest(message)
+            if envelope is not None:
+                push.send_multipart(envelope + self.communicator.wire.encodeReply(response, message), copy=False)
+        push.close()
+
+
+    # dispatch an admitted message, a handler that raises is answered with
+    # CORE_NONE instead of leaving the sender waiting for its timeout
+    def runRequest(self, message):
+        try:
+            return self.dispatchMessage(message)
+        except Exception:
+            logging.exception("[AGT] "+self.uuid+" Agent failed to handle message " + str(message.message_type) + " from " + str(message.from_uuid))
+            return LTS_Message(LTS_MessageType.CORE_NONE,
+                               from_uuid=self.uuid, to_uuid=message.from_uuid)
+        finally:
+            self.admission.done(message.message_type)
+
+
     def run_net(self):
         logging.info("[NET] "+self.uuid+" Agent building network overlay")
-        while self.getRunning():
-            sleep(self.heartbeat_timer_sec)
+        self.communicator.bootstrap()
+        period_sec = self.membership.period_sec if self.membership else self.heartbeat_timer_sec
+        while not self.stopped.wait(period_sec):
+            self.heartbeat()
+
+        logging.info("[NET] "+self.uuid+" Agent terminating")
+
+    # one round of the membership protocol, or one more peer
+    def heartbeat(self):
+        if self.view:
+            self.view.maintain()
+        elif self.membership:
+            self.membership.probe()
+        else:
             new_uuid = self.communicator.populate()
             if new_uuid:
-                self.communicator.subscribe(new_uuid)
-            
-        logging.info("[NET] "+self.uuid+" Agent terminating")
+                self.communicator.subscribe(new_uuid, post=True)
+        if self.gossip:
+            self.gossip.maintain()
+        self.communicator.saveSnapshot()
+        self.communicator.pool.evictIdle()
 
 
     def dispatchMessage(self, message):
-        logging.info("[AGT] "+self.uuid+" Agent received message " + str(message.message_type) + " from " + message.from_uuid + " content " + message.content)
+        logging.info("[AGT] "+self.uuid+" Agent received message " + str(message.message_type) + " from " + message.from_uuid + " content " + str(message.content))
         response = LTS_Message(LTS_MessageType.CORE_ACK,
                                from_uuid=self.uuid, to_uuid=message.from_uuid)
 
-        if message.message_type == LTS_MessageType.CORE_TERMINATE:
-            self.rpc.terminate()
-            self.setRunning(False)
-
-        elif message.message_type == LTS_MessageType.DHT_GET_PEER:
-            response = self.communicator.dht.dispatchGetPeer(message)
-
-        elif message.message_type == LTS_MessageType.DHT_SUBSCRIBE:
-            content_json = json.loads(message.content)
-            if content_json and 'uuid' in content_json:
-                self.communicator.dht.add(content_json['uuid'], content_json['address'])
-
-        elif message.message_type == LTS_MessageType.RPC_CALL:
-            content_json = json.loads(message.content)
-            self.rpc.addInstance(name=content_json['procedure'],
-                                 params_json=str(content_json['parameters']),
-                                 rpc_uuid=content_json['rpc_uuid'],
-                                 from_uuid=message.from_uuid)
-
-        elif message.message_type == LTS_MessageType.RPC_RESULTS:
-            content_json = json.loads(message.content)
-            self.rpc.result(content_json)
-                
-        elif message.message_type == LTS_MessageType.USER_DEFINED or message.message_type.startswith("DSM_"):
-            if self.dispatch_handler:
-                response = self.dispatch_handler.dispatchMessage(message) or response
-
-            else:
-                logging.error("[AGT] "+self.uuid+" Agent received message from " + message.from_uuid + " with type " + str(message.message_type) + " but no dispatch handler is set")
-
+        handler = self.handlers.get(message.message_type)
+        if handler:
+            response = handler.handler(message) or response
 
         else:
             logging.error("[AGT] "+self.uuid+" Agent received message from " + message.from_uuid + " with unknown type " + str(message.message_type))
@@ -151,7 +397,98 @@ class LTS_Agent(LTS_BaseClass):
             self.setRunning(False)
 
         return response
-            
+
+
+    # the sender is leaving the overlay
+    def dispatchTerminate(self, message):
+        self.communicator.dht.remove(message.from_uuid)
+        self.rpc.terminate()
+        self.setRunning(False)
+
+    def dispatchSubscribe(self, message):
+        content_json = message.getContentObject()
+        if content_json and 'uuid' in content_json:
+            if self.view:
+                return self.view.dispatchSubscribe(message)
+            if self.membership:
+                return self.membership.dispatchPing(message)
+            self.communicator.dht.add(content_json['uuid'], content_json['address'])
+
+    # blocks for the ping of the member, on a worker. Agents without
+    # membership answer a plain CORE_ACK, which is not an answer of the member
+    def dispatchPingReq(self, message):
+        if self.membership:
+            return self.membership.dispatchPingReq(message)
+
+    # agents without a partial view keep every peer and do not take part in
+    # the shuffles
+    def dispatchForwardJoin(self, message):
+        if self.view:
+            return self.view.dispatchForwardJoin(message)
+        content_json = message.getContentObject()
+        self.communicator.dht.add(content_json['uuid'], content_json['address'])
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"accept": True},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+    def dispatchDisconnect(self, message):
+        if self.view:
+            return self.view.dispatchDisconnect(message)
+
+    def dispatchShuffle(self, message):
+        if self.view:
+            return self.view.dispatchShuffle(message)
+
+    # agents without gossip deliver what they are pushed without forwarding
+    # it, and never ask for the messages announced
+    def dispatchGossipPush(self, message):
+        if self.gossip:
+            return self.gossip.dispatchPush(message)
+        gossip = message.getContentObject()
+        self.submitMessage(LTS_Message(gossip['type'], content=gossip['content'],
+                                       from_uuid=gossip['origin'], to_uuid=self.uuid))
+
+    def dispatchGossipIHave(self, message):
+        if self.gossip:
+            return self.gossip.dispatchIHave(message)
+
+    def dispatchGossipGraft(self, message):
+        if self.gossip:
+            return self.gossip.dispatchGraft(message)
+
+    # messages of unknown type, see LTS_Wire.decode
+    def dispatchNone(self, message):
+        return LTS_Message(LTS_MessageType.CORE_NONE,
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+    def dispatchBatch(self, message):
+        content_json = message.getContentObject()
+        for obj in content_json['messages']:
+            batched = LTS_Message(LTS_MessageType.CORE_NONE)
+            batched.fromDict(obj)
+            if batched.message_type not in LTS_WIRE_TYPE_CODES:
+                logging.warning("[AGT] "+self.uuid+" Agent dropping batched message of unknown type " + str(batched.message_type) + " from " + str(batched.from_uuid))
+                continue
+            self.submitMessage(batched)
+
+    def dispatchRPCCall(self, message):
+        content_json = message.getContentObject()
+        if not self.rpc.addInstance(name=content_json['procedure'],
+                                    params_json=json.dumps(content_json['parameters']),
+                                    rpc_uuid=content_json['rpc_uuid'],
+                                    from_uuid=message.from_uuid):
+            return self.busyMessage(message)
+
+    def dispatchRPCResults(self, message):
+        self.rpc.result(message.getContentObject())
+
+    # application handlers may also return it when their own queues are full
+    def busyMessage(self, message):
+        return self.admission.busyMessage(message, LTS_WIRE_BUSY)
+
+    def dispatchUser(self, message):
+        if self.dispatch_handler:
+            return self.dispatch_handler.dispatchMessage(message)
+        logging.error("[AGT] "+self.uuid+" Agent received message from " + message.from_uuid + " with type " + str(message.message_type) + " but no dispatch handler is set")
 
 
     def terminate(self):
@@ -0,0 +1,653 @@
+import uuid
+import random
+import asyncio
+import threading
+
+import zmq
+import zmq.asyncio
+
+from datetime import datetime
+
+from src.core.common import *
+from src.core.dht import LTS_DHT
+from src.core.message import *
+from src.core.pool import LTS_ConnectionPool
+from src.core.wire import LTS_Wire, LTS_WIRE_VERSION, lts_wire_split_envelope
+from src.core.dsm import LTS_DSM
+from src.core.memory import LTS_Chunk
+from src.core.rpc import LTS_RPC, LTS_RPC_Instance
+from src.core.agents import LTS_Agent
+from src.core.dispatch import LTS_HandlerRegistry
+from src.core.admission import LTS_Admission, LTS_Backoff
+from src.core.breaker import LTS_CircuitBreaker
+from src.core.inproc import lts_zmq_context, lts_inproc
+from src.core.coordinates import LTS_Vivaldi
+
+# ------------------------------------------------------------------------------
+
+# asyncio flavour of LTS_Communicator: same DHT, pool and message format,
+# but every exchange is a coroutine so that a single event loop can keep
+# thousands of requests in flight
+
+class LTS_AsyncCommunicator(LTS_BaseClass):
+
+    def __init__(self, comm_uuid, name,
+                 zmq_bind="tcp://*:5555", zmq_address="tcp://localhost:5555",
+                 zmq_seed_uuid=None, zmq_seed_address=None,
+                 zmq_recv_timeout_sec=10,
+                 zmq_pool_idle_sec=60,
+                 zmq_broadcast_deadline_sec=None,
+                 zmq_wire_version=LTS_WIRE_VERSION,
+                 codec="json",
+                 zmq_compress_threshold=None,
+                 zmq_compressor=None,
+                 zmq_inproc=True,
+                 zmq_busy_retries=2,
+                 zmq_seeds=None,
+                 zmq_breaker_open_sec=5,
+                 zmq_min_timeout_ms=1000):
+
+        super().__init__("LTS_AsyncCommunicator")
+        self.uuid = comm_uuid
+        self.name = name
+
+        self.zmq_bind = zmq_bind
+        self.zmq_address = zmq_address
+        self.zmq_seed_uuid = zmq_seed_uuid
+        self.zmq_seed_address = zmq_seed_address
+
+        # shadow of the shared context so that threaded and asyncio agents
+        # of the process reach each other over inproc endpoints
+        self.zmq_inproc = zmq_inproc
+        self.zmq_inproc_address = None
+        if self.zmq_inproc:
+            self.zmq_context = zmq.asyncio.Context.shadow(lts_zmq_context().underlying)
+        else:
+            self.zmq_context = zmq.asyncio.Context()
+        self.zmq_socket_router = self.zmq_context.socket(zmq.ROUTER)
+        self.zmq_socket_router.bind(self.zmq_bind)
+        if self.zmq_inproc and not self.zmq_bind.startswith("inproc://"):
+            self.zmq_inproc_address = "inproc://lts-" + self.uuid + "-" + str(id(self))
+            self.zmq_socket_router.bind(self.zmq_inproc_address)
+            lts_inproc.register(self.zmq_address, self.zmq_inproc_address)
+
+        self.zmq_recv_timeout = zmq_recv_timeout_sec * 1000
+        self.zmq_busy_retries = zmq_busy_retries
+        self.backoff = LTS_Backoff(self.uuid, self.zmq_recv_timeout)
+        self.breaker = LTS_CircuitBreaker(self.uuid, self.zmq_recv_timeout,
+                                          zmq_min_timeout_ms,
+                                          open_sec=zmq_breaker_open_sec)
+        self.zmq_broadcast_deadline = self.zmq_recv_timeout
+        if zmq_broadcast_deadline_sec is not None:
+            self.zmq_broadcast_deadline = zmq_broadcast_deadline_sec * 1000
+
+        self.wire = LTS_Wire(self.uuid, zmq_wire_version, codec,
+                             zmq_compress_threshold, zmq_compressor)
+
+        self.pool = LTS_ConnectionPool(self.uuid, self.zmq_context,
+                                       idle_timeout_sec=zmq_pool_idle_sec)
+
+        self.dht = LTS_DHT(self.uuid)
+        self.dht.addRemoveListener(self.pool.evict)
+        self.dht.add(self.uuid, self.zmq_address)
+
+        self.vivaldi = LTS_Vivaldi(self.uuid)
+        self.wire.vivaldi = self.vivaldi
+        self.dht.vivaldi = self.vivaldi
+
+        # subscription to the seeds is done by LTS_AsyncAgent.run
+        self.zmq_seeds = [seed for seed in (zmq_seeds or list()) if seed[0] != self.uuid]
+        if self.zmq_seed_uuid == self.uuid or self.zmq_seed_uuid is None:
+            self.zmq_seed_uuid = self.uuid
+            self.zmq_seed_address = self.zmq_address
+        else:
+            self.zmq_seeds.insert(0, (self.zmq_seed_uuid, self.zmq_seed_address))
+        for seed_uuid, seed_address in self.zmq_seeds:
+            self.dht.add(seed_uuid, seed_address)
+
+
+    def toJSON(self):
+        res = '{"class_name": "LTS_AsyncCommunicator", "uuid": "'+self.uuid+'", "zmq_bind": "'+self.zmq_bind+'", "zmq_address": "'+self.zmq_address+'", "zmq_seed_uuid": "'+self.zmq_seed_uuid+'", "zmq_seed_address": "'+self.zmq_seed_address+'", "dht": '+self.dht.toJSON()+'}'
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def getPeerAddress(self, to_uuid):
+        to_address = self.dht.getAddress(to_uuid)
+        if to_address and self.zmq_inproc:
+            to_address = lts_inproc.resolve(to_address)
+        return to_address
+
+    def closeServer(self):
+        if self.zmq_inproc_address:
+            lts_inproc.unregister(self.zmq_address, self.zmq_inproc_address)
+        self.zmq_socket_router.close()
+
+    def processMessage(self, frames):
+        message = self.wire.decode(frames)
+        self.dht.setSeen(message.from_uuid, message.coordinate)
+        return message
+
+    def getCompressionStats(self):
+        return self.wire.getCompressionStats()
+
+
+    async def sendMessage(self, to_uuid, message, timeout_ms=None, busy_retries=None):
+        if busy_retries is None:
+            busy_retries = self.zmq_busy_retries
+        while True:
+            delay = self.backoff.getDelay(to_uuid)
+            if delay > 0 and busy_retries > 0:
+                await asyncio.sleep(delay)
+            response = await self.requestMessage(to_uuid, message, timeout_ms)
+            if response.message_type != LTS_MessageType.CORE_BUSY or busy_retries <= 0:
+                break
+            busy_retries = busy_retries - 1
+        return response
+
+    async def requestMessage(self, to_uuid, message, timeout_ms=None):
+        response = LTS_Message(LTS_MessageType.CORE_NONE)
+        if timeout_ms is None:
+            timeout_ms = self.zmq_recv_timeout
+        timeout_ms = min(timeout_ms, self.breaker.getTimeout(to_uuid))
+        to_address = self.getPeerAddress(to_uuid)
+        if to_address and not self.breaker.allow(to_uuid):
+            logging.info("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " failed, breaker open")
+        elif to_address:
+            entry = self.pool.acquire(to_uuid, to_address)
+            socket = entry.socket
+            start = datetime.now()
+            await socket.send_multipart(self.wire.encodeRequest(to_uuid, message), copy=False)
+            if await socket.poll(timeout_ms, zmq.POLLIN):
+                data_recv = await socket.recv_multipart(copy=False)
+                self.pool.release(to_uuid, entry)
+                end = datetime.now()
+                latency = end - start
+                self.breaker.success(to_uuid, latency.total_seconds())
+                self.dht.setLatency(to_uuid, latency.total_seconds() * 1000000)
+                response = self.processMessage(data_recv)
+                if response.coordinate:
+                    self.vivaldi.update(response.coordinate, self.dht.getLatency(to_uuid) or latency.total_seconds() * 1000000)
+                logging.info("[COM] "+self.uuid+" Agent latency " + str(int(latency.total_seconds() * 1000)) + " milliseconds with " + to_uuid)
+            else:
+                logging.info("[COM] "+self.uuid+" Agent recv timeout")
+                self.pool.discard(to_uuid, entry)
+                self.breaker.failure(to_uuid)
+                self.dht.remove(to_uuid)
+        else:
+            logging.warning("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " not in DHT")
+
+        return response
+
+
+    async def send(self, to_uuid, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content,
+                              from_uuid=self.uuid, to_uuid=to_uuid)
+        return await self.sendMessage(to_uuid, message)
+
+
+    # all sends share the same deadline since they run concurrently
+    async def scatterMessage(self, message, uuid_list=None, deadline_ms=None):
+        results = dict()
+        failures = list()
+        if uuid_list is None:
+            uuid_list = self.dht.getUuidList()
+        if deadline_ms is None:
+            deadline_ms = self.zmq_broadcast_deadline
+        coroutines = list()
+        for to_uuid in uuid_list:
+            peer_message = LTS_Message(message.message_type, content=message.content,
+                                       from_uuid=message.from_uuid, to_uuid=to_uuid)
+            coroutines.append(self.sendMessage(to_uuid, peer_message, deadline_ms, busy_retries=0))
+        responses = await asyncio.gather(*coroutines)
+        for to_uuid, response in zip(uuid_list, responses):
+            if response.message_type == LTS_MessageType.CORE_NONE:
+                failures.append(to_uuid)
+            else:
+                results[to_uuid] = response
+        return results, failures
+
+    async def broadcastMessage(self, message):
+        return await self.scatterMessage(message)
+
+    async def broadcast(self, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content, from_uuid=self.uuid)
+        return await self.broadcastMessage(message)
+
+
+    # ask a peer for another peer
+    async def populate(self):
+        res = None
+        best_uuid, _ = self.dht.getPeerBestLatency()
+        if best_uuid:
+            message = LTS_Message(LTS_MessageType.DHT_GET_PEER,
+                                  from_uuid=self.uuid, to_uuid = best_uuid)
+            response = await self.sendMessage(message.to_uuid, message)
+            if response.message_type == LTS_MessageType.CORE_RESPONSE:
+                response_json = response.getContentObject()
+                if response_json and 'uuid' in response_json:
+                    self.dht.add(response_json['uuid'], response_json['address'])
+                    self.dht.setCoordinate(response_json['uuid'], response_json.get('coordinate'))
+                    res = response_json['uuid']
+        return res
+
+    # send self uuid and address to an other peer to be added to its DHT
+    async def subscribe(self, to_uuid):
+        message = self.subscribeMessage(to_uuid)
+        return await self.sendMessage(message.to_uuid, message)
+
+    def subscribeMessage(self, to_uuid):
+        return LTS_Message(LTS_MessageType.DHT_SUBSCRIBE, {"uuid": self.uuid, "address": self.zmq_address}, from_uuid=self.uuid, to_uuid=to_uuid)
+
+    async def bootstrap(self, deadline_ms=None):
+        if not self.zmq_seeds:
+            return list()
+        results, failures = await self.scatterMessage(self.subscribeMessage(None),
+                                                      [seed_uuid for seed_uuid, _ in self.zmq_seeds],
+                                                      deadline_ms)
+        if failures:
+            logging.warning("[COM] "+self.uuid+" Agent seeds not reachable " + str(failures))
+        return list(results.keys())
+
+# ------------------------------------------------------------------------------
+
+class LTS_AsyncDSM(LTS_DSM):
+
+    async def write(self, chunk_id, content):
+        res = None
+        chunk = self.memory.getChunk(chunk_id)
+        if chunk is None:
+            logging.info("[DSM] "+self.uuid+" Writing chunk " + chunk_id + " in memory first touch")
+            res = self.memory.firstTouch(chunk_id, self.uuid, content)
+        elif chunk.agent_uuid == self.uuid:
+            res, version, sharers = self.writeOwned(chunk_id, content)
+            await self.invalidate(chunk_id, version, sharers)
+        elif self.isCoherent(chunk.agent_uuid):
+            logging.info("[DSM] "+self.uuid+" Writing chunk " + chunk_id + " to agent " + chunk.agent_uuid)
+            message = self.putMessage(chunk, content)
+            response = await self.communicator.sendMessage(chunk.agent_uuid, message)
+            res = self.putResult(chunk, content, response)
+        else:
+            res = self.memory.addChunk(LTS_Chunk(chunk_id, chunk.agent_uuid,
+                                                 chunk.version + 1, content))
+        return res
+
+    async def invalidate(self, chunk_id, version, sharers):
+        if not sharers:
+            return
+        message = self.invalidateMessage(chunk_id, version, sharers)
+        _, failures = await self.communicator.scatterMessage(message, list(sharers), self.invalidate_deadline_ms)
+        self.invalidated(chunk_id, failures)
+
+    # awaited by serveMessage like the coroutine handlers
+    async def dispatchPut(self, message):
+        chunk_id, version, sharers = self.putOwned(message)
+        await self.invalidate(chunk_id, version, sharers)
+        return self.putResponse(message, chunk_id, version)
+
+    async def read(self, chunk_id):
+        content = None
+        chunk = self.memory.readChunk(chunk_id)
+        if chunk:
+            if chunk.content is not None:
+                content = chunk.content
+            else:
+                if chunk.agent_uuid is not None and chunk.agent_uuid != self.uuid:
+                    logging.info("[DSM] "+self.uuid+" Asking agent " + chunk.agent_uuid + " for chunk " + chunk.uuid)
+                    message = self.getMessage(chunk)
+                    response = await self.communicator.sendMessage(chunk.agent_uuid, message)
+                    content = self.getResult(response)
+        else:
+            logging.warning("[DSM] "+self.uuid+" Reading chunk " + chunk_id + " not in memory")
+        return content
+
+    async def advertize(self, chunk_id):
+        chunk = self.memory.getChunkMetadata(chunk_id)
+        if chunk:
+            message = LTS_Message(LTS_MessageType.DSM_CHUNK_ADVERTIZE, from_uuid=self.uuid,
+                                  content=chunk.toDict())
+            return await self.communicator.broadcastMessage(message)
+
+# ------------------------------------------------------------------------------
+
+# remote calls wait on a future instead of a thread and a condition, local
+# procedures run on the default executor unless they are coroutines. A remote
+# call without results after rpc_timeout_sec returns "{}" like a refused one
+
+class LTS_AsyncRPC(LTS_RPC):
+
+    def __init__(self, rpc_uuid=None, rpc_timeout_sec=10, communicator=None,
+                 rpc_max_pending=None):
+        super().__init__(rpc_uuid=rpc_uuid, rpc_timeout_sec=rpc_timeout_sec,
+                         running=False, communicator=communicator,
+                         rpc_max_pending=rpc_max_pending)
+        self.rpc_tasks = set()
+
+
+    def addInstance(self, name, params_json, rpc_uuid=None, from_uuid=None):
+        res = True
+        if name in self.rpc_local_dict:
+            if self.rpc_max_pending and len(self.rpc_tasks) >= self.rpc_max_pending:
+                logging.warning("[RPC] "+self.uuid+" Rejecting procedure " + name + " for " + str(from_uuid) + ", " + str(self.rpc_max_pending) + " calls pending")
+                return False
+            rpc_instance = LTS_RPC_Instance(name=name,
+                                            handler=self.rpc_local_dict[name],
+                                            params_json=params_json,
+                                            rpc_uuid=rpc_uuid,
+                                            from_uuid=from_uuid)
+            task = asyncio.get_running_loop().create_task(self.runInstance(rpc_instance))
+            self.rpc_tasks.add(task)
+            task.add_done_callback(self.rpc_tasks.discard)
+        else:
+            logging.warning("[RPC] "+self.uuid+" Procedure " + name + " unknown")
+        return res
+
+
+    async def runHandler(self, handler, params_json):
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(params_json)
+        return await asyncio.get_running_loop().run_in_executor(None, handler, params_json)
+
+
+    async def runInstance(self, rpc_instance):
+        logging.info("[SCD] "+self.uuid+" Scheduling "+rpc_instance.uuid+" procedure " + rpc_instance.name + " for " + str(rpc_instance.from_uuid))
+        try:
+            rpc_instance.results_json = await self.runHandler(rpc_instance.handler, rpc_instance.params_json)
+        except Exception:
+            logging.exception("[SCD] "+self.uuid+" Procedure " + rpc_instance.name + " "+rpc_instance.uuid+" failed")
+        if rpc_instance.from_uuid and self.communicator:
+            logging.info("[RSP] "+self.uuid+" Sending back results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " to " + str(rpc_instance.from_uuid))
+            message = self.resultsMessage(rpc_instance)
+            await self.communicator.sendMessage(rpc_instance.from_uuid, message)
+        else:
+            logging.warning("[RSP] "+self.uuid+" Discarding results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " (unable to send back)")
+
+
+    async def call(self, name, params_json="{}"):
+        logging.info("[RPC] "+self.uuid+" Call procedure " + name)
+        results_json = "{}"
+        if name in self.rpc_local_dict:
+            results_json = json.loads(await self.runHandler(self.rpc_local_dict[name], params_json))
+        elif name in self.rpc_remote_dict:
+            rpc_uuid = str(uuid.uuid4())
+            future = asyncio.get_running_loop().create_future()
+            self.rpc_sync_dict[rpc_uuid] = future
+            response = await self.callRemote(rpc_uuid, name, params_json)
+            if response.message_type == LTS_MessageType.CORE_ACK:
+                try:
+                    results_json = await asyncio.wait_for(future, self.rpc_timeout_sec)
+                except asyncio.TimeoutError:
+                    logging.warning("[RPC] "+self.uuid+" Procedure " + name + " no results after " + str(self.rpc_timeout_sec) + "s")
+            else:
+                logging.warning("[RPC] "+self.uuid+" Procedure " + name + " not accepted (" + str(response.message_type) + ")")
+            self.rpc_sync_dict.pop(rpc_uuid, None)
+
+        return results_json
+
+    async def callRemote(self, rpc_uuid, name, params_json):
+        uuid_list = self.choosePeers(name)
+        for to_uuid in uuid_list:
+            message = self.callMessage(rpc_uuid, name, params_json, to_uuid)
+            response = await self.communicator.sendMessage(to_uuid, message, busy_retries=0)
+            if response.message_type != LTS_MessageType.CORE_BUSY:
+                return response
+        message = self.callMessage(rpc_uuid, name, params_json, uuid_list[0])
+        return await self.communicator.sendMessage(uuid_list[0], message)
+
+
+    def result(self, content_json):
+        rpc_uuid = content_json['rpc_uuid']
+        future = self.rpc_sync_dict.get(rpc_uuid)
+        if future and not future.done():
+            future.set_result(content_json['results'])
+
+
+    def terminate(self):
+        self.setRunning(False)
+        for task in list(self.rpc_tasks):
+            task.cancel()
+
+# ------------------------------------------------------------------------------
+
+# asyncio flavour of LTS_Agent, message dispatching is shared with the
+# threaded agent. Several agents can be run on the same loop with
+# asyncio.gather(agent.run(), ...), or each one on its own loop thread with
+# start(), in which case runSync() is the blocking entry point for
+# threaded code (e.g. agent.runSync(agent.rpc.call("procedure")))
+
+class LTS_AsyncAgent(LTS_Agent):
+
+    def __init__(self, agent_uuid=None, name=None,
+                 zmq_bind="tcp://*:5555", zmq_address="tcp://localhost:5555",
+                 zmq_seed_uuid=None, zmq_seed_address=None, zmq_recv_timeout_sec=10,
+                 dispatch_handler = None,
+                 heartbeat_timer_sec = 8,
+                 broadcast_terminate = True,
+                 zmq_pool_idle_sec = 60,
+                 zmq_broadcast_deadline_sec = None,
+                 zmq_wire_version = LTS_WIRE_VERSION,
+                 codec = "json",
+                 zmq_compress_threshold = None,
+                 zmq_compressor = None,
+                 zmq_inproc = True,
+                 inbound_limits = None,
+                 busy_retry_after_ms = 100,
+                 zmq_busy_retries = 2,
+                 zmq_seeds = None,
+                 terminate_deadline_sec = 1,
+                 zmq_breaker_open_sec = 5,
+                 zmq_min_timeout_ms = 1000):
+
+        LTS_BaseClass.__init__(self, "LTS_AsyncAgent")
+        self.uuid = agent_uuid or str(uuid.uuid4())
+        self.name = name or str(self.uuid)
+
+        self.dispatch_handler = dispatch_handler
+
+        self.communicator = LTS_AsyncCommunicator(self.uuid, self.name,
+                                                  zmq_bind or "tcp://*:5555",
+                                                  zmq_address or "tcp://localhost:5555",
+                                                  zmq_seed_uuid, zmq_seed_address,
+                                                  zmq_recv_timeout_sec,
+                                                  zmq_pool_idle_sec,
+                                                  zmq_broadcast_deadline_sec,
+                                                  zmq_wire_version,
+                                                  codec,
+                                                  zmq_compress_threshold,
+                                                  zmq_compressor,
+                                                  zmq_inproc,
+                                                  zmq_busy_retries,
+                                                  zmq_seeds,
+                                                  zmq_breaker_open_sec,
+                                                  zmq_min_timeout_ms)
+
+        self.admission = LTS_Admission(self.uuid, inbound_limits, busy_retry_after_ms)
+
+        # no gossip membership, partial view nor gossip tree, the agent only
+        # answers the pings and pushes of the others and keeps every peer
+        self.membership = None
+        self.view = None
+        self.gossip = None
+
+        self.dsm = LTS_AsyncDSM(dsm_uuid=self.uuid, communicator=self.communicator)
+
+        self.rpc = LTS_AsyncRPC(rpc_uuid=self.uuid, rpc_timeout_sec=zmq_recv_timeout_sec,
+                                communicator=self.communicator,
+                                rpc_max_pending=self.admission.getLimit("RPC"))
+
+        self.handlers = LTS_HandlerRegistry(self.uuid)
+        self.registerHandlers()
+
+        self.heartbeat_timer_sec = heartbeat_timer_sec
+
+        self.broadcast_terminate = broadcast_terminate
+        # peers that are already gone never answer the terminate broadcast,
+        # it is not worth waiting for them as long as for other requests
+        self.terminate_deadline_sec = terminate_deadline_sec
+
+        self.loop = None
+        self.pid_loop = None
+        self.stop_event = None
+        self.request_tasks = set()
+
+        self.running_lock = threading.Lock()
+        self.running = False
+
+
+    def setRunning(self, running):
+        self.running_lock.acquire()
+        self.running = running
+        self.running_lock.release()
+        if not running and self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.setRunning(True)
+        logging.info("[AGT] "+self.uuid+" Agent running on " + self.communicator.zmq_address)
+
+        net_task = self.loop.create_task(self.run_net())
+        router = self.communicator.zmq_socket_router
+        while self.getRunning():
+            recv_task = asyncio.ensure_future(router.recv_multipart(copy=False))
+            stop_task = self.loop.create_task(self.stop_event.wait())
+            await asyncio.wait([recv_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+            if recv_task.done():
+                frames = recv_task.result()
+                task = self.loop.create_task(self.serveRequest(*lts_wire_split_envelope(frames)))
+                self.request_tasks.add(task)
+                task.add_done_callback(self.request_tasks.discard)
+            else:
+                recv_task.cancel()
+
+        if self.request_tasks:
+            await asyncio.wait(list(self.request_tasks))
+
+        if self.broadcast_terminate:
+            logging.info("[AGT] "+self.uuid+" Agent broadcast terminate")
+            message = LTS_Message(LTS_MessageType.CORE_TERMINATE,
+                                  from_uuid=self.uuid)
+            await self.communicator.scatterMessage(message, deadline_ms=self.terminate_deadline_sec * 1000)
+
+        net_task.cancel()
+        self.communicator.pool.close()
+        self.communicator.closeServer()
+        logging.info("[AGT] "+self.uuid+" Agent terminating")
+
+
+    # terminating only cancels tasks and coroutine handlers of the
+    # application run on the loop, like inline handlers
+    def registerHandlers(self):
+        super().registerHandlers()
+        self.handlers.register(LTS_MessageType.CORE_TERMINATE, self.dispatchTerminate, inline=True)
+        self.handlers.register(LTS_MessageType.DHT_PING_REQ, self.dispatchPingReq, inline=True)
+        if self.dispatch_handler and asyncio.iscoroutinefunction(self.dispatch_handler.dispatchMessage):
+            self.handlers.register(LTS_MessageType.USER_DEFINED, self.dispatchUser, inline=True)
+
+    def registerHandler(self, message_type, handler, inline=False):
+        self.handlers.register(message_type, handler, inline or asyncio.iscoroutinefunction(handler))
+
+    # ping a member on behalf of an agent running the membership protocol
+    async def dispatchPingReq(self, message):
+        content_json = message.getContentObject()
+        to_uuid = content_json['uuid']
+        if not self.communicator.dht.getAddress(to_uuid):
+            self.communicator.dht.add(to_uuid, content_json['address'])
+        response = await self.communicator.sendMessage(to_uuid, self.communicator.subscribeMessage(to_uuid),
+                                                       timeout_ms=content_json.get('timeout_ms', self.communicator.zmq_broadcast_deadline),
+                                                       busy_retries=0)
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE,
+                           {"ack": response.message_type != LTS_MessageType.CORE_NONE},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+
+    # inline handlers run on the loop, the others on the default executor
+    async def serveMessage(self, message):
+        handler = self.handlers.get(message.message_type)
+        if handler is None or handler.inline:
+            response = self.dispatchMessage(message)
+        elif self.admission.admit(message.message_type):
+            try:
+                response = await self.loop.run_in_executor(None, self.dispatchMessage, message)
+            finally:
+                self.admission.done(message.message_type)
+        else:
+            response = self.busyMessage(message)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def serveRequest(self, envelope, frames):
+        message = self.communicator.processMessage(frames)
+        default = LTS_Message(LTS_MessageType.CORE_ACK,
+                              from_uuid=self.uuid, to_uuid=message.from_uuid)
+        response = await self.serveMessage(message) or default
+        await self.communicator.zmq_socket_router.send_multipart(envelope + self.communicator.wire.encodeReply(response, message), copy=False)
+
+
+    def submitMessage(self, message):
+        task = self.loop.create_task(self.serveMessage(message))
+        self.request_tasks.add(task)
+        task.add_done_callback(self.request_tasks.discard)
+
+
+    async def run_net(self):
+        logging.info("[NET] "+self.uuid+" Agent building network overlay")
+        await self.communicator.bootstrap()
+        while self.getRunning():
+            await asyncio.sleep(self.heartbeat_timer_sec)
+            new_uuid = await self.communicator.populate()
+            if new_uuid:
+                await self.communicator.subscribe(new_uuid)
+            self.communicator.pool.evictIdle()
+
+
+    # run the agent on its own event loop thread
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.pid_loop = threading.Thread(target=self.loop.run_until_complete,
+                                         args=(self.run(),))
+        self.pid_loop.start()
+
+    # blocking wrapper to run one of the agent coroutines from another thread
+    def runSync(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    def terminate(self):
+        self.rpc.terminate()
+        self.setRunning(False)
+        if self.pid_loop:
+            self.pid_loop.join()
+            self.loop.close()
+
+
+# ------------------------------------------------------------------------------
+
+
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    async def main():
+        charles = LTS_AsyncAgent("charles", "Charles")
+        alice = LTS_AsyncAgent("alice", "Alice",
+                               zmq_bind="tcp://*:5556", zmq_address="tcp://localhost:5556",
+                               zmq_seed_uuid="charles", zmq_seed_address="tcp://localhost:5555",
+                               broadcast_terminate = False)
+        charles.rpc.register("echo", lambda params_json: params_json)
+        alice.rpc.registerRemote("echo", "charles")
+        tasks = [asyncio.create_task(charles.run()), asyncio.create_task(alice.run())]
+        await asyncio.sleep(0.5)
+        print(await alice.rpc.call("echo", '{"hello": "world"}'))
+        print(await alice.communicator.broadcast('{"hello": "world"}'))
+        alice.terminate()
+        await asyncio.sleep(0.5)
+        charles.terminate()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+    exit(0)
@@ -0,0 +1,170 @@
+import threading
+
+from time import monotonic
+from collections import deque
+
+from src.core.common import *
+
+# ------------------------------------------------------------------------------
+
+# circuit breaker states, a peer is closed while it answers. After
+# failure_threshold consecutive timeouts it is open and sends to it fail
+# right away. Once the open period is over a single request is let through
+# (half open): an answer closes the breaker, a timeout opens it again for
+# twice as long, up to max_open_sec
+
+LTS_BREAKER_CLOSED = "closed"
+LTS_BREAKER_OPEN = "open"
+LTS_BREAKER_HALF_OPEN = "half_open"
+
+class LTS_PeerHealth(LTS_BaseClass):
+
+    def __init__(self, uuid, open_sec, rtt_samples):
+        super().__init__("LTS_PeerHealth")
+        self.uuid = uuid
+        self.state = LTS_BREAKER_CLOSED
+        self.failures = 0
+        self.open_sec = open_sec
+        self.open_until = 0
+        # round trip times in seconds of the last answered requests
+        self.rtt = deque(maxlen=rtt_samples)
+        # milliseconds, None until enough round trips are known
+        self.timeout_ms = None
+
+    def toDict(self):
+        return {"uuid": self.uuid, "state": self.state, "failures": self.failures,
+                "timeout_ms": self.timeout_ms}
+
+# ------------------------------------------------------------------------------
+
+# the timeout of a request to a peer is rtt_factor times the rtt_percentile of
+# its last round trips, between min_timeout_ms and max_timeout_ms. Peers with
+# less than rtt_min_samples known round trips get max_timeout_ms
+
+class LTS_CircuitBreaker(LTS_BaseClass):
+
+    def __init__(self, breaker_uuid, max_timeout_ms=10000, min_timeout_ms=1000,
+                 failure_threshold=1, open_sec=5, max_open_sec=60,
+                 rtt_percentile=0.99, rtt_factor=4, rtt_samples=64, rtt_min_samples=8):
+        super().__init__("LTS_CircuitBreaker")
+        self.uuid = breaker_uuid
+        self.max_timeout_ms = max_timeout_ms
+        self.min_timeout_ms = min(min_timeout_ms, max_timeout_ms)
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.max_open_sec = max_open_sec
+        self.rtt_percentile = rtt_percentile
+        self.rtt_factor = rtt_factor
+        self.rtt_samples = rtt_samples
+        self.rtt_min_samples = rtt_min_samples
+
+        # peer uuid : str -> LTS_PeerHealth
+        self.peers = dict()
+        self.peers_lock = threading.Lock()
+
+        self.nb_rejected = 0
+
+
+    def toJSON(self):
+        self.peers_lock.acquire()
+        res = json.dumps({"class_name": "LTS_CircuitBreaker", "uuid": self.uuid,
+                          "peers": {key: value.toDict() for key, value in self.peers.items()},
+                          "rejected": self.nb_rejected})
+        self.peers_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def getPeer(self, uuid):
+        peer = self.peers.get(uuid)
+        if peer is None:
+            peer = LTS_PeerHealth(uuid, self.open_sec, self.rtt_samples)
+            self.peers[uuid] = peer
+        return peer
+
+    def getState(self, uuid):
+        self.peers_lock.acquire()
+        res = LTS_BREAKER_CLOSED
+        if uuid in self.peers:
+            res = self.peers[uuid].state
+        self.peers_lock.release()
+        return res
+
+    # False when requests to the peer must fail right away, lets the probe
+    # of a half open peer through
+    def allow(self, uuid):
+        res = True
+        self.peers_lock.acquire()
+        peer = self.peers.get(uuid)
+        if peer and peer.state != LTS_BREAKER_CLOSED:
+            if peer.state == LTS_BREAKER_OPEN and monotonic() >= peer.open_until:
+                peer.state = LTS_BREAKER_HALF_OPEN
+            else:
+                res = False
+                self.nb_rejected = self.nb_rejected + 1
+        self.peers_lock.release()
+        return res
+
+    # same as allow without changing the state, to sort out peers
+    def available(self, uuid):
+        self.peers_lock.acquire()
+        peer = self.peers.get(uuid)
+        res = peer is None or peer.state == LTS_BREAKER_CLOSED or (peer.state == LTS_BREAKER_OPEN and monotonic() >= peer.open_until)
+        self.peers_lock.release()
+        return res
+
+    def getTimeout(self, uuid):
+        res = self.max_timeout_ms
+        self.peers_lock.acquire()
+        peer = self.peers.get(uuid)
+        if peer and peer.timeout_ms is not None:
+            res = peer.timeout_ms
+        self.peers_lock.release()
+        return res
+
+    def success(self, uuid, rtt_sec):
+        self.peers_lock.acquire()
+        peer = self.getPeer(uuid)
+        if peer.state != LTS_BREAKER_CLOSED:
+            logging.info("[BRK] "+self.uuid+" Agent " + uuid + " answering again, closing breaker")
+        peer.state = LTS_BREAKER_CLOSED
+        peer.failures = 0
+        peer.open_sec = self.open_sec
+        peer.rtt.append(rtt_sec)
+        if len(peer.rtt) >= self.rtt_min_samples:
+            rtt = sorted(peer.rtt)
+            percentile = rtt[min(len(rtt) - 1, int(len(rtt) * self.rtt_percentile))]
+            peer.timeout_ms = int(min(self.max_timeout_ms, max(self.min_timeout_ms, percentile * self.rtt_factor * 1000)))
+        self.peers_lock.release()
+
+    def failure(self, uuid):
+        self.peers_lock.acquire()
+        peer = self.getPeer(uuid)
+        peer.failures = peer.failures + 1
+        opened = peer.state == LTS_BREAKER_HALF_OPEN or peer.failures >= self.failure_threshold
+        if opened:
+            open_sec = peer.open_sec
+            peer.state = LTS_BREAKER_OPEN
+            peer.open_until = monotonic() + open_sec
+            peer.open_sec = min(peer.open_sec * 2, self.max_open_sec)
+        self.peers_lock.release()
+        if opened:
+            logging.info("[BRK] "+self.uuid+" Agent " + uuid + " not answering, opening breaker for " + str(open_sec) + " seconds")
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    breaker = LTS_CircuitBreaker("alice", open_sec=0.1)
+    for i in range(10):
+        breaker.success("bob", 0.002)
+    print(breaker.getTimeout("bob"), breaker.getTimeout("charles"))
+    breaker.failure("charles")
+    print(breaker.allow("charles"), breaker.available("bob"))
+    while not breaker.available("charles"):
+        pass
+    print(breaker.allow("charles"), breaker.allow("charles"))
+    breaker.failure("charles")
+    print(breaker.toJSON())
+
+    exit(0)
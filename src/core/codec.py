@@ -0,0 +1,191 @@
+import zlib
+import pickle
+
+from abc import ABC, abstractmethod
+
+from src.core.common import *
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# ------------------------------------------------------------------------------
+
+# codecs turn the structured content of core messages (chunks, DHT entries,
+# RPC envelopes) into bytes. Codes are sent on the wire and must be stable,
+# code 0 is reserved for plain utf-8 text content. A codec implements dumps
+# (object to bytes) and loads (bytes-like to object)
+
+LTS_CODEC_TEXT = 0
+
+class LTS_Codec(LTS_BaseClass, ABC):
+
+    def __init__(self, name="unknown", code=LTS_CODEC_TEXT):
+        super().__init__("LTS_Codec")
+        self.name = name
+        self.code = code
+
+    def available(self):
+        return True
+
+    @abstractmethod
+    def dumps(self, obj):
+        pass
+
+    @abstractmethod
+    def loads(self, data):
+        pass
+
+# ------------------------------------------------------------------------------
+
+class LTS_JSONCodec(LTS_Codec):
+
+    def __init__(self):
+        super().__init__("json", 1)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    def loads(self, data):
+        return json.loads(bytes(data))
+
+# ------------------------------------------------------------------------------
+
+class LTS_MsgpackCodec(LTS_Codec):
+
+    def __init__(self):
+        super().__init__("msgpack", 2)
+
+    def available(self):
+        return msgpack is not None
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+# ------------------------------------------------------------------------------
+
+# pickle can run arbitrary code when loading, it is only accepted from peers
+# by agents that explicitly select it and should be kept to trusted overlays
+
+class LTS_PickleCodec(LTS_Codec):
+
+    def __init__(self):
+        super().__init__("pickle", 3)
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=5)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+# ------------------------------------------------------------------------------
+
+# compressors are codecs from bytes to bytes, code 0 means no compression
+
+LTS_COMPRESS_NONE = 0
+
+class LTS_ZlibCodec(LTS_Codec):
+
+    def __init__(self, level=1):
+        super().__init__("zlib", 1)
+        self.level = level
+
+    def dumps(self, data):
+        return zlib.compress(data, self.level)
+
+    def loads(self, data):
+        return zlib.decompress(data)
+
+# ------------------------------------------------------------------------------
+
+class LTS_LZ4Codec(LTS_Codec):
+
+    def __init__(self):
+        super().__init__("lz4", 2)
+
+    def available(self):
+        return lz4 is not None
+
+    def dumps(self, data):
+        return lz4.frame.compress(data)
+
+    def loads(self, data):
+        return lz4.frame.decompress(data)
+
+# ------------------------------------------------------------------------------
+
+class LTS_CodecRegistry(LTS_BaseClass):
+
+    def __init__(self, default="json"):
+        super().__init__("LTS_CodecRegistry")
+        self.default = default
+        # codec name : str -> LTS_Codec
+        self.codecs = dict()
+        # codec code : int -> LTS_Codec
+        self.codes = dict()
+
+    def register(self, codec):
+        self.codecs[codec.name] = codec
+        self.codes[codec.code] = codec
+
+    def get(self, name):
+        codec = self.codecs.get(name)
+        if codec is None or not codec.available():
+            logging.warning("[COD] Codec " + str(name) + " not available, using " + self.default)
+            codec = self.codecs[self.default]
+        return codec
+
+    # None when unknown or not available
+    def getByCode(self, code):
+        codec = self.codes.get(code)
+        if codec is None or not codec.available():
+            return None
+        return codec
+
+    def names(self):
+        return [name for name, codec in self.codecs.items() if codec.available()]
+
+    # codecs accepted from peers by an agent using the given codec
+    def accepted(self, codec):
+        res = [codec]
+        for other in self.codecs.values():
+            if other.available() and other.name != "pickle" and other not in res:
+                res.append(other)
+        return res
+
+
+lts_codecs = LTS_CodecRegistry()
+lts_codecs.register(LTS_JSONCodec())
+lts_codecs.register(LTS_MsgpackCodec())
+lts_codecs.register(LTS_PickleCodec())
+
+lts_compressors = LTS_CodecRegistry(default="zlib")
+lts_compressors.register(LTS_ZlibCodec())
+lts_compressors.register(LTS_LZ4Codec())
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    obj = {"uuid": "x", "agent_uuid": None, "version": 1, "content": [1, 2.5, "three"]}
+    for name in lts_codecs.names():
+        codec = lts_codecs.get(name)
+        data = codec.dumps(obj)
+        print(name, len(data), codec.loads(data) == obj)
+
+    data = json.dumps([obj] * 64).encode()
+    for name in lts_compressors.names():
+        compressor = lts_compressors.get(name)
+        print(name, len(data), len(compressor.dumps(data)), compressor.loads(compressor.dumps(data)) == data)
+
+    exit(0)
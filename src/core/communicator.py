@@ -1,11 +1,20 @@
 import zmq
+import threading
 
+from time import sleep, monotonic
 from datetime import datetime
 
 
 from src.core.common import *
-from src.core.dht import LTS_DHT
+from src.core.dht import LTS_DHT, LTS_KademliaDHT, LTS_PartialViewDHT, lts_dht_distance
 from src.core.message import *
+from src.core.pool import LTS_ConnectionPool
+from src.core.wire import LTS_Wire, LTS_WIRE_VERSION
+from src.core.outbound import LTS_OutboundQueue
+from src.core.inproc import lts_zmq_context, lts_inproc
+from src.core.admission import LTS_Backoff
+from src.core.breaker import LTS_CircuitBreaker
+from src.core.coordinates import LTS_Vivaldi
 
 
 # ------------------------------------------------------------------------------
@@ -15,7 +24,28 @@ class LTS_Communicator(LTS_BaseClass):
     def __init__(self, comm_uuid, name,
                  zmq_bind="tcp://*:5555", zmq_address="tcp://localhost:5555",
                  zmq_seed_uuid=None, zmq_seed_address=None,
-                 zmq_recv_timeout_sec=10):
+                 zmq_recv_timeout_sec=10,
+                 zmq_pool_idle_sec=60,
+                 zmq_server_workers=4,
+                 zmq_broadcast_parallel=True,
+                 zmq_broadcast_deadline_sec=None,
+                 zmq_wire_version=LTS_WIRE_VERSION,
+                 codec="json",
+                 zmq_coalesce_linger_ms=0,
+                 zmq_coalesce_max=64,
+                 zmq_compress_threshold=None,
+                 zmq_compressor=None,
+                 zmq_inproc=True,
+                 zmq_busy_retries=2,
+                 zmq_seeds=None,
+                 zmq_breaker_open_sec=5,
+                 zmq_min_timeout_ms=1000,
+                 dht_bucket_size=None,
+                 dht_active_size=None,
+                 dht_passive_size=30,
+                 dht_snapshot=None,
+                 dht_snapshot_sec=60,
+                 dht_snapshot_max_age_sec=3600):
 
         super().__init__("LTS_Communicator")
         self.uuid = comm_uuid
@@ -26,81 +56,394 @@ class LTS_Communicator(LTS_BaseClass):
         self.zmq_seed_uuid = zmq_seed_uuid
         self.zmq_seed_address = zmq_seed_address
 
-        self.zmq_context = zmq.Context()
-        self.zmq_socket_rep = self.zmq_context.socket(zmq.REP)
-        self.zmq_socket_rep.bind(self.zmq_bind)
+        # agents of the process share one context and reach each other over
+        # inproc endpoints, zmq_inproc=False keeps a private context and tcp
+        self.zmq_inproc = zmq_inproc
+        self.zmq_inproc_address = None
+        if self.zmq_inproc:
+            self.zmq_context = lts_zmq_context()
+        else:
+            self.zmq_context = zmq.Context()
+
+        # zmq_server_workers == 0 serves requests one at a time on a REP
+        # socket, otherwise a ROUTER socket hands requests to a pool of
+        # workers that push their replies back through an inproc socket
+        self.zmq_server_workers = zmq_server_workers
+        self.zmq_socket_rep = None
+        self.zmq_socket_router = None
+        self.zmq_socket_reply = None
+        self.zmq_reply_address = "inproc://lts-reply-" + self.uuid + "-" + str(id(self))
+        # zmq_bind None leaves the serving to an LTS_AgentHost
+        if self.zmq_bind is None:
+            pass
+        elif self.zmq_server_workers > 0:
+            self.zmq_socket_router = self.zmq_context.socket(zmq.ROUTER)
+            self.zmq_socket_router.bind(self.zmq_bind)
+            self.bindInproc(self.zmq_socket_router)
+            self.zmq_socket_reply = self.zmq_context.socket(zmq.PULL)
+            self.zmq_socket_reply.bind(self.zmq_reply_address)
+        else:
+            self.zmq_socket_rep = self.zmq_context.socket(zmq.REP)
+            self.zmq_socket_rep.bind(self.zmq_bind)
+            self.bindInproc(self.zmq_socket_rep)
+
+        # polled along with the server socket, wakeServer() sends an empty
+        # message to interrupt the poll when the agent stops
+        self.zmq_control_address = "inproc://lts-control-" + self.uuid + "-" + str(id(self))
+        self.zmq_socket_control = None
+        if self.zmq_bind is not None:
+            self.zmq_socket_control = self.zmq_context.socket(zmq.PULL)
+            self.zmq_socket_control.bind(self.zmq_control_address)
 
         self.zmq_recv_timeout = zmq_recv_timeout_sec * 1000
 
-        self.dht = LTS_DHT(self.uuid)
+        # a request answered with CORE_BUSY is sent again up to
+        # zmq_busy_retries times, after the delay asked by the peer
+        self.zmq_busy_retries = zmq_busy_retries
+        self.backoff = LTS_Backoff(self.uuid, self.zmq_recv_timeout)
+
+        # peers that stopped answering fail right away for a while instead
+        # of each request waiting for the timeout, the timeout of the others
+        # follows their round trip times
+        self.breaker = LTS_CircuitBreaker(self.uuid, self.zmq_recv_timeout,
+                                          zmq_min_timeout_ms,
+                                          open_sec=zmq_breaker_open_sec)
+
+        # broadcast to all peers at once and wait for the replies until a
+        # single deadline instead of one blocking send per peer
+        self.zmq_broadcast_parallel = zmq_broadcast_parallel
+        self.zmq_broadcast_deadline = self.zmq_recv_timeout
+        if zmq_broadcast_deadline_sec is not None:
+            self.zmq_broadcast_deadline = zmq_broadcast_deadline_sec * 1000
+
+        # payloads larger than zmq_compress_threshold bytes are compressed
+        # for peers that accept it, disabled when the threshold is None
+        self.wire = LTS_Wire(self.uuid, zmq_wire_version, codec,
+                             zmq_compress_threshold, zmq_compressor)
+
+        # requests to agents of the same LTS_AgentHost are served by a
+        # direct call instead of a socket
+        self.host = None
+
+        # gossip membership of the agent (LTS_Membership), its pings are the
+        # subscribe messages
+        self.membership = None
+        # partial view of the agent (LTS_PartialView), subscribing is joining
+        self.view = None
+        # multi-hop broadcast of the agent (LTS_GossipBroadcast)
+        self.gossip = None
+
+        self.pool = LTS_ConnectionPool(self.uuid, self.zmq_context,
+                                       idle_timeout_sec=zmq_pool_idle_sec)
+
+        # coalescing of posted messages, disabled when the linger is 0
+        self.outbound = None
+        if zmq_coalesce_linger_ms > 0:
+            self.outbound = LTS_OutboundQueue(self.uuid, self,
+                                              linger_ms=zmq_coalesce_linger_ms,
+                                              max_batch=zmq_coalesce_max)
+
+        # dht_bucket_size None keeps every known peer, otherwise a Kademlia
+        # routing table keeps up to dht_bucket_size peers per distance range.
+        # dht_active_size only keeps a partial view of the overlay
+        if dht_bucket_size:
+            self.dht = LTS_KademliaDHT(self.uuid, dht_bucket_size)
+        elif dht_active_size:
+            self.dht = LTS_PartialViewDHT(self.uuid, dht_active_size, dht_passive_size)
+        else:
+            self.dht = LTS_DHT(self.uuid)
+        self.dht.addRemoveListener(self.pool.evict)
         self.dht.add(self.uuid, self.zmq_address)
+
+        # network coordinate of the agent, sent along every message and moved
+        # by the round trips, so that the latency of the peers can be
+        # estimated before any message is sent to them
+        self.vivaldi = LTS_Vivaldi(self.uuid)
+        self.wire.vivaldi = self.vivaldi
+        self.dht.vivaldi = self.vivaldi
+
+        # (uuid, address) of the peers subscribed to by bootstrap()
+        self.zmq_seeds = [seed for seed in (zmq_seeds or list()) if seed[0] != self.uuid]
         if self.zmq_seed_uuid == self.uuid or self.zmq_seed_uuid is None:
             self.zmq_seed_uuid = self.uuid
             self.zmq_seed_address = self.zmq_address
         else:
-            self.dht.add(self.zmq_seed_uuid, zmq_seed_address)
-            self.subscribe(self.zmq_seed_uuid)
+            self.zmq_seeds.insert(0, (self.zmq_seed_uuid, self.zmq_seed_address))
+        for seed_uuid, seed_address in self.zmq_seeds:
+            self.dht.add(seed_uuid, seed_address)
+
+        # the DHT is saved to the dht_snapshot file every dht_snapshot_sec
+        # and when the agent stops. A restarted agent reloads the peers seen
+        # less than dht_snapshot_max_age_sec ago and checks them all at once
+        # when it bootstraps
+        self.dht_snapshot = dht_snapshot
+        self.dht_snapshot_sec = dht_snapshot_sec
+        self.dht_snapshot_next = monotonic() + dht_snapshot_sec
+        self.dht_snapshot_lock = threading.Lock()
+        self.restored = list()
+        if self.dht_snapshot:
+            self.restored = self.dht.load(self.dht_snapshot, dht_snapshot_max_age_sec)
 
 
 
     def toJSON(self):
-        res = '{"class_name": "LTS_Communicator", "uuid": "'+self.uuid+'", "zmq_bind": "'+self.zmq_bind+'", "zmq_address": "'+self.zmq_address+'", "zmq_seed_uuid": "'+self.zmq_seed_uuid+'", "zmq_seed_address": "'+self.zmq_seed_address+'", "dht": '+self.dht.toJSON()+'}'
+        res = '{"class_name": "LTS_Communicator", "uuid": "'+self.uuid+'", "zmq_bind": "'+str(self.zmq_bind)+'", "zmq_address": "'+self.zmq_address+'", "zmq_seed_uuid": "'+self.zmq_seed_uuid+'", "zmq_seed_address": "'+self.zmq_seed_address+'", "dht": '+self.dht.toJSON()+'}'
         return json.dumps(json.loads(res), sort_keys=True, indent=4)
 
 
-    
-    def processMessage(self, message_str):
-        message = LTS_Message(LTS_MessageType.CORE_NONE)
-        message.fromJSON(message_str)
+
+    # also bind the server socket to an inproc endpoint, unless the agent
+    # is only reachable in process already
+    def bindInproc(self, socket):
+        if self.zmq_inproc and not self.zmq_bind.startswith("inproc://"):
+            self.zmq_inproc_address = "inproc://lts-" + self.uuid + "-" + str(id(self))
+            socket.bind(self.zmq_inproc_address)
+            lts_inproc.register(self.zmq_address, self.zmq_inproc_address)
+
+    # inproc endpoint of the peer when it runs in this process, to_address
+    # is given for peers that may not be in the DHT
+    def getPeerAddress(self, to_uuid, to_address=None):
+        to_address = to_address or self.dht.getAddress(to_uuid)
+        if to_address and self.zmq_inproc:
+            to_address = lts_inproc.resolve(to_address)
+        return to_address
+
+    # can be called from any thread
+    def wakeServer(self):
+        if self.zmq_socket_control is None:
+            return
+        socket = self.zmq_context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.LINGER, 1000)
+        socket.connect(self.zmq_control_address)
+        try:
+            socket.send(b'', zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+        socket.close()
+
+    def drainControl(self):
+        while True:
+            try:
+                self.zmq_socket_control.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+    def closeServer(self):
+        if self.zmq_inproc_address:
+            lts_inproc.unregister(self.zmq_address, self.zmq_inproc_address)
+        for socket in [self.zmq_socket_rep, self.zmq_socket_router, self.zmq_socket_reply, self.zmq_socket_control]:
+            if socket:
+                socket.close()
+
+    def processMessage(self, frames):
+        message = self.wire.decode(frames)
+        self.dht.setSeen(message.from_uuid, message.coordinate)
         return message
 
+    def getCompressionStats(self):
+        return self.wire.getCompressionStats()
+
 
     
-    def sendMessage(self, to_uuid, message):
+    def sendMessage(self, to_uuid, message, busy_retries=None):
+        if busy_retries is None:
+            busy_retries = self.zmq_busy_retries
+        while True:
+            delay = self.backoff.getDelay(to_uuid)
+            if delay > 0 and busy_retries > 0:
+                sleep(delay)
+            response = self.requestMessage(to_uuid, message)
+            if response.message_type != LTS_MessageType.CORE_BUSY or busy_retries <= 0:
+                break
+            busy_retries = busy_retries - 1
+        return response
+
+    def requestMessage(self, to_uuid, message):
         response = LTS_Message(LTS_MessageType.CORE_NONE)
-        socket = self.zmq_context.socket(zmq.REQ)
-        to_address = self.dht.getAddress(to_uuid)
-        if to_address:
-            socket.connect(to_address)
+        to_address = self.getPeerAddress(to_uuid)
+        if to_address and not self.breaker.allow(to_uuid):
+            logging.info("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " failed, breaker open")
+        elif to_address and self.host and self.host.hosts(to_uuid):
+            response = self.host.request(self, to_uuid, message)
+        elif to_address:
+            entry = self.pool.acquire(to_uuid, to_address)
+            socket = entry.socket
             start = datetime.now()
-            socket.send_string(message.toJSON())
-            socket.RCVTIMEO = self.zmq_recv_timeout
+            # a send blocks when the inproc endpoint of the peer is gone
+            timeout = self.breaker.getTimeout(to_uuid)
+            socket.SNDTIMEO = timeout
+            socket.RCVTIMEO = timeout
             data_recv = None
             try:
-                data_recv = socket.recv_string()
+                socket.send_multipart(self.wire.encodeRequest(to_uuid, message), copy=False)
+                data_recv = socket.recv_multipart(copy=False)
             except zmq.ZMQError as e:
                 if e.errno == zmq.EAGAIN:
                     logging.info("[COM] "+self.uuid+" Agent recv timeout")
                     self.dht.remove(to_uuid)
             if data_recv:
-                end = datetime.now()
-                latency = end - start
-                self.dht.setLatency(to_uuid, latency.microseconds)
-                response.fromJSON(data_recv)
-                logging.info("[COM] "+self.uuid+" Agent latency " + str(int(latency.microseconds / 1000)) + " milliseconds with " + to_uuid)
+                self.pool.release(to_uuid, entry)
+                response = self.processResponse(to_uuid, start, data_recv)
+            else:
+                self.pool.discard(to_uuid, entry)
+                self.breaker.failure(to_uuid)
 
         else:
             logging.warning("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " not in DHT")
 
-        socket.close()
-            
         return response
 
 
+    def processResponse(self, to_uuid, start, data_recv):
+        end = datetime.now()
+        latency = end - start
+        self.breaker.success(to_uuid, latency.total_seconds())
+        self.dht.setLatency(to_uuid, latency.total_seconds() * 1000000)
+        logging.info("[COM] "+self.uuid+" Agent latency " + str(int(latency.total_seconds() * 1000)) + " milliseconds with " + to_uuid)
+        response = self.processMessage(data_recv)
+        if response.coordinate:
+            self.vivaldi.update(response.coordinate, self.dht.getLatency(to_uuid) or latency.total_seconds() * 1000000)
+        self.backoff.processResponse(to_uuid, response)
+        return response
+
+
+    # send a message to several peers at once and gather the responses
+    # until a global deadline, returns the responses per peer uuid and the
+    # list of peers that did not answer in time or are not in the DHT
+    def scatterMessage(self, message, uuid_list=None, deadline_ms=None):
+        if uuid_list is None:
+            uuid_list = self.dht.getUuidList()
+        return self.scatterMessages({to_uuid: message for to_uuid in uuid_list}, deadline_ms)
+
+    # same as scatterMessage with a different message per peer uuid, the
+    # address of the peers not in the DHT are given in addresses. With
+    # penalize False the peers that do not answer are neither removed from
+    # the DHT nor counted by the breaker, and open breakers are ignored: the
+    # membership probes decide by themselves whether a peer failed
+    def scatterMessages(self, messages, deadline_ms=None, addresses=None, penalize=True):
+        results = dict()
+        failures = list()
+        if deadline_ms is None:
+            deadline_ms = self.zmq_broadcast_deadline
+
+        pending = dict()
+        poller = zmq.Poller()
+        start = datetime.now()
+        timeout_ms = 0
+        for to_uuid, message in messages.items():
+            to_address = self.getPeerAddress(to_uuid, (addresses or dict()).get(to_uuid))
+            if to_address and penalize and not self.breaker.allow(to_uuid):
+                failures.append(to_uuid)
+            elif to_address and self.host and self.host.hosts(to_uuid):
+                message.to_uuid = to_uuid
+                results[to_uuid] = self.host.request(self, to_uuid, message)
+            elif to_address:
+                entry = self.pool.acquire(to_uuid, to_address)
+                message.to_uuid = to_uuid
+                try:
+                    entry.socket.send_multipart(self.wire.encodeRequest(to_uuid, message), zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    logging.info("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " not possible")
+                    self.pool.discard(to_uuid, entry)
+                    if penalize:
+                        self.breaker.failure(to_uuid)
+                        self.dht.remove(to_uuid)
+                    failures.append(to_uuid)
+                    continue
+                pending[entry.socket] = (to_uuid, entry)
+                poller.register(entry.socket, zmq.POLLIN)
+                timeout_ms = max(timeout_ms, self.breaker.getTimeout(to_uuid))
+            else:
+                logging.warning("[COM] "+self.uuid+" Agent send to agent " + str(to_uuid) + " not in DHT")
+                failures.append(to_uuid)
+
+        # no need to wait longer than the timeout of the slowest peer
+        deadline_ms = min(deadline_ms, timeout_ms)
+        while pending:
+            remaining_ms = deadline_ms - (datetime.now() - start).total_seconds() * 1000
+            if remaining_ms <= 0:
+                break
+            for socket, _ in poller.poll(remaining_ms):
+                to_uuid, entry = pending.pop(socket)
+                poller.unregister(socket)
+                data_recv = socket.recv_multipart(copy=False)
+                self.pool.release(to_uuid, entry)
+                results[to_uuid] = self.processResponse(to_uuid, start, data_recv)
+
+        for to_uuid, entry in pending.values():
+            logging.info("[COM] "+self.uuid+" Agent recv timeout")
+            self.pool.discard(to_uuid, entry)
+            if penalize:
+                self.breaker.failure(to_uuid)
+                self.dht.remove(to_uuid)
+            failures.append(to_uuid)
+
+        return results, failures
+
+
     def send(self, to_uuid, content):
         message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content,
                               from_uuid=self.uuid, to_uuid=to_uuid)
         return self.sendMessage(to_uuid, message)
     
     def broadcastMessage(self, message):
+        if self.zmq_broadcast_parallel:
+            return self.scatterMessage(message)
+        results = dict()
+        failures = list()
         uuid_list = self.dht.getUuidList()
         for to_uuid in uuid_list:
             message.to_uuid = to_uuid
-            self.sendMessage(message.to_uuid, message)
+            response = self.sendMessage(message.to_uuid, message)
+            if response.message_type == LTS_MessageType.CORE_NONE:
+                failures.append(to_uuid)
+            else:
+                results[to_uuid] = response
+        return results, failures
 
     def broadcast(self, content):
         message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content, from_uuid=self.uuid)
-        self.broadcastMessage(message)
+        return self.broadcastMessage(message)
+
+    # reach every agent of the overlay through the gossip tree when the agent
+    # has one, otherwise only the peers of the DHT
+    def gossipBroadcastMessage(self, message):
+        if self.gossip:
+            self.gossip.broadcastMessage(message)
+        else:
+            self.broadcastMessage(message)
+
+    def gossipBroadcast(self, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content, from_uuid=self.uuid)
+        self.gossipBroadcastMessage(message)
+
+
+    # send a message whose response is not needed, through the outbound
+    # queue when coalescing is enabled
+    def postMessage(self, to_uuid, message):
+        if self.outbound:
+            self.outbound.post(to_uuid, message)
+        else:
+            self.sendMessage(to_uuid, message)
+
+    def postBroadcastMessage(self, message):
+        if self.outbound:
+            for to_uuid in self.dht.getUuidList():
+                peer_message = LTS_Message(message.message_type, content=message.content,
+                                           from_uuid=message.from_uuid, to_uuid=to_uuid)
+                peer_message.buffers = message.buffers
+                self.outbound.post(to_uuid, peer_message)
+        else:
+            self.broadcastMessage(message)
+
+    def post(self, to_uuid, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content,
+                              from_uuid=self.uuid, to_uuid=to_uuid)
+        self.postMessage(to_uuid, message)
+
+    def postBroadcast(self, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content, from_uuid=self.uuid)
+        self.postBroadcastMessage(message)
 
     # ask a peer for another peer
     def populate(self):
@@ -111,18 +454,137 @@ class LTS_Communicator(LTS_BaseClass):
                                   from_uuid=self.uuid, to_uuid = best_uuid)
             response = self.sendMessage(message.to_uuid, message)
             if response.message_type == LTS_MessageType.CORE_RESPONSE:
-                response_json = json.loads(json.loads(response.toJSON())['content'])
+                response_json = response.getContentObject()
                 if response_json and 'uuid' in response_json:
                     self.dht.add(response_json['uuid'], response_json['address'])
-                    res = response_json['uuid']
+                    self.dht.setCoordinate(response_json['uuid'], response_json.get('coordinate'))
+                    # a full Kademlia bucket may not keep it
+                    if self.dht.getAddress(response_json['uuid']):
+                        res = response_json['uuid']
         return res
 
 
     
     # send self uuid and address to an other peer to be added to its DHT
-    def subscribe(self, to_uuid):
-        message = LTS_Message(LTS_MessageType.DHT_SUBSCRIBE, '{"uuid": "' + self.uuid + '", "address": "' + self.zmq_address + '"}', from_uuid=self.uuid, to_uuid=to_uuid)
-        response = self.sendMessage(message.to_uuid, message)
+    def subscribe(self, to_uuid, post=False):
+        message = self.subscribeMessage(to_uuid)
+        if post:
+            self.postMessage(message.to_uuid, message)
+        else:
+            self.sendMessage(message.to_uuid, message)
+
+    def subscribeMessage(self, to_uuid):
+        if self.membership:
+            return self.membership.pingMessage(to_uuid)
+        if self.view:
+            return self.view.subscribeMessage(to_uuid)
+        return LTS_Message(LTS_MessageType.DHT_SUBSCRIBE, {"uuid": self.uuid, "address": self.zmq_address}, from_uuid=self.uuid, to_uuid=to_uuid)
+
+    # subscribe to all the seeds at once, the ones that do not answer before
+    # the broadcast deadline are removed from the DHT. With gossip membership
+    # the seeds answer with the members they know, with a partial view the
+    # join is forwarded from them on random walks. A Kademlia agent then
+    # looks itself up to fill its buckets and be known by its neighbours
+    def bootstrap(self, deadline_ms=None):
+        self.revalidate(deadline_ms)
+        if not self.zmq_seeds:
+            return list()
+        messages = {seed_uuid: self.subscribeMessage(seed_uuid) for seed_uuid, _ in self.zmq_seeds}
+        results, failures = self.scatterMessages(messages, deadline_ms)
+        if failures:
+            logging.warning("[COM] "+self.uuid+" Agent seeds not reachable " + str(failures))
+        for seed_uuid, response in results.items():
+            if self.membership:
+                self.membership.processAck(seed_uuid, response)
+            if self.view:
+                self.view.join(seed_uuid, dict(self.zmq_seeds)[seed_uuid], response)
+        if isinstance(self.dht, LTS_KademliaDHT):
+            self.searchPeer(self.uuid)
+        return list(results.keys())
+
+
+    # contact all the peers restored from the snapshot at once, the ones that
+    # do not answer within the minimum timeout are removed from the DHT. With
+    # gossip membership they are only asked for a peer, and become members
+    # once they answered, otherwise they are subscribed to
+    def revalidate(self, deadline_ms=None):
+        if deadline_ms is None:
+            deadline_ms = self.breaker.min_timeout_ms
+        seeds = [seed_uuid for seed_uuid, _ in self.zmq_seeds]
+        messages = dict()
+        for uuid in self.restored:
+            if uuid not in seeds and self.dht.getAddress(uuid):
+                if self.membership:
+                    messages[uuid] = LTS_Message(LTS_MessageType.DHT_GET_PEER, from_uuid=self.uuid, to_uuid=uuid)
+                else:
+                    messages[uuid] = self.subscribeMessage(uuid)
+        self.restored = list()
+        if not messages:
+            return list()
+        results, failures = self.scatterMessages(messages, deadline_ms)
+        if self.membership:
+            for uuid in results.keys():
+                self.membership.applyContact(uuid, self.dht.getAddress(uuid), None)
+        logging.info("[COM] "+self.uuid+" Agent revalidated " + str(len(results)) + " of " + str(len(messages)) + " peers from snapshot")
+        return list(results.keys())
+
+    # saved every dht_snapshot_sec unless forced, by the heartbeat and when
+    # the agent stops
+    def saveSnapshot(self, force=False):
+        if not self.dht_snapshot:
+            return
+        self.dht_snapshot_lock.acquire()
+        due = force or monotonic() >= self.dht_snapshot_next
+        if due:
+            self.dht_snapshot_next = monotonic() + self.dht_snapshot_sec
+        self.dht_snapshot_lock.release()
+        if not due:
+            return
+        count = self.dht.save(self.dht_snapshot)
+        logging.info("[COM] "+self.uuid+" Agent saved " + str(count) + " peers to " + self.dht_snapshot)
+
+
+    def searchMessage(self, to_uuid, uuid, count):
+        return LTS_Message(LTS_MessageType.DHT_SEARCH_PEER, {"uuid": uuid, "count": count, "address": self.zmq_address}, from_uuid=self.uuid, to_uuid=to_uuid)
+
+    # iterative lookup of a peer: the alpha closest peers to uuid not asked
+    # yet are asked in parallel for the peers they know closest to uuid,
+    # until uuid is found or the count closest peers have all been asked.
+    # Returns the address of the peer, None if not found
+    def searchPeer(self, uuid, alpha=3, count=None):
+        count = count or getattr(self.dht, 'bucket_size', 20)
+        if uuid != self.uuid and self.dht.getAddress(uuid):
+            return self.dht.getAddress(uuid)
+        # peer uuid : str -> address : str
+        shortlist = {peer_uuid: address for peer_uuid, address in self.dht.closest(uuid, count) if peer_uuid != self.uuid}
+        asked = set()
+        hops = 0
+        while uuid not in shortlist:
+            closest = sorted(shortlist.keys(), key=lambda peer_uuid: lts_dht_distance(peer_uuid, uuid))[:count]
+            candidates = [peer_uuid for peer_uuid in closest if peer_uuid not in asked][:alpha]
+            if not candidates:
+                break
+            hops = hops + 1
+            asked.update(candidates)
+            messages = {peer_uuid: self.searchMessage(peer_uuid, uuid, count) for peer_uuid in candidates}
+            results, failures = self.scatterMessages(messages, addresses=shortlist)
+            for peer_uuid in failures:
+                shortlist.pop(peer_uuid, None)
+            for peer_uuid, response in results.items():
+                if response.message_type != LTS_MessageType.CORE_RESPONSE:
+                    continue
+                self.dht.add(peer_uuid, shortlist[peer_uuid])
+                for peer in response.getContentObject()['peers']:
+                    if peer['uuid'] != self.uuid:
+                        shortlist.setdefault(peer['uuid'], peer['address'])
+        res = shortlist.get(uuid)
+        if uuid == self.uuid:
+            logging.info("[COM] "+self.uuid+" Agent joined in " + str(hops) + " hops")
+        else:
+            logging.info("[COM] "+self.uuid+" Agent search " + uuid + " " + ("found" if res else "not found") + " in " + str(hops) + " hops")
+        if res:
+            self.dht.add(uuid, res)
+        return res
 
 
     
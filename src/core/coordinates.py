@@ -0,0 +1,135 @@
+import math
+import random
+import threading
+
+from src.core.common import *
+
+# ------------------------------------------------------------------------------
+
+# Vivaldi network coordinates: each agent is a point of a euclidean space
+# plus a height (the latency of its access link), so that the latency between
+# two agents is estimated as the distance between their coordinates without
+# any message between them. Every round trip to a peer moves our coordinate
+# toward or away from the coordinate of the peer, by a step weighted by the
+# confidence of both coordinates. Coordinates and latencies are in
+# microseconds, like the latencies of the DHT.
+#
+# Coordinates travel as a list of floats: the vector, then the height, then
+# the error of the coordinate (1 for a new agent, close to 0 once stable).
+
+class LTS_Coordinate(LTS_BaseClass):
+
+    def __init__(self, dimensions=4, height_us=0, error=1.0):
+        super().__init__("LTS_Coordinate")
+        self.vector = [0.0] * dimensions
+        self.height_us = height_us
+        self.error = error
+
+    def toList(self):
+        return self.vector + [self.height_us, self.error]
+
+    def fromList(self, values):
+        self.vector = list(values[:-2])
+        self.height_us = values[-2]
+        self.error = values[-1]
+        return self
+
+    # estimated round trip time to the other coordinate
+    def distance(self, other):
+        return math.dist(self.vector, other.vector) + self.height_us + other.height_us
+
+# ------------------------------------------------------------------------------
+
+class LTS_Vivaldi(LTS_BaseClass):
+
+    def __init__(self, vivaldi_uuid, dimensions=4, ce=0.25, cc=0.25,
+                 min_height_us=10, min_error=0.01):
+        super().__init__("LTS_Vivaldi")
+        self.uuid = vivaldi_uuid
+        self.dimensions = dimensions
+        # weights of the error and of the coordinate updates
+        self.ce = ce
+        self.cc = cc
+        self.min_height_us = min_height_us
+        self.min_error = min_error
+        self.coordinate = LTS_Coordinate(dimensions, min_height_us)
+        self.coordinate_lock = threading.Lock()
+        self.nb_updates = 0
+
+
+    def toJSON(self):
+        self.coordinate_lock.acquire()
+        res = json.dumps({"class_name": "LTS_Vivaldi", "uuid": self.uuid,
+                          "coordinate": self.coordinate.toList(), "updates": self.nb_updates})
+        self.coordinate_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def getList(self):
+        self.coordinate_lock.acquire()
+        res = self.coordinate.toList()
+        self.coordinate_lock.release()
+        return res
+
+    # coordinate received from a peer, None if it does not have our
+    # number of dimensions
+    def remote(self, values):
+        if values is None or len(values) != self.dimensions + 2:
+            return None
+        return LTS_Coordinate(self.dimensions).fromList(values)
+
+    # estimated round trip time to a peer from its coordinate, None if unknown
+    def estimate(self, values):
+        remote = self.remote(values)
+        if remote is None:
+            return None
+        self.coordinate_lock.acquire()
+        res = self.coordinate.distance(remote)
+        self.coordinate_lock.release()
+        return res
+
+    # move our coordinate after a round trip of rtt_us to a peer
+    def update(self, values, rtt_us):
+        remote = self.remote(values)
+        if remote is None or rtt_us <= 0:
+            return
+        self.coordinate_lock.acquire()
+        local = self.coordinate
+        weight = local.error / max(local.error + remote.error, self.min_error)
+        distance = local.distance(remote)
+        sample_error = abs(distance - rtt_us) / rtt_us
+        local.error = min(1.0, max(self.min_error, sample_error * self.ce * weight + local.error * (1 - self.ce * weight)))
+        force = self.cc * weight * (rtt_us - distance)
+        direction = [a - b for a, b in zip(local.vector, remote.vector)]
+        length = math.hypot(*direction)
+        if length == 0:
+            direction = [random.uniform(-1, 1) for _ in direction]
+            length = math.hypot(*direction)
+        local.vector = [x + force * d / length for x, d in zip(local.vector, direction)]
+        if distance > 0:
+            local.height_us = max(self.min_height_us, local.height_us + force * (local.height_us + remote.height_us) / distance)
+        self.nb_updates = self.nb_updates + 1
+        self.coordinate_lock.release()
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    # agents placed on a plane, the round trip time is the distance between
+    # them plus 200 microseconds of access link on each side
+    positions = [(random.uniform(0, 20000), random.uniform(0, 20000)) for i in range(50)]
+    rtt = lambda i, j: math.dist(positions[i], positions[j]) + 400
+    agents = [LTS_Vivaldi(str(i)) for i in range(len(positions))]
+    for step in range(5000):
+        i, j = random.sample(range(len(agents)), 2)
+        agents[i].update(agents[j].getList(), rtt(i, j))
+    errors = list()
+    for i in range(len(agents)):
+        for j in range(i + 1, len(agents)):
+            errors.append(abs(agents[i].estimate(agents[j].getList()) - rtt(i, j)) / rtt(i, j))
+    errors.sort()
+    print("median relative error", round(errors[len(errors) // 2], 3), "p90", round(errors[int(len(errors) * 0.9)], 3))
+    print(agents[0].toJSON())
+
+    exit(0)
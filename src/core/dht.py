@@ -1,13 +1,86 @@
 
+import os
+import tempfile
+import copy
+import bisect
+import random
+import hashlib
 import threading
 
+from time import time, monotonic
 from datetime import datetime
+from collections import deque
 
 from src.core.common import *
 from src.core.message import *
+from src.core.codec import lts_codecs
 
 # ------------------------------------------------------------------------------
 
+# position of a peer in the 160 bits identifier space, uuids are hashed since
+# agents may be given any string as uuid
+
+LTS_DHT_ID_BITS = 160
+
+def lts_dht_id(uuid):
+    return int.from_bytes(hashlib.sha1(uuid.encode()).digest(), "big")
+
+def lts_dht_distance(uuid_a, uuid_b):
+    return lts_dht_id(uuid_a) ^ lts_dht_id(uuid_b)
+
+# ------------------------------------------------------------------------------
+
+# round trip times are smoothed as in TCP (RFC 6298): latency_us is the
+# moving average of the samples, latency_var_us their mean deviation. The
+# last LTS_DHT_LATENCY_SAMPLES samples are kept for percentiles
+
+LTS_DHT_LATENCY_ALPHA = 0.125
+LTS_DHT_LATENCY_BETA = 0.25
+LTS_DHT_LATENCY_SAMPLES = 32
+
+# the latency samples, coordinates and last seen times of the peers are
+# published at most every LTS_DHT_PUBLISH_SEC seconds, peers added or removed
+# right away
+
+LTS_DHT_PUBLISH_SEC = 0.1
+
+# the latencies estimated from the coordinates are only computed for
+# LTS_DHT_ESTIMATE_SAMPLE random peers (and as many of the index head for the
+# closest peer), so that looking for a peer does not scan the whole DHT
+
+LTS_DHT_ESTIMATE_SAMPLE = 16
+
+# keys of a peer in a snapshot of the DHT and the type of their value, the
+# coordinate is optional. float stands for any number, list for a list of
+# numbers
+
+LTS_DHT_SNAPSHOT_KEYS = {"uuid": str, "address": str, "latency_us": float,
+                         "latency_var_us": float, "samples": int,
+                         "samples_us": list, "seen": float}
+
+def lts_dht_is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def lts_dht_is_snapshot_value(value, kind):
+    if kind is float:
+        return lts_dht_is_number(value)
+    if kind is list:
+        return isinstance(value, list) and all(lts_dht_is_number(item) for item in value)
+    return isinstance(value, kind) and not isinstance(value, bool)
+
+# raises a TypeError or a KeyError when a peer of a snapshot is malformed
+def lts_dht_check_snapshot(peer):
+    if not isinstance(peer, dict):
+        raise TypeError("peer " + repr(peer) + " is not a dict")
+    for key, kind in LTS_DHT_SNAPSHOT_KEYS.items():
+        if key not in peer:
+            raise KeyError("peer " + repr(peer.get('uuid')) + " without " + key)
+        if not lts_dht_is_snapshot_value(peer[key], kind):
+            raise TypeError("peer " + repr(peer.get('uuid')) + " with " + key + " " + repr(peer[key]))
+    coordinate = peer.get('coordinate')
+    if coordinate is not None and not lts_dht_is_snapshot_value(coordinate, list):
+        raise TypeError("peer " + repr(peer['uuid']) + " with coordinate " + repr(coordinate))
+
 class LTS_DHTEntry(LTS_BaseClass):
 
     def __init__(self, uuid, zmq_address, latency_us=0):
@@ -15,10 +88,100 @@ class LTS_DHTEntry(LTS_BaseClass):
         self.uuid = uuid
         self.zmq_address = zmq_address
         self.latency_us = latency_us
+        self.latency_var_us = latency_us / 2
+        self.nb_samples = 1 if latency_us else 0
+        self.samples = deque(maxlen=LTS_DHT_LATENCY_SAMPLES)
+        # last network coordinate received from or about the peer
+        self.coordinate = None
         self.timestamp_create = datetime.now()
+        # wall clock time (seconds) the peer was added or last sent us a
+        # message
+        self.timestamp_seen = time()
+
+    def toDict(self):
+        return {"uuid": self.uuid, "zmq_address": self.zmq_address,
+                "latency_us": self.latency_us,
+                "latency_var_us": self.latency_var_us,
+                "samples": self.nb_samples,
+                "coordinate": self.coordinate,
+                "timestamp_create": str(self.timestamp_create),
+                "timestamp_seen": self.timestamp_seen}
+
+    def fromDict(self, obj):
+        self.uuid = obj['uuid']
+        self.zmq_address = obj['zmq_address']
+        self.latency_us = obj['latency_us']
+        self.latency_var_us = obj.get('latency_var_us', self.latency_us / 2)
+        self.nb_samples = obj.get('samples', 1 if self.latency_us else 0)
+        self.coordinate = obj.get('coordinate')
+        self.timestamp_create = datetime.fromisoformat(obj['timestamp_create'])
+        self.timestamp_seen = obj.get('timestamp_seen', self.timestamp_seen)
+
+    # compact form kept in the snapshots of the DHT, with the latency samples
+    # (see LTS_DHT_SNAPSHOT_KEYS)
+    def toSnapshot(self):
+        return {"uuid": self.uuid, "address": self.zmq_address,
+                "latency_us": self.latency_us, "latency_var_us": self.latency_var_us,
+                "samples": self.nb_samples, "samples_us": list(self.samples),
+                "coordinate": self.coordinate, "seen": self.timestamp_seen}
+
+    def fromSnapshot(self, obj):
+        self.latency_us = obj['latency_us']
+        self.latency_var_us = obj['latency_var_us']
+        self.nb_samples = obj['samples']
+        self.samples.extend(obj['samples_us'])
+        self.coordinate = obj.get('coordinate')
+        self.timestamp_seen = obj['seen']
+
+    # writable copy of an entry that has been published
+    def copy(self):
+        res = copy.copy(self)
+        res.samples = deque(self.samples, maxlen=LTS_DHT_LATENCY_SAMPLES)
+        return res
+
+    def addSample(self, latency_us):
+        if self.nb_samples == 0:
+            self.latency_us = latency_us
+            self.latency_var_us = latency_us / 2
+        else:
+            self.latency_var_us = (1 - LTS_DHT_LATENCY_BETA) * self.latency_var_us + LTS_DHT_LATENCY_BETA * abs(self.latency_us - latency_us)
+            self.latency_us = (1 - LTS_DHT_LATENCY_ALPHA) * self.latency_us + LTS_DHT_LATENCY_ALPHA * latency_us
+        self.nb_samples = self.nb_samples + 1
+        self.samples.append(latency_us)
+
+    def getPercentile(self, percentile):
+        if not self.samples:
+            return self.latency_us
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
 
 # ------------------------------------------------------------------------------
 
+# immutable version of the DHT published by the writers. Neither the dict,
+# the entries nor the tuples of a version are modified once published, the
+# readers take the current version without any lock
+
+class LTS_DHTVersion(LTS_BaseClass):
+
+    def __init__(self, number, entries, latency_index, dht_uuid):
+        super().__init__("LTS_DHTVersion")
+        self.number = number
+        self.timestamp = monotonic()
+        # peer uuid : str -> LTS_DHTEntry
+        self.entries = entries
+        self.latency_index = tuple(latency_index)
+        # peer uuids but our own, as returned by getUuidList
+        self.uuids = tuple(key for key in entries if key != dht_uuid)
+
+# ------------------------------------------------------------------------------
+
+# The peers are written under dht_lock in self.dht and published as an
+# LTS_DHTVersion. An entry of a published version is copied before its first
+# modification, the entries created or copied since the last version are
+# modified in place. Added and removed peers are published at once (at the end
+# of the batch within beginBatch/endBatch), the other updates every
+# LTS_DHT_PUBLISH_SEC: the latencies read may be late by that much.
+
 class LTS_DHT(LTS_BaseClass):
 
     def __init__(self, dht_uuid):
@@ -26,97 +189,565 @@ class LTS_DHT(LTS_BaseClass):
         self.uuid = dht_uuid
         self.dht = dict()
         self.dht_lock = threading.Lock()
+        # peers with a known latency ordered by latency :
+        # list((latency_us : float, uuid : str))
+        self.latency_index = list()
+        # uuids of the entries not published yet, modified in place
+        self.fresh = set()
+        self.nb_pending = 0
+        self.batch = 0
+        self.published = LTS_DHTVersion(0, dict(), list(), dht_uuid)
+        # handlers called with the peer uuid once it has been removed
+        self.remove_listeners = list()
+        # LTS_Vivaldi of the agent, estimates the latency of the peers that
+        # were never measured from their coordinate
+        self.vivaldi = None
+
+    def addRemoveListener(self, handler):
+        self.remove_listeners.append(handler)
+
+    # the current version, published first when updates are waiting for
+    # longer than LTS_DHT_PUBLISH_SEC. Never to be called with the DHT lock held
+    def getPublished(self):
+        published = self.published
+        if self.nb_pending and monotonic() - published.timestamp >= LTS_DHT_PUBLISH_SEC:
+            self.dht_lock.acquire()
+            self.publish(True)
+            self.dht_lock.release()
+            published = self.published
+        return published
+
+    # to be called with the DHT lock held, after each update. A peer added or
+    # removed is published at once, outside of a batch
+    def publish(self, now=False):
+        self.nb_pending = self.nb_pending + 1
+        if self.batch or not (now or monotonic() - self.published.timestamp >= LTS_DHT_PUBLISH_SEC):
+            return
+        self.published = LTS_DHTVersion(self.published.number + 1, dict(self.dht),
+                                        self.latency_index, self.uuid)
+        self.fresh = set()
+        self.nb_pending = 0
+
+    # publish the peers added or removed by several updates at once
+    def beginBatch(self):
+        self.dht_lock.acquire()
+        self.batch = self.batch + 1
+        self.dht_lock.release()
+
+    def endBatch(self):
+        self.dht_lock.acquire()
+        self.batch = self.batch - 1
+        if self.nb_pending:
+            self.publish(True)
+        self.dht_lock.release()
+
+    # to be called with the DHT lock held, the entry of a peer that can be
+    # modified, None if not in the DHT
+    def writeEntry(self, uuid):
+        entry = self.dht.get(uuid)
+        if entry is not None and uuid not in self.fresh:
+            entry = entry.copy()
+            self.dht[uuid] = entry
+            self.fresh.add(uuid)
+        return entry
+
+    # the latency index is only updated with the DHT lock held
+    def indexEntry(self, entry):
+        if entry.nb_samples > 0:
+            bisect.insort(self.latency_index, (entry.latency_us, entry.uuid))
+
+    def unindexEntry(self, entry):
+        if entry.nb_samples > 0:
+            i = bisect.bisect_left(self.latency_index, (entry.latency_us, entry.uuid))
+            if i < len(self.latency_index) and self.latency_index[i][1] == entry.uuid:
+                del self.latency_index[i]
+
+    # to be called with the DHT lock held, a peer added again with the same
+    # address keeps its latency
+    def insertEntry(self, uuid, zmq_address, latency_us=0):
+        entry = self.dht.get(uuid)
+        if entry is None or entry.zmq_address != zmq_address:
+            if entry:
+                self.unindexEntry(entry)
+            entry = LTS_DHTEntry(uuid, zmq_address, latency_us)
+            self.dht[uuid] = entry
+            self.fresh.add(uuid)
+            self.indexEntry(entry)
+            self.publish(True)
+
+    # to be called with the DHT lock held, the listeners are to be called
+    # once it is released. Returns the entry removed, None if none
+    def deleteEntry(self, uuid):
+        res = self.dht.pop(uuid, None)
+        if res:
+            logging.info("[DHT] "+self.uuid+" Peer DHT REMOVE " + uuid + " " + res.zmq_address)
+            self.unindexEntry(res)
+            self.fresh.discard(uuid)
+            self.publish(True)
+        return res
+
+    def removed(self, uuid):
+        for handler in self.remove_listeners:
+            handler(uuid)
 
     def add(self, uuid, zmq_address, latency_us=0):
-        entry = LTS_DHTEntry(uuid, zmq_address, latency_us)
         self.dht_lock.acquire()
-        self.dht[uuid] = entry
+        self.insertEntry(uuid, zmq_address, latency_us)
         self.dht_lock.release()
         logging.info("[DHT] "+self.uuid+" Peer DHT ADD " + uuid + " " + zmq_address)
 
     def remove(self, uuid):
-        res = None
         self.dht_lock.acquire()
-        if uuid in self.dht:
-            res = self.dht[uuid]
-            logging.info("[DHT] "+self.uuid+" Peer DHT REMOVE " + uuid + " " + res.zmq_address)
-            del self.dht[uuid]
+        res = self.deleteEntry(uuid)
         self.dht_lock.release()
+        if res:
+            self.removed(uuid)
         return res
 
     def getAddress(self, uuid):
+        entry = self.getPublished().entries.get(uuid)
+        return entry.zmq_address if entry else None
+
+    def getLatency(self, uuid):
+        entry = self.getPublished().entries.get(uuid)
+        return entry.latency_us if entry else None
+
+    # adds a round trip sample, returns the previous smoothed latency
+    def setLatency(self, uuid, latency_us):
         res = None
         self.dht_lock.acquire()
-        if uuid in self.dht:
-            res = self.dht[uuid].zmq_address
+        entry = self.writeEntry(uuid)
+        if entry:
+            res = entry.latency_us
+            self.unindexEntry(entry)
+            entry.addSample(latency_us)
+            self.indexEntry(entry)
+            self.publish()
         self.dht_lock.release()
         return res
 
-    def getLatency(self, uuid):
-        res = None
+    # the peer sent us a message, along with its coordinate if any
+    def setSeen(self, uuid, coordinate=None):
         self.dht_lock.acquire()
-        if uuid in self.dht:
-            res = self.dht[uuid].latency_us
+        entry = self.writeEntry(uuid)
+        if entry:
+            entry.timestamp_seen = time()
+            if coordinate:
+                entry.coordinate = coordinate
+            self.publish()
         self.dht_lock.release()
-        return res
 
-    def setLatency(self, uuid, latency_us):
-        res = None
+    def setCoordinate(self, uuid, coordinate):
         self.dht_lock.acquire()
-        if uuid in self.dht:
-            res = self.dht[uuid].latency_us
-            self.dht[uuid].latency_us = latency_us
+        entry = self.writeEntry(uuid)
+        if entry:
+            entry.coordinate = coordinate
+            self.publish()
         self.dht_lock.release()
+
+    def getCoordinate(self, uuid):
+        entry = self.getPublished().entries.get(uuid)
+        return entry.coordinate if entry else None
+
+    # the entry may be the one of a published version
+    def estimateEntry(self, entry):
+        if entry.nb_samples > 0:
+            return entry.latency_us
+        if self.vivaldi and entry.coordinate:
+            return self.vivaldi.estimate(entry.coordinate)
+        return None
+
+    # smoothed latency of a peer, or its latency estimated from its
+    # coordinate when it was never measured. None if not known at all
+    def getEstimate(self, uuid):
+        entry = self.getPublished().entries.get(uuid)
+        return self.estimateEntry(entry) if entry else None
+
+    # smoothed latency, mean deviation and percentiles of a peer, None if
+    # not in the DHT
+    def getLatencyStats(self, uuid):
+        res = None
+        entry = self.getPublished().entries.get(uuid)
+        if entry:
+            res = {"latency_us": entry.latency_us, "latency_var_us": entry.latency_var_us,
+                   "samples": entry.nb_samples,
+                   "p50_us": entry.getPercentile(0.5), "p90_us": entry.getPercentile(0.9),
+                   "p99_us": entry.getPercentile(0.99)}
+        return res
+
+    # the count peers with the lowest latency, first from the index
+    def getBestPeers(self, count, avoid_uuid=None, published=None):
+        res = list()
+        for _, key in (published or self.getPublished()).latency_index:
+            if len(res) >= count:
+                break
+            if key != avoid_uuid and key != self.uuid:
+                res.append(key)
         return res
 
+    # up to count random peers of a version : list(str)
+    def samplePeers(self, published, count):
+        return random.sample(published.uuids, min(count, len(published.uuids)))
+
+    # the peer with the lowest latency, measured or estimated from the
+    # coordinates of a sample of the peers, any other peer when no latency is
+    # known yet
     def getPeerBestLatency(self, avoid_uuid=None):
-        best_latency = None
-        best_address = None
         best_uuid = None
-        self.dht_lock.acquire()
-        for key, value in self.dht.items():
-            if key != avoid_uuid and key != self.uuid and (best_latency is None or (value.latency_us < best_latency and value.latency_us != 0)):
-                best_latency = value.latency_us
-                best_address = value.zmq_address
+        best_address = None
+        best_latency = None
+        published = self.getPublished()
+        best_list = self.getBestPeers(1, avoid_uuid, published)
+        if best_list:
+            best_uuid = best_list[0]
+            best_latency = published.entries[best_uuid].latency_us
+        for key in self.samplePeers(published, LTS_DHT_ESTIMATE_SAMPLE):
+            entry = published.entries[key]
+            if key == avoid_uuid or entry.nb_samples > 0:
+                continue
+            estimate = self.estimateEntry(entry)
+            if estimate is not None and (best_latency is None or estimate < best_latency):
                 best_uuid = key
-        self.dht_lock.release()
+                best_latency = estimate
+            elif best_uuid is None:
+                best_uuid = key
+        if best_uuid:
+            best_address = published.entries[best_uuid].zmq_address
         return best_uuid, best_address
 
+    # the count peers closest to uuid in the XOR metric : list((uuid, address))
+    def closest(self, uuid, count):
+        target_id = lts_dht_id(uuid)
+        res = [(key, value.zmq_address) for key, value in self.getPublished().entries.items()]
+        res.sort(key=lambda peer: lts_dht_id(peer[0]) ^ target_id)
+        return res[:count]
+
+    # the same tuple until the peers change : tuple(str)
     def getUuidList(self):
-        res = list()
-        self.dht_lock.acquire()        
-        for key, _ in self.dht.items():
-            if key != self.uuid:
-                res.append(key)
-        self.dht_lock.release()
-        return res
+        return self.getPublished().uuids
 
     
+    def toDict(self):
+        res = {"class_name": "LTS_DHT",
+               "dht": {key: value.toDict() for key, value in self.getPublished().entries.items()}}
+        return res
+
     def toJSON(self):
-        res = '{"class_name": "LTS_DHT", "dht": {'
-        i = 0
+        return json.dumps(self.toDict(), sort_keys=True, indent=4)
+
+
+    # write the peers to a file, the first byte is the code of the codec.
+    # The file is replaced at once so that a crash never leaves half of it,
+    # each save writes its own temporary file so that concurrent saves do not
+    # mix their contents
+    def save(self, path, codec="msgpack"):
+        codec = lts_codecs.get(codec)
+        peers = [value.toSnapshot() for key, value in self.getPublished().entries.items() if key != self.uuid]
+        data = codec.dumps({"uuid": self.uuid, "timestamp": time(), "peers": peers})
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                            dir=os.path.dirname(path) or ".")
+            with os.fdopen(fd, "wb") as snapshot:
+                snapshot.write(bytes([codec.code]) + data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("[DHT] "+self.uuid+" Peer DHT snapshot not saved to " + path + ": " + str(e))
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return 0
+        return len(peers)
+
+    # add the peers of a snapshot seen less than max_age_sec ago, the most
+    # recently seen first. Returns the uuids of the ones now in the DHT, an
+    # unreadable snapshot is logged and ignored
+    def load(self, path, max_age_sec=3600):
+        try:
+            with open(path, "rb") as snapshot:
+                data = snapshot.read()
+            codec = lts_codecs.getByCode(data[0])
+            if codec is None or codec.name == "pickle":
+                raise ValueError("unknown or unavailable codec " + str(data[0]))
+            obj = codec.loads(data[1:])
+            if not isinstance(obj.get('peers'), list):
+                raise TypeError("no list of peers")
+            for peer in obj['peers']:
+                lts_dht_check_snapshot(peer)
+            now = time()
+            peers = [peer for peer in obj['peers'] if now - peer['seen'] <= max_age_sec
+                     and peer['uuid'] not in (self.uuid, obj.get('uuid'))]
+        except FileNotFoundError:
+            return list()
+        except (OSError, ValueError, IndexError, KeyError, TypeError, AttributeError) as e:
+            logging.warning("[DHT] "+self.uuid+" Peer DHT snapshot " + path + " not loaded: " + str(e))
+            return list()
+        peers.sort(key=lambda peer: peer['seen'], reverse=True)
+        self.beginBatch()
+        try:
+            for peer in peers:
+                self.restore(peer)
+        finally:
+            self.endBatch()
+        res = [peer['uuid'] for peer in peers if self.getAddress(peer['uuid'])]
+        logging.info("[DHT] "+self.uuid+" Peer DHT restored " + str(len(peers)) + " of " + str(len(obj['peers'])) + " peers from " + path)
+        return res
+
+    def restore(self, peer):
+        self.add(peer['uuid'], peer['address'])
         self.dht_lock.acquire()
-        for key, value in self.dht.items():
-            res = res + '"'+str(key)+'": {"uuid": "'+str(value.uuid)+'", "zmq_address": "'+str(value.zmq_address)+'", "latency_us": '+str(value.latency_us)+', "timestamp_create": "'+str(value.timestamp_create)+'"}'
-            i = i + 1
-            if i < len(self.dht):
-                res = res + ', '
-        res = res + '}}'
-        self.dht_lock.release()
-        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+        try:
+            entry = self.writeEntry(peer['uuid'])
+            if entry and entry.nb_samples == 0:
+                entry.fromSnapshot(peer)
+                self.indexEntry(entry)
+                self.publish()
+        finally:
+            self.dht_lock.release()
+
+    # the peer closest to the coordinate of the requester, among our closest
+    # peers and a sample of the others with a coordinate :
+    # (uuid, address, coordinate), Nones if there is none
+    def getPeerClosest(self, coordinate, avoid_uuid=None):
+        res = (None, None, None)
+        remote = self.vivaldi.remote(coordinate) if self.vivaldi else None
+        if remote is None:
+            return res
+        best_distance = None
+        published = self.getPublished()
+        candidates = set(self.getBestPeers(LTS_DHT_ESTIMATE_SAMPLE, avoid_uuid, published))
+        candidates.update(self.samplePeers(published, LTS_DHT_ESTIMATE_SAMPLE))
+        for key in candidates:
+            entry = published.entries[key]
+            if key == avoid_uuid:
+                continue
+            other = self.vivaldi.remote(entry.coordinate)
+            if other and (best_distance is None or remote.distance(other) < best_distance):
+                best_distance = remote.distance(other)
+                res = (key, entry.zmq_address, entry.coordinate)
+        return res
 
+    # the peer closest to the requester when it sent its coordinate, our
+    # own best peer otherwise
     def dispatchGetPeer(self, message: LTS_Message):
-        best_uuid, best_address = self.getPeerBestLatency(avoid_uuid=message.from_uuid)
+        best_uuid, best_address, coordinate = self.getPeerClosest(message.coordinate, avoid_uuid=message.from_uuid)
+        if best_uuid is None:
+            best_uuid, best_address = self.getPeerBestLatency(avoid_uuid=message.from_uuid)
+            coordinate = self.getCoordinate(best_uuid)
         if best_uuid:
-            response = LTS_Message(LTS_MessageType.CORE_RESPONSE, '{"uuid": "' + best_uuid + '", "address": "' + best_address + '"}', from_uuid=message.to_uuid)
+            response = LTS_Message(LTS_MessageType.CORE_RESPONSE, {"uuid": best_uuid, "address": best_address, "coordinate": coordinate}, from_uuid=message.to_uuid)
         else:
             response = LTS_Message(LTS_MessageType.CORE_NONE)
         return response
-    
+
+    # the requester is added to the DHT, then given the peers closest to the
+    # searched uuid
+    def dispatchSearchPeer(self, message: LTS_Message):
+        content_json = message.getContentObject()
+        if content_json.get('address') and message.from_uuid:
+            self.add(message.from_uuid, content_json['address'])
+        peers = [{"uuid": uuid, "address": address} for uuid, address in self.closest(content_json['uuid'], content_json['count'])]
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"peers": peers},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+# ------------------------------------------------------------------------------
+
+# Kademlia routing table: peers are kept in one bucket per distance range
+# [2^i, 2^(i+1)) from the agent, at most bucket_size per bucket, so that the
+# DHT only holds O(log N) peers and any peer is found in O(log N) lookup
+# steps (see LTS_Communicator.searchPeer). A bucket keeps its oldest peers,
+# the ones that did not fit wait in a replacement list and take the place of
+# the peers removed from the DHT.
+
+class LTS_KademliaDHT(LTS_DHT):
+
+    def __init__(self, dht_uuid, bucket_size=20):
+        super().__init__(dht_uuid)
+        self.class_name = "LTS_KademliaDHT"
+        self.bucket_size = bucket_size
+        self.dht_id = lts_dht_id(dht_uuid)
+        # bucket index : int -> peer uuids, least recently seen first
+        self.buckets = [list() for i in range(LTS_DHT_ID_BITS)]
+        # bucket index : int -> (uuid, address) of the peers not in the bucket
+        self.replacements = [list() for i in range(LTS_DHT_ID_BITS)]
+
+    def getBucket(self, uuid):
+        return (lts_dht_id(uuid) ^ self.dht_id).bit_length() - 1
+
+    def add(self, uuid, zmq_address, latency_us=0):
+        if uuid == self.uuid:
+            return super().add(uuid, zmq_address, latency_us)
+        index = self.getBucket(uuid)
+        self.dht_lock.acquire()
+        bucket = self.buckets[index]
+        added = uuid in self.dht or len(bucket) < self.bucket_size
+        if added:
+            if uuid in bucket:
+                bucket.remove(uuid)
+            bucket.append(uuid)
+        else:
+            replacements = self.replacements[index]
+            replacements[:] = [peer for peer in replacements if peer[0] != uuid]
+            replacements.append((uuid, zmq_address))
+            del replacements[:-self.bucket_size]
+        self.dht_lock.release()
+        if added:
+            super().add(uuid, zmq_address, latency_us)
+
+    def remove(self, uuid):
+        res = super().remove(uuid)
+        if res and uuid != self.uuid:
+            index = self.getBucket(uuid)
+            replacement = None
+            self.dht_lock.acquire()
+            if uuid in self.buckets[index]:
+                self.buckets[index].remove(uuid)
+            if self.replacements[index]:
+                replacement = self.replacements[index].pop()
+            self.dht_lock.release()
+            if replacement:
+                self.add(*replacement)
+        return res
+
+    # a peer that answered becomes the most recently seen of its bucket
+    def setLatency(self, uuid, latency_us):
+        res = super().setLatency(uuid, latency_us)
+        if res is not None and uuid != self.uuid:
+            bucket = self.buckets[self.getBucket(uuid)]
+            self.dht_lock.acquire()
+            if uuid in bucket:
+                bucket.remove(uuid)
+                bucket.append(uuid)
+            self.dht_lock.release()
+        return res
+
+# ------------------------------------------------------------------------------
+
+# HyParView partial view: the DHT only holds the active view, at most
+# active_size peers to which the agent sends its broadcasts, the other known
+# peers wait in a passive view of at most passive_size peers, to replace the
+# active peers that fail (see LTS_PartialView). The passive view is refreshed
+# by shuffles, the state and the fan-out of an agent stay constant whatever
+# the size of the overlay.
+
+class LTS_PartialViewDHT(LTS_DHT):
+
+    def __init__(self, dht_uuid, active_size=5, passive_size=30):
+        super().__init__(dht_uuid)
+        self.class_name = "LTS_PartialViewDHT"
+        self.active_size = active_size
+        self.passive_size = passive_size
+        # peer uuid : str -> address : str
+        self.passive = dict()
+
+    def getActiveCount(self):
+        return len(self.getUuidList())
+
+    def isFull(self):
+        return self.getActiveCount() >= self.active_size
+
+    # to be called with the DHT lock held, the size check and the insertion
+    # are done in the same critical section so that concurrent joins cannot
+    # grow the active view past active_size
+    def isFullLocked(self, uuid):
+        active = len(self.dht) - (self.uuid in self.dht)
+        return uuid != self.uuid and uuid not in self.dht and active >= self.active_size
+
+    # peers are added to the active view while there is room, to the passive
+    # view otherwise
+    def add(self, uuid, zmq_address, latency_us=0):
+        self.dht_lock.acquire()
+        added = not self.isFullLocked(uuid)
+        if added:
+            self.passive.pop(uuid, None)
+            self.insertEntry(uuid, zmq_address, latency_us)
+        else:
+            self.insertPassive(uuid, zmq_address)
+        self.dht_lock.release()
+        if added:
+            logging.info("[DHT] "+self.uuid+" Peer DHT ADD " + uuid + " " + zmq_address)
+
+    # add to the active view, making room when it is full. Returns the
+    # (uuid, address) of the peer moved to the passive view, None if none had
+    # to
+    def addActive(self, uuid, zmq_address):
+        evicted = None
+        self.dht_lock.acquire()
+        active = [peer for peer in self.dht if peer != self.uuid]
+        if active and self.isFullLocked(uuid):
+            evicted_uuid = random.choice(active)
+            evicted = (evicted_uuid, self.deleteEntry(evicted_uuid).zmq_address)
+            self.insertPassive(*evicted)
+        self.passive.pop(uuid, None)
+        self.insertEntry(uuid, zmq_address)
+        self.dht_lock.release()
+        logging.info("[DHT] "+self.uuid+" Peer DHT ADD " + uuid + " " + zmq_address)
+        if evicted:
+            self.removed(evicted[0])
+        return evicted
+
+    def addPassive(self, uuid, zmq_address):
+        self.dht_lock.acquire()
+        self.insertPassive(uuid, zmq_address)
+        self.dht_lock.release()
+
+    # to be called with the DHT lock held
+    def insertPassive(self, uuid, zmq_address):
+        if uuid == self.uuid or zmq_address is None or uuid in self.dht:
+            return
+        if uuid not in self.passive and len(self.passive) >= self.passive_size:
+            del self.passive[random.choice(list(self.passive.keys()))]
+        self.passive[uuid] = zmq_address
+
+    # the active peers of a snapshot may not know us anymore, the active view
+    # is rebuilt from the passive one
+    def restore(self, peer):
+        self.addPassive(peer['uuid'], peer['address'])
+
+    def removePassive(self, uuid):
+        self.dht_lock.acquire()
+        res = self.passive.pop(uuid, None)
+        self.dht_lock.release()
+        return res
+
+    # up to count random passive peers : list((uuid, address))
+    def getPassive(self, count):
+        self.dht_lock.acquire()
+        res = random.sample(list(self.passive.items()), min(count, len(self.passive)))
+        self.dht_lock.release()
+        return res
+
+    def toDict(self):
+        res = super().toDict()
+        self.dht_lock.acquire()
+        res['class_name'] = "LTS_PartialViewDHT"
+        res['passive'] = dict(self.passive)
+        self.dht_lock.release()
+        return res
 
 # ------------------------------------------------------------------------------
 
 if __name__ == "__main__":
     common = LTS_Common()
 
+    dht = LTS_KademliaDHT("alice", bucket_size=2)
+    for i in range(64):
+        dht.add("peer-" + str(i), "tcp://localhost:" + str(6000 + i))
+    print(len(dht.getUuidList()), [len(bucket) for bucket in dht.buckets if bucket])
+    print(dht.closest("peer-7", 3))
+
+    view = LTS_PartialViewDHT("bob", active_size=3, passive_size=4)
+    for i in range(8):
+        view.add("peer-" + str(i), "tcp://localhost:" + str(6000 + i))
+    print(view.addActive("peer-7", "tcp://localhost:6007"))
+    print(view.toJSON())
+
+    snapshot = LTS_DHT("charles")
+    for i in range(4):
+        snapshot.add("peer-" + str(i), "tcp://localhost:" + str(6000 + i))
+        snapshot.setLatency("peer-" + str(i), 100 * (i + 1))
+    path = os.path.join(tempfile.mkdtemp(), "charles.dht")
+    print(snapshot.save(path), os.path.getsize(path))
+    restarted = LTS_DHT("charles")
+    print(restarted.load(path), restarted.getPeerBestLatency())
+
     exit(0)
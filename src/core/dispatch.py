@@ -0,0 +1,71 @@
+import threading
+
+from src.core.common import *
+from src.core.message import *
+
+# ------------------------------------------------------------------------------
+
+# a handler takes the received LTS_Message and returns the response message,
+# or None for a plain CORE_ACK. Inline handlers must be fast and non
+# blocking (membership, DHT, DSM metadata), they run on the receiving thread.
+# The other ones run on the bounded pool of server workers so that a slow
+# application handler does not delay the rest of the traffic.
+
+class LTS_Handler(LTS_BaseClass):
+
+    def __init__(self, message_type, handler, inline=False):
+        super().__init__("LTS_Handler")
+        self.message_type = message_type
+        self.handler = handler
+        self.inline = inline
+
+# ------------------------------------------------------------------------------
+
+class LTS_HandlerRegistry(LTS_BaseClass):
+
+    def __init__(self, registry_uuid):
+        super().__init__("LTS_HandlerRegistry")
+        self.uuid = registry_uuid
+        # message type : str -> LTS_Handler
+        self.handlers = dict()
+        self.handlers_lock = threading.Lock()
+
+
+    def toJSON(self):
+        self.handlers_lock.acquire()
+        handlers = {message_type: handler.inline for message_type, handler in self.handlers.items()}
+        self.handlers_lock.release()
+        res = json.dumps({"class_name": "LTS_HandlerRegistry", "uuid": self.uuid, "inline": handlers})
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def register(self, message_type, handler, inline=False):
+        message_type = getattr(message_type, "value", message_type)
+        logging.info("[DSP] "+self.uuid+" Registering " + ("inline" if inline else "worker") + " handler for " + str(message_type))
+        self.handlers_lock.acquire()
+        self.handlers[message_type] = LTS_Handler(message_type, handler, inline)
+        self.handlers_lock.release()
+
+    def unregister(self, message_type):
+        self.handlers_lock.acquire()
+        self.handlers.pop(message_type, None)
+        self.handlers_lock.release()
+
+    def get(self, message_type):
+        self.handlers_lock.acquire()
+        res = self.handlers.get(message_type)
+        self.handlers_lock.release()
+        return res
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    registry = LTS_HandlerRegistry("registry")
+    registry.register(LTS_MessageType.DHT_GET_PEER, lambda message: None, inline=True)
+    registry.register(LTS_MessageType.USER_DEFINED, lambda message: None)
+    print(registry.get("DHT_GET_PEER").inline, registry.get(LTS_MessageType.USER_DEFINED).inline)
+    print(registry.toJSON())
+
+    exit(0)
@@ -1,15 +1,34 @@
 
 import uuid
+import threading
 
 from src.core.common import *
 from src.core.communicator import *
-from src.core.memory import LTS_Memory, LTS_Chunk
+from src.core.memory import LTS_Memory, LTS_Chunk, LTS_MEMORY_CAPACITY
+from src.core.wire import LTS_WIRE_DSM
 
 # ------------------------------------------------------------------------------
 
+# Write-invalidate coherence: the owner of a chunk (the agent that first wrote
+# it) keeps the directory of the peers that read a copy of it with
+# DSM_CHUNK_GET. A reader serves its copy from memory until the owner tells it
+# with DSM_CHUNK_INVALIDATE that a newer version was written, the next read
+# fetches the chunk again. The owner waits for the invalidations before
+# write() returns. A peer writing a chunk it does not own sends the content to
+# the owner with DSM_CHUNK_PUT, the owner writes it and invalidates the other
+# copies before answering with the new version.
+#
+# Copies carry the version they were read at: an invalidation only drops an
+# older copy and a copy older than an invalidation already received is not
+# kept. Peers older than LTS_WIRE_DSM are not tracked and their writes stay
+# local, as are the writes to an owner older than LTS_WIRE_DSM. A peer that
+# does not answer an invalidation in time is removed from the DHT and may
+# keep a stale copy.
+
 class LTS_DSM(LTS_BaseClass):
 
-    def __init__(self, dsm_uuid=None, communicator=None, memory_capacity = 64):
+    def __init__(self, dsm_uuid=None, communicator=None, memory_capacity = LTS_MEMORY_CAPACITY,
+                 memory_policy = "lru", invalidate_deadline_ms = None):
 
         super().__init__("LTS_DSM")
         self.uuid = dsm_uuid or str(uuid.uuid4())
@@ -18,48 +37,140 @@ class LTS_DSM(LTS_BaseClass):
 
         self.communicator = communicator
 
+        # memory_capacity in bytes, the remote contents cached by read()
+        # are evicted first by memory_policy ("lru" or "arc")
         self.memory = LTS_Memory(memory_uuid=self.uuid,
-                                 capacity = memory_capacity)
+                                 capacity = memory_capacity,
+                                 policy = memory_policy)
+
+        # chunk uuid : str -> uuids of the peers holding a copy : set(str),
+        # for the chunks owned by the agent
+        self.directory = dict()
+        self.directory_lock = threading.Lock()
+        # None waits for the broadcast deadline of the communicator
+        self.invalidate_deadline_ms = invalidate_deadline_ms
+
+        self.nb_invalidations_sent = 0
+        self.nb_invalidations_received = 0
 
 
     def toJSON(self):
-        return "{}"
+        self.directory_lock.acquire()
+        res = json.dumps({"class_name": "LTS_DSM", "uuid": self.uuid,
+                          "memory": self.memory.getStats(),
+                          "directory": {key: sorted(value) for key, value in self.directory.items()},
+                          "invalidations_sent": self.nb_invalidations_sent,
+                          "invalidations_received": self.nb_invalidations_received})
+        self.directory_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
 
 
+    def isCoherent(self, peer_uuid):
+        return self.communicator.wire.getPeerVersion(peer_uuid) >= LTS_WIRE_DSM
 
 
     def write(self, chunk_id, content):
         res = None
         chunk = self.memory.getChunk(chunk_id)
-        if chunk:
-            chunk.content = content
-            chunk.version = chunk.version + 1
-            res = chunk_id
-        else:
+        if chunk is None:
             logging.info("[DSM] "+self.uuid+" Writing chunk " + chunk_id + " in memory first touch")
             res = self.memory.firstTouch(chunk_id, self.uuid, content)
+        elif chunk.agent_uuid == self.uuid:
+            res, version, sharers = self.writeOwned(chunk_id, content)
+            self.invalidate(chunk_id, version, sharers)
+        elif self.isCoherent(chunk.agent_uuid):
+            logging.info("[DSM] "+self.uuid+" Writing chunk " + chunk_id + " to agent " + chunk.agent_uuid)
+            message = self.putMessage(chunk, content)
+            response = self.communicator.sendMessage(chunk.agent_uuid, message)
+            res = self.putResult(chunk, content, response)
+        else:
+            res = self.memory.addChunk(LTS_Chunk(chunk_id, chunk.agent_uuid,
+                                                 chunk.version + 1, content))
         return res
-            
+
+    # write a chunk of the agent, the writer keeps its copy. Returns the
+    # uuid of the chunk (None if refused), its new version and the peers
+    # whose copy is to be invalidated
+    def writeOwned(self, chunk_id, content, writer_uuid=None):
+        sharers = set()
+        self.directory_lock.acquire()
+        version = self.memory.getChunk(chunk_id).version + 1
+        res = self.memory.addChunk(LTS_Chunk(chunk_id, self.uuid, version, content))
+        if res:
+            sharers = self.directory.pop(chunk_id, set())
+            if writer_uuid:
+                sharers.discard(writer_uuid)
+                self.directory[chunk_id] = {writer_uuid}
+        self.directory_lock.release()
+        return res, version, sharers
+
+    def invalidateMessage(self, chunk_id, version, sharers):
+        logging.info("[DSM] "+self.uuid+" Invalidating " + str(len(sharers)) + " copies of chunk " + chunk_id)
+        self.directory_lock.acquire()
+        self.nb_invalidations_sent = self.nb_invalidations_sent + len(sharers)
+        self.directory_lock.release()
+        return LTS_Message(LTS_MessageType.DSM_CHUNK_INVALIDATE, {"uuid": chunk_id, "version": version},
+                           from_uuid=self.uuid)
+
+    def invalidated(self, chunk_id, failures):
+        if failures:
+            logging.warning("[DSM] "+self.uuid+" Copies of chunk " + chunk_id + " not invalidated on " + str(failures))
+
+    def invalidate(self, chunk_id, version, sharers):
+        if not sharers:
+            return
+        message = self.invalidateMessage(chunk_id, version, sharers)
+        _, failures = self.communicator.scatterMessage(message, list(sharers), self.invalidate_deadline_ms)
+        self.invalidated(chunk_id, failures)
+
+    def putMessage(self, chunk, content):
+        message = LTS_Message(LTS_MessageType.DSM_CHUNK_PUT,
+                              from_uuid=self.uuid, to_uuid=chunk.agent_uuid)
+        LTS_Chunk(chunk.uuid, chunk.agent_uuid, chunk.version, content).toMessage(message)
+        return message
+
+    # the written content is kept as a copy of the version the owner wrote
+    def putResult(self, chunk, content, response):
+        version = None
+        if response.message_type == LTS_MessageType.CORE_RESPONSE:
+            version = response.getContentObject().get('version')
+        if version is None:
+            logging.warning("[DSM] "+self.uuid+" Writing chunk " + chunk.uuid + " refused by agent " + chunk.agent_uuid)
+            return None
+        self.memory.cacheChunk(LTS_Chunk(chunk.uuid, chunk.agent_uuid, version, content))
+        return chunk.uuid
+
 
     def read(self, chunk_id):
         content = None
-        chunk = self.memory.getChunk(chunk_id)
+        chunk = self.memory.readChunk(chunk_id)
         if chunk:
             if chunk.content is not None:
                 content = chunk.content
             else:
                 if chunk.agent_uuid is not None and chunk.agent_uuid != self.uuid:
                     logging.info("[DSM] "+self.uuid+" Asking agent " + chunk.agent_uuid + " for chunk " + chunk.uuid)
-                    message = LTS_Message(LTS_MessageType.DSM_CHUNK_GET,
-                                          from_uuid=self.uuid, to_uuid=chunk.agent_uuid,
-                                          content=chunk.toJSON())
+                    message = self.getMessage(chunk)
                     response = self.communicator.sendMessage(chunk.agent_uuid, message)
-                    chunk.fromJSON(response.content)
-                    content = chunk.content
+                    content = self.getResult(response)
         else:
             logging.warning("[DSM] "+self.uuid+" Reading chunk " + chunk_id + " not in memory")
         return content
 
+    def getMessage(self, chunk):
+        message = LTS_Message(LTS_MessageType.DSM_CHUNK_GET,
+                              from_uuid=self.uuid, to_uuid=chunk.agent_uuid)
+        LTS_Chunk(chunk.uuid, chunk.agent_uuid, chunk.version).toMessage(message)
+        return message
+
+    def getResult(self, response):
+        if response.message_type == LTS_MessageType.CORE_NONE:
+            return None
+        chunk = LTS_Chunk()
+        chunk.fromMessage(response)
+        self.memory.cacheChunk(chunk)
+        return chunk.content
+
 
     def dispatchMessage(self, message):
         response = LTS_Message(LTS_MessageType.CORE_ACK,
@@ -67,36 +178,76 @@ class LTS_DSM(LTS_BaseClass):
 
         if message.message_type == LTS_MessageType.DSM_CHUNK_ADVERTIZE:
             chunk = LTS_Chunk()
-            chunk.fromJSON(message.content)
-            self.memory.addChunk(chunk)
+            chunk.fromDict(message.getContentObject())
+            # a copy of the advertised version is still valid
+            current = self.memory.getChunk(chunk.uuid)
+            if current is None or current.agent_uuid != chunk.agent_uuid or current.version < chunk.version:
+                self.memory.addChunk(chunk)
         elif message.message_type == LTS_MessageType.DSM_CHUNK_GET:
             chunkmd = LTS_Chunk()
-            chunkmd.fromJSON(message.content)
+            chunkmd.fromDict(message.getContentObject())
+            self.directory_lock.acquire()
             chunk = self.memory.getChunk(chunkmd.uuid)
             if chunk:
-                response.content = chunk.toJSON()
+                chunk.toMessage(response)
+                if chunk.agent_uuid == self.uuid and message.from_uuid and self.isCoherent(message.from_uuid):
+                    self.directory.setdefault(chunk.uuid, set()).add(message.from_uuid)
             else:
-                response.content = message.content
+                response.content = chunkmd.toDict()
+            self.directory_lock.release()
+        elif message.message_type == LTS_MessageType.DSM_CHUNK_INVALIDATE:
+            content_json = message.getContentObject()
+            if self.memory.invalidateChunk(content_json['uuid'], content_json['version']):
+                logging.info("[DSM] "+self.uuid+" Copy of chunk " + content_json['uuid'] + " invalidated by " + message.from_uuid)
+                self.directory_lock.acquire()
+                self.nb_invalidations_received = self.nb_invalidations_received + 1
+                self.directory_lock.release()
+        elif message.message_type == LTS_MessageType.DSM_CHUNK_PUT:
+            response = self.dispatchPut(message)
         else:
             logging.error("[DSM] "+self.uuid+" Receiving message from " + message.from_uuid + " with unknown DSM type " + str(message.message_type))
 
         return response
 
+    # DSM_CHUNK_PUT: write a chunk of the agent for the sender, answers with
+    # the new version, None if the chunk is not ours or was refused
+    def dispatchPut(self, message):
+        chunk_id, version, sharers = self.putOwned(message)
+        self.invalidate(chunk_id, version, sharers)
+        return self.putResponse(message, chunk_id, version)
+
+    def putOwned(self, message):
+        chunk = LTS_Chunk()
+        chunk.fromMessage(message)
+        current = self.memory.getChunk(chunk.uuid)
+        if current is None or current.agent_uuid != self.uuid:
+            return chunk.uuid, None, set()
+        res, version, sharers = self.writeOwned(chunk.uuid, chunk.content, message.from_uuid)
+        return chunk.uuid, version if res else None, sharers
+
+    def putResponse(self, message, chunk_id, version):
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"uuid": chunk_id, "version": version},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
 
 
-    
+
+    # with a gossip tree the advertisement reaches the whole overlay, not
+    # only the peers of the DHT
     def advertize(self, chunk_id):
         chunk = self.memory.getChunkMetadata(chunk_id)
         if chunk:
             message = LTS_Message(LTS_MessageType.DSM_CHUNK_ADVERTIZE, from_uuid=self.uuid,
-                                  content=chunk.toJSON())
-            self.communicator.broadcastMessage(message)
+                                  content=chunk.toDict())
+            if self.communicator.gossip:
+                self.communicator.gossip.broadcastMessage(message)
+            else:
+                self.communicator.postBroadcastMessage(message)
+
 
-    
 # ------------------------------------------------------------------------------
 
 
 
 if __name__ == "__main__":
-    
+
     exit(0)
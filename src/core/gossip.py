@@ -0,0 +1,281 @@
+import uuid
+import queue
+import threading
+
+from time import monotonic
+from collections import OrderedDict
+
+from src.core.common import *
+from src.core.message import *
+from src.core.wire import LTS_WIRE_GOSSIP
+
+# ------------------------------------------------------------------------------
+
+# multi-hop broadcast over the peers of the DHT (Plumtree). A message is
+# pushed with GOSSIP_PUSH to the eager peers and only announced by its id with
+# GOSSIP_IHAVE to the lazy ones. All the peers start eager: a peer receiving a
+# message it already delivered answers the push with a prune, both ends of the
+# link turn it lazy and the eager links end up as a spanning tree of the
+# overlay. A message is then delivered to the N agents in O(log N) hops with
+# N - 1 pushes, plus the announcements that are batched every heartbeat.
+#
+# An agent missing a message announced for more than graft_timeout_ms asks
+# the peer that announced it with GOSSIP_GRAFT: the peer answers with the
+# message and the link turns eager again, which repairs the tree around the
+# agents that left. Peers removed from the DHT leave the eager and lazy sets.
+#
+# Pushes are forwarded on a thread of the agent (or the executor of its host)
+# so that the handlers never wait for another peer. Only peers that know the
+# gossip messages take part, in a partial view (dht_active_size) the links
+# are the active view and the number of lazy announcements stays bounded.
+
+class LTS_GossipBroadcast(LTS_BaseClass):
+
+    def __init__(self, gossip_uuid, communicator, deliver, submit=None,
+                 graft_timeout_ms=1000, cache_size=1024, timeout_ms=1000):
+        super().__init__("LTS_GossipBroadcast")
+        self.uuid = gossip_uuid
+        self.communicator = communicator
+        self.dht = communicator.dht
+        # called with the delivered LTS_Message, from the sender of the
+        # broadcast
+        self.deliver = deliver
+        self.graft_timeout_sec = graft_timeout_ms / 1000
+        self.cache_size = cache_size
+        self.timeout_ms = timeout_ms
+
+        # peers the messages are only announced to
+        self.lazy = set()
+        # message id : str -> pushed content : dict, the last cache_size
+        # messages received, to detect duplicates and answer grafts
+        self.received = OrderedDict()
+        # message id : str -> [first announce : float (monotonic), announcers : list(str)]
+        self.missing = dict()
+        # peer uuid : str -> ids to announce : list(str)
+        self.announces = dict()
+        self.state_lock = threading.Lock()
+
+        self.nb_delivered = 0
+        self.nb_duplicates = 0
+        self.nb_pushed = 0
+        self.nb_grafted = 0
+        self.max_hops = 0
+
+        # submit None forwards on a thread of our own
+        self.submit = submit
+        self.pid_gsp = None
+        if self.submit is None:
+            self.forward_queue = queue.Queue()
+            self.submit = self.queueForward
+            self.pid_gsp = threading.Thread(target=self.run_gsp)
+            self.pid_gsp.start()
+
+
+    def toJSON(self):
+        self.state_lock.acquire()
+        res = json.dumps({"class_name": "LTS_GossipBroadcast", "uuid": self.uuid,
+                          "lazy": sorted(self.lazy), "delivered": self.nb_delivered,
+                          "duplicates": self.nb_duplicates, "pushed": self.nb_pushed,
+                          "grafted": self.nb_grafted, "max_hops": self.max_hops})
+        self.state_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def queueForward(self, function, *args):
+        self.forward_queue.put((function, args))
+
+    def run_gsp(self):
+        while True:
+            task = self.forward_queue.get()
+            if task is None:
+                break
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("[GSP] "+self.uuid+" Gossip forward failed")
+
+    def terminate(self):
+        if self.pid_gsp:
+            self.forward_queue.put(None)
+            self.pid_gsp.join()
+
+
+    # peers of the DHT that know the gossip messages : list(str)
+    def getPeers(self):
+        wire = self.communicator.wire
+        return [key for key in self.dht.getUuidList()
+                if key != self.uuid and wire.getPeerVersion(key) >= LTS_WIRE_GOSSIP]
+
+    # to be called with state_lock held, False if the message is a duplicate
+    def record(self, gossip):
+        if gossip['id'] in self.received:
+            return False
+        self.received[gossip['id']] = gossip
+        while len(self.received) > self.cache_size:
+            self.received.popitem(last=False)
+        self.missing.pop(gossip['id'], None)
+        self.max_hops = max(self.max_hops, gossip['hops'])
+        return True
+
+    def deliverGossip(self, gossip):
+        message = LTS_Message(gossip['type'], content=gossip['content'],
+                              from_uuid=gossip['origin'], to_uuid=self.uuid)
+        self.deliver(message)
+
+
+    def broadcastMessage(self, message):
+        gossip = {"id": str(uuid.uuid4()), "origin": self.uuid,
+                  "type": message.message_type, "content": message.content, "hops": 0}
+        self.state_lock.acquire()
+        self.record(gossip)
+        self.state_lock.release()
+        self.push(gossip, None)
+
+    def broadcast(self, content):
+        message = LTS_Message(LTS_MessageType.USER_DEFINED, content=content, from_uuid=self.uuid)
+        self.broadcastMessage(message)
+
+    # push a message to the eager peers but the one it came from, the lazy
+    # ones get its id on the next heartbeat
+    def push(self, gossip, from_uuid):
+        forward = dict(gossip)
+        forward['hops'] = gossip['hops'] + 1
+        peers = [key for key in self.getPeers() if key != from_uuid and key != gossip['origin']]
+        self.state_lock.acquire()
+        eager = [key for key in peers if key not in self.lazy]
+        for key in peers:
+            if key in self.lazy:
+                self.announces.setdefault(key, list()).append(gossip['id'])
+        self.nb_pushed = self.nb_pushed + len(eager)
+        self.state_lock.release()
+        if not eager:
+            return
+        messages = {key: LTS_Message(LTS_MessageType.GOSSIP_PUSH, forward,
+                                     from_uuid=self.uuid, to_uuid=key) for key in eager}
+        results, _ = self.communicator.scatterMessages(messages, self.timeout_ms)
+        pruned = [key for key, response in results.items()
+                  if response.message_type == LTS_MessageType.CORE_RESPONSE and response.getContentObject().get('prune')]
+        if pruned:
+            self.state_lock.acquire()
+            self.lazy.update(pruned)
+            self.state_lock.release()
+
+
+    # every heartbeat: forget the peers that left, announce the messages to
+    # the lazy peers and graft the ones announced but still missing
+    def maintain(self):
+        peers = set(self.getPeers())
+        now = monotonic()
+        self.state_lock.acquire()
+        self.lazy.intersection_update(peers)
+        announces = {key: ids for key, ids in self.announces.items() if key in peers}
+        self.announces = dict()
+        grafts = dict()
+        for msg_id, missing in list(self.missing.items()):
+            announcers = [key for key in missing[1] if key in peers]
+            if not announcers:
+                del self.missing[msg_id]
+            elif now - missing[0] >= self.graft_timeout_sec:
+                missing[1] = announcers[1:]
+                grafts.setdefault(announcers[0], list()).append(msg_id)
+        self.state_lock.release()
+
+        if announces:
+            messages = {key: LTS_Message(LTS_MessageType.GOSSIP_IHAVE, {"ids": ids},
+                                         from_uuid=self.uuid, to_uuid=key) for key, ids in announces.items()}
+            self.communicator.scatterMessages(messages, self.timeout_ms)
+        if grafts:
+            messages = {key: LTS_Message(LTS_MessageType.GOSSIP_GRAFT, {"ids": ids},
+                                         from_uuid=self.uuid, to_uuid=key) for key, ids in grafts.items()}
+            results, _ = self.communicator.scatterMessages(messages, self.timeout_ms)
+            for key, response in results.items():
+                if response.message_type == LTS_MessageType.CORE_RESPONSE:
+                    self.grafted(key, response.getContentObject().get('messages', list()))
+
+    def grafted(self, from_uuid, gossips):
+        self.state_lock.acquire()
+        self.lazy.discard(from_uuid)
+        gossips = [gossip for gossip in gossips if self.record(gossip)]
+        self.nb_grafted = self.nb_grafted + len(gossips)
+        self.nb_delivered = self.nb_delivered + len(gossips)
+        self.state_lock.release()
+        for gossip in gossips:
+            logging.info("[GSP] "+self.uuid+" Gossip " + gossip['id'] + " grafted from " + from_uuid)
+            self.deliverGossip(gossip)
+            self.push(gossip, from_uuid)
+
+
+    # GOSSIP_PUSH: deliver and forward a new message, prune the link of a
+    # duplicate
+    def dispatchPush(self, message):
+        gossip = message.getContentObject()
+        self.state_lock.acquire()
+        new = self.record(gossip)
+        if new:
+            self.lazy.discard(message.from_uuid)
+            self.nb_delivered = self.nb_delivered + 1
+        else:
+            self.lazy.add(message.from_uuid)
+            self.nb_duplicates = self.nb_duplicates + 1
+        self.state_lock.release()
+        if not new:
+            return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"prune": True},
+                               from_uuid=self.uuid, to_uuid=message.from_uuid)
+        self.deliverGossip(gossip)
+        self.submit(self.push, gossip, message.from_uuid)
+
+    # GOSSIP_IHAVE: remember the messages we did not receive yet
+    def dispatchIHave(self, message):
+        now = monotonic()
+        self.state_lock.acquire()
+        for msg_id in message.getContentObject()['ids']:
+            if msg_id not in self.received:
+                self.missing.setdefault(msg_id, [now, list()])[1].append(message.from_uuid)
+        self.state_lock.release()
+
+    # GOSSIP_GRAFT: the sender missed messages we announced, the link turns
+    # eager
+    def dispatchGraft(self, message):
+        self.state_lock.acquire()
+        self.lazy.discard(message.from_uuid)
+        gossips = [self.received[msg_id] for msg_id in message.getContentObject()['ids'] if msg_id in self.received]
+        self.state_lock.release()
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"messages": gossips},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    import random
+    from time import sleep
+    from src.core.agents import LTS_Agent
+
+    class Receiver:
+        def __init__(self):
+            self.received = list()
+
+        def dispatchMessage(self, message):
+            self.received.append(message.content)
+
+    agent_list = list()
+    for i in range(12):
+        seed = agent_list[random.randrange(i)] if i else None
+        agent_list.append(LTS_Agent(zmq_bind="inproc://gossip-" + str(i), zmq_address="inproc://gossip-" + str(i),
+                                    zmq_seed_uuid=seed.uuid if seed else None,
+                                    zmq_seed_address=seed.communicator.zmq_address if seed else None,
+                                    dispatch_handler=Receiver(),
+                                    heartbeat_timer_sec=1, dht_active_size=3, dht_passive_size=6,
+                                    gossip=True, broadcast_terminate=False))
+    sleep(3)
+    for i in range(3):
+        agent_list[i].gossip.broadcast('{"round": ' + str(i) + '}')
+        sleep(1)
+    for agent in agent_list:
+        print(agent.uuid, len(agent.dispatch_handler.received), agent.gossip.toJSON())
+    for agent in agent_list:
+        agent.terminate()
+
+    exit(0)
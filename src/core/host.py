@@ -0,0 +1,568 @@
+import uuid
+import heapq
+import random
+import threading
+
+from time import sleep, monotonic
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from src.core.common import *
+from src.core.agents import *
+from src.core.rpc import LTS_RPC, LTS_RPC_Instance
+from src.core.inproc import lts_zmq_context, lts_inproc
+from src.core.wire import LTS_Wire, LTS_WIRE_VERSION, lts_wire_split_envelope
+
+# ------------------------------------------------------------------------------
+
+# an agent host runs many lightweight agents in one process without a thread
+# per agent: one network thread polls a single ROUTER socket for all of them
+# and fires their heartbeats from one timer heap, handlers run on one shared
+# executor. Each hosted agent keeps its own DHT, DSM and RPC objects and is
+# advertised at the host address, requests are routed by their to_uuid.
+# Requests between agents of the same host do not go through a socket.
+
+class LTS_AgentHost(LTS_BaseClass):
+
+    def __init__(self, host_uuid=None,
+                 zmq_bind="tcp://*:5555", zmq_address="tcp://localhost:5555",
+                 zmq_recv_timeout_sec=10,
+                 heartbeat_timer_sec=8,
+                 workers=8,
+                 zmq_wire_version=LTS_WIRE_VERSION,
+                 zmq_inproc=True,
+                 running=True):
+
+        super().__init__("LTS_AgentHost")
+        self.uuid = host_uuid or str(uuid.uuid4())
+
+        self.zmq_bind = zmq_bind
+        self.zmq_address = zmq_address
+        self.zmq_recv_timeout_sec = zmq_recv_timeout_sec
+        self.zmq_wire_version = zmq_wire_version
+        self.heartbeat_timer_sec = heartbeat_timer_sec
+
+        self.zmq_inproc = zmq_inproc
+        if self.zmq_inproc:
+            self.zmq_context = lts_zmq_context()
+        else:
+            self.zmq_context = zmq.Context()
+
+        self.zmq_socket_router = self.zmq_context.socket(zmq.ROUTER)
+        self.zmq_socket_router.bind(self.zmq_bind)
+        self.zmq_inproc_address = None
+        if self.zmq_inproc and not self.zmq_bind.startswith("inproc://"):
+            self.zmq_inproc_address = "inproc://lts-host-" + self.uuid + "-" + str(id(self))
+            self.zmq_socket_router.bind(self.zmq_inproc_address)
+            lts_inproc.register(self.zmq_address, self.zmq_inproc_address)
+
+        # replies of the executor threads, see reply()
+        self.zmq_reply_address = "inproc://lts-host-reply-" + self.uuid + "-" + str(id(self))
+        self.zmq_socket_reply = self.zmq_context.socket(zmq.PULL)
+        self.zmq_socket_reply.bind(self.zmq_reply_address)
+        self.local = threading.local()
+        self.push_list = list()
+        self.push_lock = threading.Lock()
+
+        self.zmq_control_address = "inproc://lts-host-control-" + self.uuid + "-" + str(id(self))
+        self.zmq_socket_control = self.zmq_context.socket(zmq.PULL)
+        self.zmq_socket_control.bind(self.zmq_control_address)
+
+        # answers requests to agents that are not (or no longer) hosted
+        self.wire = LTS_Wire(self.uuid, zmq_wire_version)
+
+        # agent uuid : str -> LTS_HostedAgent
+        self.agents = dict()
+        self.agents_lock = threading.Lock()
+
+        # heartbeats : heap((deadline : float (monotonic), agent uuid : str)),
+        # only used by the network thread. Agents whose previous heartbeat is
+        # still running are skipped
+        self.timers = list()
+        self.timers_lock = threading.Lock()
+        self.beating = set()
+
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="lts-host")
+
+        # set by terminate, the hosted agents do not send each other their
+        # terminate broadcast and each remote peer is only sent one
+        self.closing = False
+        self.notified = set()
+        self.notified_lock = threading.Lock()
+
+        self.pid_net = None
+        self.running_lock = threading.Lock()
+        self.running = running
+
+        if self.getRunning():
+            self.pid_net = threading.Thread(target=self.run_net)
+            self.pid_net.start()
+
+
+    def toJSON(self):
+        self.agents_lock.acquire()
+        agents = list(self.agents.keys())
+        self.agents_lock.release()
+        res = json.dumps({"class_name": "LTS_AgentHost", "uuid": self.uuid,
+                          "zmq_bind": self.zmq_bind, "zmq_address": self.zmq_address,
+                          "agents": agents})
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+    def getRunning(self):
+        self.running_lock.acquire()
+        res = self.running
+        self.running_lock.release()
+        return res
+
+    def setRunning(self, running):
+        self.running_lock.acquire()
+        self.running = running
+        self.running_lock.release()
+        if not running:
+            self.wakeServer()
+
+
+    def addAgent(self, agent_uuid=None, name=None, **kwargs):
+        agent = LTS_HostedAgent(self, agent_uuid, name, **kwargs)
+        self.agents_lock.acquire()
+        self.agents[agent.uuid] = agent
+        self.agents_lock.release()
+        self.timers_lock.acquire()
+        heapq.heappush(self.timers, (monotonic() + random.uniform(0, self.heartbeat_timer_sec), agent.uuid))
+        self.timers_lock.release()
+        self.submit(agent.communicator.bootstrap)
+        return agent
+
+    def removeAgent(self, agent_uuid):
+        self.agents_lock.acquire()
+        agent = self.agents.pop(agent_uuid, None)
+        self.agents_lock.release()
+        return agent
+
+    def getAgent(self, agent_uuid):
+        self.agents_lock.acquire()
+        res = self.agents.get(agent_uuid)
+        self.agents_lock.release()
+        return res
+
+    def hosts(self, agent_uuid):
+        return self.getAgent(agent_uuid) is not None
+
+    def getAgentList(self):
+        self.agents_lock.acquire()
+        res = list(self.agents.values())
+        self.agents_lock.release()
+        return res
+
+
+    def submit(self, function, *args):
+        return self.executor.submit(self.runTask, function, *args)
+
+    # exceptions of the tasks would otherwise stay in their future
+    def runTask(self, function, *args):
+        try:
+            return function(*args)
+        except Exception:
+            logging.exception("[HST] "+self.uuid+" Host task " + str(function) + " failed")
+
+    # served by a direct call on the thread of the requester
+    def request(self, communicator, to_uuid, message):
+        agent = self.getAgent(to_uuid)
+        if agent is None:
+            return LTS_Message(LTS_MessageType.CORE_NONE)
+        start = datetime.now()
+        data_recv = agent.serveLocal(communicator.wire.encodeRequest(to_uuid, message))
+        return communicator.processResponse(to_uuid, start, data_recv)
+
+    # zmq sockets are not thread safe, each executor thread pushes its
+    # replies on its own socket to the network thread
+    def reply(self, frames):
+        push = getattr(self.local, "push", None)
+        if push is None:
+            push = self.zmq_context.socket(zmq.PUSH)
+            push.connect(self.zmq_reply_address)
+            self.local.push = push
+            self.push_lock.acquire()
+            self.push_list.append(push)
+            self.push_lock.release()
+        push.send_multipart(frames, copy=False)
+
+
+    def wakeServer(self):
+        socket = self.zmq_context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.LINGER, 1000)
+        socket.connect(self.zmq_control_address)
+        try:
+            socket.send(b'', zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+        socket.close()
+
+    def drainControl(self):
+        while True:
+            try:
+                self.zmq_socket_control.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+
+    def run_net(self):
+        logging.info("[HST] "+self.uuid+" Host running on " + self.zmq_address)
+        router = self.zmq_socket_router
+        reply = self.zmq_socket_reply
+        control = self.zmq_socket_control
+        poller = zmq.Poller()
+        poller.register(router, zmq.POLLIN)
+        poller.register(reply, zmq.POLLIN)
+        poller.register(control, zmq.POLLIN)
+        while self.getRunning():
+            events = dict(poller.poll(self.nextTimeout()))
+            if control in events:
+                self.drainControl()
+            if reply in events:
+                self.forwardReplies(router, reply)
+            if router in events:
+                while True:
+                    try:
+                        frames = router.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.serveRequest(router, *lts_wire_split_envelope(frames))
+            self.fireTimers()
+
+        self.forwardReplies(router, reply)
+        logging.info("[HST] "+self.uuid+" Host terminating")
+
+    def serveRequest(self, router, envelope, frames):
+        agent = self.getAgent(self.wire.peekTo(frames))
+        if agent:
+            agent.serveRequest(router, envelope, frames)
+        else:
+            message = self.wire.decode(frames)
+            logging.info("[HST] "+self.uuid+" Host received message " + str(message.message_type) + " for agent " + str(message.to_uuid) + " not hosted")
+            response = LTS_Message(LTS_MessageType.CORE_NONE)
+            router.send_multipart(envelope + self.wire.encodeReply(response, message), copy=False)
+
+    def forwardReplies(self, router, reply):
+        while True:
+            try:
+                frames = reply.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            router.send_multipart(frames, copy=False)
+
+
+    # milliseconds until the next heartbeat, bounded by the recv timeout
+    def nextTimeout(self):
+        res = self.zmq_recv_timeout_sec * 1000
+        self.timers_lock.acquire()
+        if self.timers:
+            res = min(res, max(0, (self.timers[0][0] - monotonic()) * 1000))
+        self.timers_lock.release()
+        return res
+
+    def fireTimers(self):
+        now = monotonic()
+        due = list()
+        self.timers_lock.acquire()
+        while self.timers and self.timers[0][0] <= now:
+            _, agent_uuid = heapq.heappop(self.timers)
+            due.append(agent_uuid)
+        self.timers_lock.release()
+        for agent_uuid in due:
+            agent = self.getAgent(agent_uuid)
+            if agent is None:
+                continue
+            if agent_uuid not in self.beating:
+                self.beating.add(agent_uuid)
+                self.submit(self.heartbeat, agent)
+            self.timers_lock.acquire()
+            heapq.heappush(self.timers, (now + self.heartbeat_timer_sec, agent_uuid))
+            self.timers_lock.release()
+
+    def heartbeat(self, agent):
+        try:
+            agent.heartbeat()
+        finally:
+            self.beating.discard(agent.uuid)
+
+
+    # remote peers of the list not sent a terminate broadcast yet
+    def claimNotify(self, dht, uuid_list):
+        res = list()
+        self.notified_lock.acquire()
+        for to_uuid in uuid_list:
+            if to_uuid not in self.notified and dht.getAddress(to_uuid) != self.zmq_address:
+                self.notified.add(to_uuid)
+                res.append(to_uuid)
+        self.notified_lock.release()
+        return res
+
+    # agents are closed while the network thread still answers the requests
+    # of the others
+    def terminate(self):
+        self.closing = True
+        futures = list()
+        for agent in self.getAgentList():
+            agent.rpc.terminate()
+            agent.setRunning(False)
+            if agent.close_future:
+                futures.append(agent.close_future)
+        for future in futures:
+            future.result()
+        self.setRunning(False)
+        if self.pid_net:
+            self.pid_net.join()
+        self.executor.shutdown(wait=True)
+        if self.zmq_inproc_address:
+            lts_inproc.unregister(self.zmq_address, self.zmq_inproc_address)
+        self.push_lock.acquire()
+        for push in self.push_list:
+            push.close()
+        self.push_lock.release()
+        for socket in [self.zmq_socket_router, self.zmq_socket_reply, self.zmq_socket_control]:
+            socket.close()
+
+# ------------------------------------------------------------------------------
+
+# incoming calls are run on the executor of the host instead of scheduler
+# threads, at most rpc_max_pending at a time
+
+class LTS_HostedRPC(LTS_RPC):
+
+    def __init__(self, host, rpc_uuid=None, rpc_timeout_sec=10,
+                 communicator=None, rpc_max_pending=None):
+        super().__init__(rpc_uuid=rpc_uuid, rpc_timeout_sec=rpc_timeout_sec,
+                         running=False, communicator=communicator, rpc_workers=0,
+                         rpc_max_pending=rpc_max_pending)
+        self.host = host
+
+
+    def addInstance(self, name, params_json, rpc_uuid=None, from_uuid=None):
+        if name not in self.rpc_local_dict:
+            logging.warning("[RPC] "+self.uuid+" Procedure " + name + " unknown")
+            return True
+        if not self.acquirePending(name, from_uuid):
+            return False
+        rpc_instance = LTS_RPC_Instance(name=name, handler=self.rpc_local_dict[name],
+                                        params_json=params_json,
+                                        rpc_uuid=rpc_uuid, from_uuid=from_uuid)
+        self.host.submit(self.runInstance, rpc_instance)
+        return True
+
+    def runInstance(self, rpc_instance):
+        logging.info("[SCD] "+self.uuid+" Scheduling "+rpc_instance.uuid+" procedure " + rpc_instance.name + " for " + str(rpc_instance.from_uuid))
+        try:
+            super().runInstance(rpc_instance)
+        finally:
+            self.releasePending()
+        if rpc_instance.from_uuid and self.communicator:
+            self.sendResults(rpc_instance)
+
+# ------------------------------------------------------------------------------
+
+# an agent without sockets nor threads of its own, created by
+# LTS_AgentHost.addAgent
+
+class LTS_HostedAgent(LTS_Agent):
+
+    def __init__(self, host, agent_uuid=None, name=None,
+                 zmq_seed_uuid=None, zmq_seed_address=None,
+                 dispatch_handler = None,
+                 broadcast_terminate = True,
+                 zmq_pool_idle_sec = 60,
+                 zmq_broadcast_parallel = True,
+                 zmq_broadcast_deadline_sec = None,
+                 codec = "json",
+                 zmq_compress_threshold = None,
+                 zmq_compressor = None,
+                 inbound_limits = None,
+                 busy_retry_after_ms = 100,
+                 zmq_busy_retries = 2,
+                 zmq_seeds = None,
+                 terminate_deadline_sec = 1,
+                 zmq_breaker_open_sec = 5,
+                 zmq_min_timeout_ms = 1000,
+                 dht_bucket_size = None,
+                 membership = True,
+                 dht_active_size = None,
+                 dht_passive_size = 30,
+                 gossip = False,
+                 dht_snapshot = None,
+                 dht_snapshot_sec = 60,
+                 dsm_capacity = LTS_MEMORY_CAPACITY,
+                 dsm_policy = "lru"):
+
+        LTS_BaseClass.__init__(self, "LTS_HostedAgent")
+        self.uuid = agent_uuid or str(uuid.uuid4())
+        self.name = name or str(self.uuid)
+        self.host = host
+
+        self.dispatch_handler = dispatch_handler
+
+        # no server socket, the host serves the requests
+        self.communicator = LTS_Communicator(self.uuid, self.name,
+                                             None, host.zmq_address,
+                                             zmq_seed_uuid, zmq_seed_address,
+                                             host.zmq_recv_timeout_sec,
+                                             zmq_pool_idle_sec,
+                                             0,
+                                             zmq_broadcast_parallel,
+                                             zmq_broadcast_deadline_sec,
+                                             host.zmq_wire_version,
+                                             codec,
+                                             0,
+                                             64,
+                                             zmq_compress_threshold,
+                                             zmq_compressor,
+                                             host.zmq_inproc,
+                                             zmq_busy_retries,
+                                             zmq_seeds,
+                                             zmq_breaker_open_sec,
+                                             zmq_min_timeout_ms,
+                                             dht_bucket_size,
+                                             dht_active_size,
+                                             dht_passive_size,
+                                             dht_snapshot,
+                                             dht_snapshot_sec)
+        self.communicator.host = host
+
+        self.admission = LTS_Admission(self.uuid, inbound_limits, busy_retry_after_ms)
+
+        self.view = None
+        if dht_active_size:
+            self.view = LTS_PartialView(self.uuid, self.communicator)
+            self.communicator.view = self.view
+            membership = False
+
+        # the protocol rounds are the heartbeats of the host
+        self.membership = None
+        if membership:
+            self.membership = LTS_Membership(self.uuid, self.communicator,
+                                             period_sec=host.heartbeat_timer_sec)
+            self.communicator.membership = self.membership
+
+        # pushes are forwarded on the executor of the host
+        self.gossip = None
+        if gossip:
+            self.gossip = LTS_GossipBroadcast(self.uuid, self.communicator, self.submitMessage,
+                                              submit=host.submit)
+            self.communicator.gossip = self.gossip
+
+        self.dsm = LTS_DSM(dsm_uuid=self.uuid, communicator=self.communicator,
+                           memory_capacity=dsm_capacity, memory_policy=dsm_policy)
+
+        self.rpc = LTS_HostedRPC(host, rpc_uuid=self.uuid, rpc_timeout_sec=host.zmq_recv_timeout_sec,
+                                 communicator=self.communicator,
+                                 rpc_max_pending=self.admission.getLimit("RPC"))
+
+        self.handlers = LTS_HandlerRegistry(self.uuid)
+        self.registerHandlers()
+
+        self.heartbeat_timer_sec = host.heartbeat_timer_sec
+
+        self.broadcast_terminate = broadcast_terminate
+        self.terminate_deadline_sec = terminate_deadline_sec
+
+        self.close_future = None
+
+        self.stopped = threading.Event()
+        self.running_lock = threading.Lock()
+        self.running = True
+
+
+    def setRunning(self, running):
+        self.running_lock.acquire()
+        stopping = self.running and not running
+        self.running = running
+        self.running_lock.release()
+        if running:
+            self.stopped.clear()
+        else:
+            self.stopped.set()
+        if stopping:
+            self.host.removeAgent(self.uuid)
+            self.close_future = self.host.submit(self.close)
+
+    def close(self):
+        self.communicator.saveSnapshot(force=True)
+        if self.membership and not self.host.closing:
+            self.membership.leave()
+        if self.broadcast_terminate:
+            logging.info("[AGT] "+self.uuid+" Agent broadcast terminate")
+            message = LTS_Message(LTS_MessageType.CORE_TERMINATE,
+                                  from_uuid=self.uuid)
+            uuid_list = self.communicator.dht.getUuidList()
+            if self.host.closing:
+                uuid_list = self.host.claimNotify(self.communicator.dht, uuid_list)
+            self.communicator.scatterMessage(message, uuid_list, deadline_ms=self.terminate_deadline_sec * 1000)
+        self.communicator.pool.close()
+        logging.info("[AGT] "+self.uuid+" Agent terminating")
+
+
+    def queueRequest(self, envelope, message):
+        self.host.submit(self.runHostedRequest, envelope, message)
+
+    def runHostedRequest(self, envelope, message):
+        response = self.runRequest(message)
+        if envelope is not None:
+            self.host.reply(envelope + self.communicator.wire.encodeReply(response, message))
+
+    def submitMessage(self, message):
+        handler = self.handlers.get(message.message_type)
+        if handler is None or handler.inline:
+            self.dispatchMessage(message)
+        elif self.admission.admit(message.message_type):
+            self.queueRequest(None, message)
+        else:
+            logging.warning("[AGT] "+self.uuid+" Agent dropping batched message " + str(message.message_type) + " from " + str(message.from_uuid))
+
+    # request of an agent of the same host, on the thread of the requester
+    def serveLocal(self, frames):
+        message = self.communicator.processMessage(frames)
+        handler = self.handlers.get(message.message_type)
+        if handler is None or handler.inline:
+            response = self.dispatchMessage(message)
+        elif self.admission.admit(message.message_type):
+            try:
+                response = self.dispatchMessage(message)
+            finally:
+                self.admission.done(message.message_type)
+        else:
+            response = self.busyMessage(message)
+        return self.communicator.wire.encodeReply(response, message)
+
+
+    def terminate(self):
+        self.rpc.terminate()
+        self.setRunning(False)
+        if self.close_future:
+            self.close_future.result()
+
+
+# ------------------------------------------------------------------------------
+
+
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    host = LTS_AgentHost(zmq_bind="tcp://*:5560", zmq_address="tcp://localhost:5560",
+                         heartbeat_timer_sec=2)
+
+    charles = LTS_Agent(zmq_bind="tcp://*:5555", zmq_address="tcp://localhost:5555")
+    seeds = [(charles.uuid, charles.communicator.zmq_address)]
+
+    agent_list = [host.addAgent(zmq_seeds=seeds) for i in range(100)]
+
+    sleep(6)
+    print(len(charles.communicator.dht.getUuidList()))
+    agent_list[0].communicator.dht.add(agent_list[1].uuid, host.zmq_address)
+    print(agent_list[0].communicator.send(agent_list[1].uuid, "hello").toJSON())
+    print(charles.communicator.send(agent_list[2].uuid, "hello").toJSON())
+
+    host.terminate()
+    charles.terminate()
+
+    exit(0)
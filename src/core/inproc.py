@@ -0,0 +1,81 @@
+import threading
+
+import zmq
+
+from src.core.common import *
+
+# ------------------------------------------------------------------------------
+
+# agents of the same process share a single zmq context, so that they can
+# reach each other over inproc endpoints instead of going through the
+# loopback interface. Each agent keeps its advertised (tcp) address for
+# remote peers and registers the inproc endpoint it is also bound to.
+
+# the default limit of 1023 sockets per context is reached by a few hundred
+# agents, it is raised before the shared context creates its first socket
+
+LTS_ZMQ_MAX_SOCKETS = 65536
+
+lts_zmq_context_lock = threading.Lock()
+lts_zmq_context_ready = False
+
+def lts_zmq_context():
+    global lts_zmq_context_ready
+    lts_zmq_context_lock.acquire()
+    context = zmq.Context.instance()
+    if not lts_zmq_context_ready:
+        context.MAX_SOCKETS = min(LTS_ZMQ_MAX_SOCKETS, context.SOCKET_LIMIT)
+        lts_zmq_context_ready = True
+    lts_zmq_context_lock.release()
+    return context
+
+# ------------------------------------------------------------------------------
+
+class LTS_InprocRegistry(LTS_BaseClass):
+
+    def __init__(self):
+        super().__init__("LTS_InprocRegistry")
+        # advertised address : str -> inproc endpoint : str
+        self.endpoints = dict()
+        self.endpoints_lock = threading.Lock()
+
+
+    def toJSON(self):
+        self.endpoints_lock.acquire()
+        res = json.dumps({"class_name": "LTS_InprocRegistry", "endpoints": self.endpoints})
+        self.endpoints_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def register(self, zmq_address, inproc_address):
+        self.endpoints_lock.acquire()
+        self.endpoints[zmq_address] = inproc_address
+        self.endpoints_lock.release()
+
+    def unregister(self, zmq_address, inproc_address):
+        self.endpoints_lock.acquire()
+        if self.endpoints.get(zmq_address) == inproc_address:
+            del self.endpoints[zmq_address]
+        self.endpoints_lock.release()
+
+    # the inproc endpoint of a local peer, the address itself otherwise
+    def resolve(self, zmq_address):
+        self.endpoints_lock.acquire()
+        res = self.endpoints.get(zmq_address, zmq_address)
+        self.endpoints_lock.release()
+        return res
+
+
+lts_inproc = LTS_InprocRegistry()
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    lts_inproc.register("tcp://localhost:5555", "inproc://lts-alice")
+    print(lts_inproc.resolve("tcp://localhost:5555"))
+    print(lts_inproc.resolve("tcp://localhost:5556"))
+    print(lts_inproc.toJSON())
+
+    exit(0)
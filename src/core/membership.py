@@ -0,0 +1,407 @@
+import math
+import random
+import threading
+
+from time import monotonic
+
+from src.core.common import *
+from src.core.message import *
+from src.core.wire import LTS_WIRE_MEMBER
+
+# ------------------------------------------------------------------------------
+
+# state of a member as seen by the other agents. A member only ever goes from
+# alive to suspect to dead, unless an update with a higher incarnation number
+# brings it back: an agent that learns it is suspected increments its own
+# incarnation and spreads an alive update that overrides the suspicion
+
+LTS_MEMBER_ALIVE = "alive"
+LTS_MEMBER_SUSPECT = "suspect"
+LTS_MEMBER_DEAD = "dead"
+
+class LTS_Member(LTS_BaseClass):
+
+    def __init__(self, uuid, zmq_address, state=LTS_MEMBER_ALIVE, incarnation=0):
+        super().__init__("LTS_Member")
+        self.uuid = uuid
+        self.zmq_address = zmq_address
+        self.state = state
+        self.incarnation = incarnation
+        self.suspect_until = 0
+        self.timestamp_change = monotonic()
+
+    def toDict(self):
+        return {"uuid": self.uuid, "address": self.zmq_address,
+                "state": self.state, "incarnation": self.incarnation}
+
+    def setState(self, state, incarnation):
+        self.state = state
+        self.incarnation = incarnation
+        self.timestamp_change = monotonic()
+
+# ------------------------------------------------------------------------------
+
+# SWIM gossip membership. Every protocol round an agent pings the next member
+# of a shuffled list, when the member does not answer before timeout_ms it
+# asks indirect other members to ping it, and only suspects it when none of
+# them got an answer. A suspect member not refuting the suspicion within
+# suspect_mult * log10(N) rounds is dead and removed from the DHT.
+#
+# Membership changes are not broadcast, the recent ones are piggybacked on
+# the pings and their answers, at most gossip_max per message and each one
+# retransmit_mult * log10(N) times, so that an event reaches the N members in
+# O(log N) rounds. The ping is a DHT_SUBSCRIBE with the updates in its
+# content, older agents ignore them and answer with a plain CORE_ACK. Only
+# peers that know DHT_PING_REQ are asked to probe indirectly.
+
+class LTS_Membership(LTS_BaseClass):
+
+    def __init__(self, membership_uuid, communicator, period_sec=1, timeout_ms=500,
+                 indirect=3, suspect_mult=4, retransmit_mult=3, gossip_max=8,
+                 dead_sec=60, sync_rounds=10):
+        super().__init__("LTS_Membership")
+        self.uuid = membership_uuid
+        self.communicator = communicator
+        self.period_sec = period_sec
+        self.timeout_ms = timeout_ms
+        self.indirect = indirect
+        self.suspect_mult = suspect_mult
+        self.retransmit_mult = retransmit_mult
+        self.gossip_max = gossip_max
+        # dead members are remembered for a while so that late updates
+        # about them do not bring them back
+        self.dead_sec = dead_sec
+        # every sync_rounds rounds the pinged member also sends back the
+        # whole membership, for the updates that did not reach us
+        self.sync_rounds = sync_rounds
+        self.nb_rounds = 0
+
+        self.incarnation = 0
+        self.leaving = False
+
+        # member uuid : str -> LTS_Member, without this agent
+        self.members = dict()
+        self.members_lock = threading.Lock()
+
+        # member uuid : str -> [update : dict, transmissions : int], the last
+        # update about each member waiting to be piggybacked
+        self.updates = dict()
+
+        # round robin over the members, shuffled at each pass
+        self.probe_list = list()
+        self.probe_index = 0
+
+
+    def toJSON(self):
+        self.members_lock.acquire()
+        res = json.dumps({"class_name": "LTS_Membership", "uuid": self.uuid,
+                          "incarnation": self.incarnation,
+                          "members": {key: value.toDict() for key, value in self.members.items()},
+                          "updates": len(self.updates)})
+        self.members_lock.release()
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def getMembers(self, state=LTS_MEMBER_ALIVE):
+        self.members_lock.acquire()
+        res = [key for key, value in self.members.items() if value.state == state]
+        self.members_lock.release()
+        return res
+
+    def getState(self, uuid):
+        res = None
+        self.members_lock.acquire()
+        if uuid in self.members:
+            res = self.members[uuid].state
+        self.members_lock.release()
+        return res
+
+    # the two bounds grow with log10 of the number of members, as in
+    # memberlist, called with the members lock held
+    def getScale(self):
+        return max(1, math.log10(len(self.members) + 1))
+
+    def getSuspectTimeout(self):
+        return self.suspect_mult * self.getScale() * self.period_sec
+
+    def getRetransmitLimit(self):
+        return self.retransmit_mult * int(math.ceil(self.getScale()))
+
+    def selfUpdate(self, state=LTS_MEMBER_ALIVE):
+        return {"uuid": self.uuid, "address": self.communicator.zmq_address,
+                "state": state, "incarnation": self.incarnation}
+
+    def queueUpdate(self, update):
+        self.updates[update['uuid']] = [update, 0]
+
+    # the updates sent the fewest times first
+    def gossip(self):
+        self.members_lock.acquire()
+        limit = self.getRetransmitLimit()
+        pending = sorted(self.updates.values(), key=lambda update: update[1])[:self.gossip_max]
+        res = list()
+        for update in pending:
+            update[1] = update[1] + 1
+            res.append(update[0])
+            if update[1] >= limit:
+                del self.updates[update[0]['uuid']]
+        self.members_lock.release()
+        return res
+
+
+    # apply an update received from a peer, the DHT follows the alive and
+    # dead members. The whole membership sent to a joining agent is not
+    # gossiped again (queue=False)
+    def applyUpdate(self, update, queue=True):
+        uuid = update['uuid']
+        state = update['state']
+        incarnation = update['incarnation']
+        dht_add = False
+        dht_remove = False
+        self.members_lock.acquire()
+        member = self.members.get(uuid)
+        if uuid == self.uuid:
+            # refute the suspicion, or the death when it is not our own leave
+            if state != LTS_MEMBER_ALIVE and incarnation >= self.incarnation and not self.leaving:
+                self.incarnation = incarnation + 1
+                self.queueUpdate(self.selfUpdate())
+                logging.info("[MBR] "+self.uuid+" Agent refuting " + state + " with incarnation " + str(self.incarnation))
+        elif member is None:
+            if state != LTS_MEMBER_DEAD:
+                member = LTS_Member(uuid, update['address'], state, incarnation)
+                if state == LTS_MEMBER_SUSPECT:
+                    member.suspect_until = monotonic() + self.getSuspectTimeout()
+                self.members[uuid] = member
+                if queue:
+                    self.queueUpdate(member.toDict())
+                dht_add = True
+                logging.info("[MBR] "+self.uuid+" Member " + uuid + " joined")
+        elif state == LTS_MEMBER_ALIVE:
+            if incarnation > member.incarnation:
+                revived = member.state == LTS_MEMBER_DEAD
+                member.zmq_address = update['address']
+                member.setState(state, incarnation)
+                self.queueUpdate(member.toDict())
+                dht_add = True
+                if revived:
+                    logging.info("[MBR] "+self.uuid+" Member " + uuid + " joined again")
+        elif state == LTS_MEMBER_SUSPECT:
+            if (member.state == LTS_MEMBER_ALIVE and incarnation >= member.incarnation) or (member.state == LTS_MEMBER_SUSPECT and incarnation > member.incarnation):
+                member.setState(state, incarnation)
+                member.suspect_until = monotonic() + self.getSuspectTimeout()
+                self.queueUpdate(member.toDict())
+                logging.info("[MBR] "+self.uuid+" Member " + uuid + " suspected")
+        elif state == LTS_MEMBER_DEAD:
+            if member.state != LTS_MEMBER_DEAD and incarnation >= member.incarnation:
+                member.setState(state, incarnation)
+                self.queueUpdate(member.toDict())
+                dht_remove = True
+                logging.info("[MBR] "+self.uuid+" Member " + uuid + " dead")
+        self.members_lock.release()
+        if dht_add and not self.communicator.dht.getAddress(uuid):
+            self.communicator.dht.add(uuid, update['address'])
+        if dht_remove:
+            self.communicator.dht.remove(uuid)
+
+    def applyUpdates(self, updates, queue=True):
+        for update in updates or list():
+            self.applyUpdate(update, queue)
+
+    # a peer that contacts us is alive, whatever we knew about it. One
+    # declared dead while it was not gets a higher incarnation than its own
+    # to override the death. Older agents do not send their incarnation
+    def applyContact(self, uuid, zmq_address, incarnation):
+        incarnation = incarnation or 0
+        self.members_lock.acquire()
+        member = self.members.get(uuid)
+        joined = member is None or member.state == LTS_MEMBER_DEAD
+        if member is not None and member.state == LTS_MEMBER_DEAD:
+            incarnation = max(incarnation, member.incarnation + 1)
+        self.members_lock.release()
+        self.applyUpdate({"uuid": uuid, "address": zmq_address,
+                          "state": LTS_MEMBER_ALIVE, "incarnation": incarnation})
+        return joined
+
+
+    def pingContent(self, sync=False):
+        res = {"uuid": self.uuid, "address": self.communicator.zmq_address,
+               "incarnation": self.incarnation, "members": self.gossip()}
+        if sync:
+            res['sync'] = True
+        return res
+
+    def pingMessage(self, to_uuid, sync=False):
+        return LTS_Message(LTS_MessageType.DHT_SUBSCRIBE, self.pingContent(sync),
+                           from_uuid=self.uuid, to_uuid=to_uuid)
+
+    # the updates of the answer are applied, True if the peer answered
+    def processAck(self, uuid, response):
+        if response is None:
+            return False
+        if response.message_type == LTS_MessageType.CORE_RESPONSE:
+            content_json = response.getContentObject() or dict()
+            self.applyUpdates(content_json.get('state'), queue=False)
+            self.applyUpdates(content_json.get('members'))
+        return response.message_type in [LTS_MessageType.CORE_RESPONSE, LTS_MessageType.CORE_ACK]
+
+    def ping(self, uuid, zmq_address, sync=False):
+        results, _ = self.communicator.scatterMessages({uuid: self.pingMessage(uuid, sync)},
+                                                       self.timeout_ms, {uuid: zmq_address},
+                                                       penalize=False)
+        res = self.processAck(uuid, results.get(uuid))
+        # the DHT drops the peers that time out on any other request
+        if res and not self.communicator.dht.getAddress(uuid):
+            self.communicator.dht.add(uuid, zmq_address)
+        return res
+
+    # ask members to ping uuid, True if one of them got an answer
+    def pingIndirect(self, uuid, zmq_address):
+        wire = self.communicator.wire
+        candidates = [key for key in self.getMembers() if key != uuid and wire.getPeerVersion(key) >= LTS_WIRE_MEMBER]
+        candidates = random.sample(candidates, min(self.indirect, len(candidates)))
+        if not candidates:
+            return False
+        messages = dict()
+        addresses = dict()
+        self.members_lock.acquire()
+        for key in candidates:
+            addresses[key] = self.members[key].zmq_address
+        self.members_lock.release()
+        for key in candidates:
+            messages[key] = LTS_Message(LTS_MessageType.DHT_PING_REQ,
+                                        {"uuid": uuid, "address": zmq_address, "timeout_ms": self.timeout_ms,
+                                         "members": self.gossip()},
+                                        from_uuid=self.uuid, to_uuid=key)
+        results, _ = self.communicator.scatterMessages(messages, 2 * self.timeout_ms, addresses,
+                                                       penalize=False)
+        res = False
+        for response in results.values():
+            if response.message_type == LTS_MessageType.CORE_RESPONSE:
+                content_json = response.getContentObject() or dict()
+                self.applyUpdates(content_json.get('members'))
+                res = res or content_json.get('ack', False)
+        if res and not self.communicator.dht.getAddress(uuid):
+            self.communicator.dht.add(uuid, zmq_address)
+        return res
+
+
+    def suspect(self, uuid):
+        self.members_lock.acquire()
+        member = self.members.get(uuid)
+        if member and member.state == LTS_MEMBER_ALIVE:
+            member.setState(LTS_MEMBER_SUSPECT, member.incarnation)
+            member.suspect_until = monotonic() + self.getSuspectTimeout()
+            self.queueUpdate(member.toDict())
+            logging.info("[MBR] "+self.uuid+" Member " + uuid + " not answering, suspected")
+        self.members_lock.release()
+
+    # suspects past their timeout are dead, the dead are forgotten after
+    # dead_sec
+    def expire(self):
+        now = monotonic()
+        dead = list()
+        self.members_lock.acquire()
+        for member in list(self.members.values()):
+            if member.state == LTS_MEMBER_SUSPECT and now >= member.suspect_until:
+                member.setState(LTS_MEMBER_DEAD, member.incarnation)
+                self.queueUpdate(member.toDict())
+                dead.append(member.uuid)
+            elif member.state == LTS_MEMBER_DEAD and now - member.timestamp_change >= self.dead_sec:
+                del self.members[member.uuid]
+        self.members_lock.release()
+        for uuid in dead:
+            logging.info("[MBR] "+self.uuid+" Member " + uuid + " dead")
+            self.communicator.dht.remove(uuid)
+
+    def nextTarget(self):
+        res = None
+        self.members_lock.acquire()
+        while res is None:
+            if self.probe_index >= len(self.probe_list):
+                self.probe_list = [key for key, value in self.members.items() if value.state != LTS_MEMBER_DEAD]
+                random.shuffle(self.probe_list)
+                self.probe_index = 0
+                if not self.probe_list:
+                    break
+            member = self.members.get(self.probe_list[self.probe_index])
+            self.probe_index = self.probe_index + 1
+            if member and member.state != LTS_MEMBER_DEAD:
+                res = (member.uuid, member.zmq_address)
+        self.members_lock.release()
+        return res
+
+    # one protocol round, called every period_sec
+    def probe(self):
+        self.expire()
+        target = self.nextTarget()
+        if target is None:
+            return
+        self.nb_rounds = self.nb_rounds + 1
+        sync = self.sync_rounds and self.nb_rounds % self.sync_rounds == 0
+        if not self.ping(*target, sync) and not self.pingIndirect(*target):
+            self.suspect(target[0])
+
+
+    # tell a few members that we leave, they spread it as a death
+    def leave(self):
+        self.members_lock.acquire()
+        self.leaving = True
+        self.incarnation = self.incarnation + 1
+        self.queueUpdate(self.selfUpdate(LTS_MEMBER_DEAD))
+        self.members_lock.release()
+        members = self.getMembers()
+        members = random.sample(members, min(self.indirect, len(members)))
+        if members:
+            logging.info("[MBR] "+self.uuid+" Agent leaving")
+            self.members_lock.acquire()
+            addresses = {key: self.members[key].zmq_address for key in members}
+            self.members_lock.release()
+            self.communicator.scatterMessages({key: self.pingMessage(key) for key in members},
+                                              self.timeout_ms, addresses)
+
+
+    # DHT_SUBSCRIBE: the subscriber is alive. A joining agent is also sent
+    # the whole membership, as the ones asking for a sync
+    def dispatchPing(self, message):
+        content_json = message.getContentObject()
+        joined = self.applyContact(content_json['uuid'], content_json['address'],
+                                   content_json.get('incarnation'))
+        self.applyUpdates(content_json.get('members'))
+        response = {"members": self.gossip()}
+        if joined or content_json.get('sync'):
+            self.members_lock.acquire()
+            response['state'] = [value.toDict() for value in self.members.values() if value.state != LTS_MEMBER_DEAD and value.uuid != content_json['uuid']]
+            response['state'].append(self.selfUpdate())
+            self.members_lock.release()
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, response,
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+    # DHT_PING_REQ: ping a member on behalf of the sender
+    def dispatchPingReq(self, message):
+        content_json = message.getContentObject()
+        self.applyUpdates(content_json.get('members'))
+        ack = self.ping(content_json['uuid'], content_json['address'])
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, {"ack": ack, "members": self.gossip()},
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    from src.core.communicator import LTS_Communicator
+
+    alice = LTS_Membership("alice", LTS_Communicator("alice", "Alice", zmq_bind=None))
+    bob = LTS_Membership("bob", LTS_Communicator("bob", "Bob", zmq_bind=None,
+                                                 zmq_address="tcp://localhost:5556"))
+    # bob joins through alice, then alice hears that bob is suspected
+    response = alice.dispatchPing(bob.pingMessage("alice"))
+    bob.processAck("alice", response)
+    alice.applyUpdate({"uuid": "bob", "address": "tcp://localhost:5556",
+                       "state": LTS_MEMBER_SUSPECT, "incarnation": 0})
+    bob.applyUpdates(alice.gossip())
+    alice.applyUpdates(bob.gossip())
+    print(alice.toJSON())
+    print(bob.toJSON())
+
+    exit(0)
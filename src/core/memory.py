@@ -1,4 +1,8 @@
 import uuid
+import threading
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 from src.core.common import *
 
@@ -17,53 +21,345 @@ class LTS_Chunk(LTS_BaseClass):
         self.content = content
 
     def fromJSON(self, chunk_str):
-        obj = json.loads(chunk_str)
+        self.fromDict(json.loads(chunk_str))
+
+    def toDict(self):
+        return {"uuid": self.uuid, "agent_uuid": self.agent_uuid,
+                "version": self.version, "content": self.content}
+
+    def fromDict(self, obj):
         self.uuid = obj['uuid']
         self.agent_uuid = obj['agent_uuid']
         self.version = obj['version']
         self.content = obj['content']
 
+    # bytes-like contents travel as a separate message frame instead of
+    # being embedded in the message content
+    def toMessage(self, message):
+        obj = self.toDict()
+        if isinstance(self.content, (bytes, bytearray, memoryview)):
+            obj['content'] = None
+            obj['content_buffer'] = len(message.buffers)
+            message.buffers.append(self.content)
+        message.content = obj
+
+    def fromMessage(self, message):
+        obj = message.getContentObject()
+        self.fromDict(obj)
+        if obj.get('content_buffer') is not None:
+            self.content = message.buffers[obj['content_buffer']]
+
     def copyMetadata(self, chunk):
         self.agent_uuid = chunk.agent_uuid
         self.version = chunk.version
 
+    # bytes taken by the content in memory, its length for bytes and strings
+    # and the length of its JSON encoding otherwise
+    def getSize(self):
+        if self.content is None:
+            return 0
+        if isinstance(self.content, (bytes, bytearray, str)):
+            return len(self.content)
+        if isinstance(self.content, memoryview):
+            return self.content.nbytes
+        return len(json.dumps(self.content))
+
+# ------------------------------------------------------------------------------
+
+# eviction policies order the remote chunks cached in memory, victim() returns
+# the one whose content is dropped first
+
+class LTS_EvictionPolicy(LTS_BaseClass, ABC):
+
+    def __init__(self, name="unknown"):
+        super().__init__("LTS_EvictionPolicy")
+        self.name = name
+
+    # a content is cached
+    @abstractmethod
+    def add(self, uuid):
+        pass
+
+    # a cached content is read
+    @abstractmethod
+    def touch(self, uuid):
+        pass
+
+    # a content is no longer cached, evicted or not
+    @abstractmethod
+    def remove(self, uuid):
+        pass
+
+    @abstractmethod
+    def victim(self):
+        pass
+
+# ------------------------------------------------------------------------------
+
+class LTS_LRUPolicy(LTS_EvictionPolicy):
+
+    def __init__(self):
+        super().__init__("lru")
+        # least recently used first
+        self.entries = OrderedDict()
+
+    def add(self, uuid):
+        self.entries[uuid] = True
+        self.entries.move_to_end(uuid)
+
+    def touch(self, uuid):
+        if uuid in self.entries:
+            self.entries.move_to_end(uuid)
+
+    def remove(self, uuid):
+        self.entries.pop(uuid, None)
+
+    def victim(self):
+        return next(iter(self.entries), None)
+
+# ------------------------------------------------------------------------------
+
+# Adaptive Replacement Cache (Megiddo and Modha): the contents read once (t1)
+# and the ones read again (t2) are kept apart, along with the ghost uuids of
+# the contents evicted from each (b1, b2). A content cached again while it is
+# a ghost of b1 moves the target size p of t1 up, a ghost of b2 moves it down,
+# so that a scan of chunks read once does not evict the ones read often.
+# Memory is counted in bytes, ARC sizes in chunks: the ghost lists keep as
+# many uuids as there are cached contents.
+
+class LTS_ARCPolicy(LTS_EvictionPolicy):
+
+    def __init__(self):
+        super().__init__("arc")
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0
+        # the uuid returned by victim(), ghost once removed
+        self.evicting = None
+
+    def add(self, uuid):
+        size = max(len(self.t1) + len(self.t2), 1)
+        if uuid in self.b1:
+            self.p = min(size, self.p + max(len(self.b2) / len(self.b1), 1))
+            del self.b1[uuid]
+            self.t2[uuid] = True
+        elif uuid in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) / len(self.b2), 1))
+            del self.b2[uuid]
+            self.t2[uuid] = True
+        elif uuid not in self.t1 and uuid not in self.t2:
+            self.t1[uuid] = True
+        else:
+            self.touch(uuid)
+
+    def touch(self, uuid):
+        if uuid in self.t1:
+            del self.t1[uuid]
+            self.t2[uuid] = True
+        elif uuid in self.t2:
+            self.t2.move_to_end(uuid)
+
+    # an evicted content leaves a ghost, a removed one does not
+    def remove(self, uuid):
+        for entries, ghosts in ((self.t1, self.b1), (self.t2, self.b2)):
+            if entries.pop(uuid, None) and uuid == self.evicting:
+                ghosts[uuid] = True
+        while len(self.b1) + len(self.b2) > len(self.t1) + len(self.t2):
+            ghosts = self.b1 if len(self.b1) >= len(self.b2) else self.b2
+            ghosts.popitem(last=False)
+        self.evicting = None
+
+    def victim(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            res = next(iter(self.t1))
+        else:
+            res = next(iter(self.t2), None)
+        self.evicting = res
+        return res
+
 # ------------------------------------------------------------------------------
 
+LTS_EVICTION_POLICIES = {"lru": LTS_LRUPolicy, "arc": LTS_ARCPolicy}
+
+# capacity in bytes of the chunk contents. The chunks owned by the agent are
+# pinned, only the remote contents cached by a read are evicted: their
+# metadata stays in memory and the next read fetches them again from their
+# owner. A chunk owned by the agent is refused when the pinned chunks do not
+# leave room for it.
+
+LTS_MEMORY_CAPACITY = 64 * 1024 * 1024
+
 class LTS_Memory(LTS_BaseClass):
 
-    def __init__(self, memory_uuid=None, capacity = 1, name="main_memory"):
+    def __init__(self, memory_uuid=None, capacity = LTS_MEMORY_CAPACITY, name="main_memory",
+                 policy = "lru"):
         super().__init__("LTS_Memory")
         self.uuid = memory_uuid
         self.name = name
         self.capacity = capacity
         self.memory = dict()
-        logging.info("[MEM] "+self.uuid+" Memory with capacity " + str(self.capacity))
+        # chunk uuid : str -> bytes counted in used
+        self.sizes = dict()
+        self.used = 0
+        self.pinned = 0
+        if isinstance(policy, LTS_EvictionPolicy):
+            self.policy = policy
+        else:
+            if policy not in LTS_EVICTION_POLICIES:
+                logging.warning("[MEM] "+str(self.uuid)+" Eviction policy " + str(policy) + " not available, using lru")
+                policy = "lru"
+            self.policy = LTS_EVICTION_POLICIES[policy]()
+        self.memory_lock = threading.Lock()
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_evictions = 0
+        logging.info("[MEM] "+str(self.uuid)+" Memory with capacity " + str(self.capacity) + " bytes, " + self.policy.name + " eviction")
+
+    def getStats(self):
+        self.memory_lock.acquire()
+        res = {"capacity": self.capacity, "used": self.used, "pinned": self.pinned,
+               "chunks": len(self.memory), "policy": self.policy.name,
+               "hits": self.nb_hits, "misses": self.nb_misses,
+               "evictions": self.nb_evictions}
+        self.memory_lock.release()
+        return res
+
+    def toJSON(self):
+        res = self.getStats()
+        res['class_name'] = "LTS_Memory"
+        res['uuid'] = self.uuid
+        res['name'] = self.name
+        return json.dumps(res, sort_keys=True, indent=4)
+
+
+    def isPinned(self, chunk):
+        return chunk.agent_uuid is not None and chunk.agent_uuid == self.uuid
 
+    # to be called with the memory lock held: stop counting a chunk
+    def release(self, uuid):
+        size = self.sizes.pop(uuid, None)
+        if size is None:
+            return
+        self.used = self.used - size
+        if self.isPinned(self.memory[uuid]):
+            self.pinned = self.pinned - size
+        else:
+            self.policy.remove(uuid)
+
+    # to be called with the memory lock held: drop cached contents until size
+    # more bytes fit, False if the pinned chunks leave no room for them
+    def makeRoom(self, size):
+        while self.used + size > self.capacity:
+            victim = self.policy.victim()
+            if victim is None:
+                return False
+            logging.debug("[MEM] "+str(self.uuid)+" Evicting content of chunk " + victim)
+            self.release(victim)
+            self.memory[victim].content = None
+            self.nb_evictions = self.nb_evictions + 1
+        return True
+
+    # to be called with the memory lock held: count the content of a chunk,
+    # False if it does not fit
+    def account(self, chunk):
+        size = chunk.getSize()
+        if size == 0:
+            return True
+        if not self.makeRoom(size):
+            return False
+        self.sizes[chunk.uuid] = size
+        self.used = self.used + size
+        if self.isPinned(chunk):
+            self.pinned = self.pinned + size
+        else:
+            self.policy.add(chunk.uuid)
+        return True
+
+    # a remote chunk too large is kept without its content, a chunk of the
+    # agent is refused (None) and the previous one kept
     def addChunk(self, chunk):
+        self.memory_lock.acquire()
+        res = self.insert(chunk)
+        self.memory_lock.release()
+        return res
+
+    # to be called with the memory lock held
+    def insert(self, chunk):
+        res = chunk.uuid
+        previous = self.memory.get(chunk.uuid)
+        if previous:
+            self.release(chunk.uuid)
+        self.memory[chunk.uuid] = chunk
+        if not self.account(chunk):
+            if self.isPinned(chunk):
+                logging.warning("[MEM] "+str(self.uuid)+" Memory full, chunk " + chunk.uuid + " refused")
+                del self.memory[chunk.uuid]
+                if previous:
+                    self.memory[chunk.uuid] = previous
+                    self.account(previous)
+                res = None
+            else:
+                chunk.content = None
+        return res
+
+    # a content fetched from its owner, None when an invalidation of a newer
+    # version came first
+    def cacheChunk(self, chunk):
         res = None
-        if len(self.memory) < self.capacity:
-            self.memory[chunk.uuid] = chunk
-            res = chunk.uuid
+        self.memory_lock.acquire()
+        current = self.memory.get(chunk.uuid)
+        if current is None or current.version <= chunk.version:
+            res = self.insert(chunk)
+        self.memory_lock.release()
+        return res
+
+    # drop the content of a remote chunk older than version, its next read
+    # fetches it again. False if there was nothing to drop
+    def invalidateChunk(self, uuid, version):
+        res = False
+        self.memory_lock.acquire()
+        chunk = self.memory.get(uuid)
+        if chunk and not self.isPinned(chunk) and chunk.version < version:
+            self.release(uuid)
+            res = chunk.content is not None
+            chunk.content = None
+            chunk.version = version
+        self.memory_lock.release()
         return res
 
     def getChunk(self, uuid):
-        chunk = None
-        if uuid in self.memory:
-            chunk = self.memory[uuid]
+        return self.memory.get(uuid)
+
+    # getChunk counting a hit when the content is in memory
+    def readChunk(self, uuid):
+        self.memory_lock.acquire()
+        chunk = self.memory.get(uuid)
+        if chunk is not None and chunk.content is not None:
+            self.nb_hits = self.nb_hits + 1
+            if not self.isPinned(chunk):
+                self.policy.touch(uuid)
+        else:
+            self.nb_misses = self.nb_misses + 1
+        self.memory_lock.release()
         return chunk
 
     def getChunkMetadata(self, uuid):
         chunkmd = None
-        if uuid in self.memory:
-            chunk = self.memory[uuid]
+        chunk = self.memory.get(uuid)
+        if chunk:
             chunkmd = LTS_Chunk(uuid)
             chunkmd.copyMetadata(chunk)
         return chunkmd
 
     def removeChunk(self, uuid):
-        chunk = self.getChunk(uuid)
+        self.memory_lock.acquire()
+        chunk = self.memory.get(uuid)
         if chunk:
+            self.release(uuid)
             del self.memory[uuid]
+        self.memory_lock.release()
         return chunk
 
     def firstTouch(self, uuid, agent_uuid, content):
@@ -72,7 +368,7 @@ class LTS_Memory(LTS_BaseClass):
     
     def toString(self):
         res = "LTS_Memory {"
-        for key, chunk in self.memory.items():
+        for key, chunk in list(self.memory.items()):
             res = res + str(key) + ", "
         res = res + "}"
         return res
@@ -97,6 +393,18 @@ if __name__ == "__main__":
     print(memory.toJSON())
     print(memory.toString())
 
+    # 4 remote chunks of 100 bytes fit, the ones read again survive a scan
+    # of chunks read once with arc, not with lru
+    for policy in ("lru", "arc"):
+        cache = LTS_Memory("alice", capacity=400, policy=policy)
+        cache.firstTouch("own", "alice", "x" * 100)
+        for i in range(3):
+            cache.addChunk(LTS_Chunk("hot-" + str(i), "bob", content="x" * 100))
+            cache.readChunk("hot-" + str(i))
+        for i in range(3):
+            cache.addChunk(LTS_Chunk("scan-" + str(i), "bob", content="x" * 100))
+        print(policy, [key for key, chunk in cache.memory.items() if chunk.content is not None], cache.toJSON())
+
     chunk2 = LTS_Chunk()
     chunk2.fromJSON("{\n    \"agent_uuid\": \"1062dd51-d234-426c-9009-cb9b1a67b42f\",\n    \"class_name\": \"LTS_Chunk\",\n    \"content\": \"64\",\n    \"uuid\": \"x\",\n    \"version\": 1\n}")
     print(chunk2.toJSON())
@@ -19,6 +19,17 @@ class LTS_MessageType(str, Enum):
     DSM_CHUNK_GET="DSM_CHUNK_GET"
     RPC_CALL="RPC_CALL"
     RPC_RESULTS="RPC_RESULTS"
+    CORE_BATCH="CORE_BATCH"
+    CORE_BUSY="CORE_BUSY"
+    DHT_PING_REQ="DHT_PING_REQ"
+    DHT_FORWARD_JOIN="DHT_FORWARD_JOIN"
+    DHT_DISCONNECT="DHT_DISCONNECT"
+    DHT_SHUFFLE="DHT_SHUFFLE"
+    GOSSIP_PUSH="GOSSIP_PUSH"
+    GOSSIP_IHAVE="GOSSIP_IHAVE"
+    GOSSIP_GRAFT="GOSSIP_GRAFT"
+    DSM_CHUNK_INVALIDATE="DSM_CHUNK_INVALIDATE"
+    DSM_CHUNK_PUT="DSM_CHUNK_PUT"
 
 # ------------------------------------------------------------------------------
 
@@ -31,6 +42,13 @@ class LTS_Message(LTS_BaseClass):
         self.content = content
         self.from_uuid = from_uuid
         self.to_uuid = to_uuid
+        # wire encoding version used by the sender, see src.core.wire
+        self.wire_version = 0
+        # network coordinate of the sender, see src.core.coordinates
+        self.coordinate = None
+        # raw binary payloads (bytes, memoryview or any buffer) sent as
+        # separate frames next to the content
+        self.buffers = list()
 
     def fromJSON(self, message_str):
         obj = json.loads(message_str)
@@ -38,6 +56,24 @@ class LTS_Message(LTS_BaseClass):
         self.content = obj['content']
         self.from_uuid = obj['from_uuid']
         self.to_uuid = obj['to_uuid']
+        self.wire_version = obj.get('wire_version', 0)
+
+    # core messages may carry structured content (dict, list) that is
+    # encoded by the codec of the agent, user content is a JSON string
+    def getContentObject(self):
+        if isinstance(self.content, (str, bytes)):
+            return json.loads(self.content)
+        return self.content
+
+    def toDict(self):
+        return {"message_type": self.message_type, "content": self.content,
+                "from_uuid": self.from_uuid, "to_uuid": self.to_uuid}
+
+    def fromDict(self, obj):
+        self.message_type = obj['message_type']
+        self.content = obj['content']
+        self.from_uuid = obj['from_uuid']
+        self.to_uuid = obj['to_uuid']
         
 # ------------------------------------------------------------------------------
 
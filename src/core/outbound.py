@@ -0,0 +1,128 @@
+import threading
+
+from time import monotonic
+
+from src.core.common import *
+from src.core.message import *
+from src.core.wire import LTS_WIRE_BATCH
+
+# ------------------------------------------------------------------------------
+
+# per destination queue of messages whose response is not needed (DSM
+# advertisements, DHT subscribes, posted user messages). Messages heading to
+# the same peer within linger_ms are coalesced into a single CORE_BATCH
+# request, a batch is sent earlier once it holds max_batch messages.
+# Peers older than LTS_WIRE_BATCH, which may not know CORE_BATCH, get one
+# request per message.
+
+class LTS_OutboundQueue(LTS_BaseClass):
+
+    def __init__(self, queue_uuid, communicator, linger_ms=5, max_batch=64):
+        super().__init__("LTS_OutboundQueue")
+        self.uuid = queue_uuid
+        self.communicator = communicator
+        self.linger_sec = linger_ms / 1000
+        self.max_batch = max_batch
+
+        # peer uuid : str -> pending messages : list(LTS_Message)
+        self.queues = dict()
+        # peer uuid : str -> flush deadline : float (monotonic)
+        self.deadlines = dict()
+        self.queue_cond = threading.Condition()
+
+        self.nb_posted = 0
+        self.nb_sent = 0
+
+        self.running = True
+        self.pid_out = threading.Thread(target=self.run_out)
+        self.pid_out.start()
+
+
+    def toJSON(self):
+        res = '{"class_name": "LTS_OutboundQueue", "uuid": "'+self.uuid+'", "linger_ms": '+str(int(self.linger_sec * 1000))+', "max_batch": '+str(self.max_batch)+', "posted": '+str(self.nb_posted)+', "sent": '+str(self.nb_sent)+'}'
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def post(self, to_uuid, message):
+        with self.queue_cond:
+            queue = self.queues.setdefault(to_uuid, list())
+            if not queue:
+                self.deadlines[to_uuid] = monotonic() + self.linger_sec
+            queue.append(message)
+            if len(queue) >= self.max_batch or message.buffers:
+                self.deadlines[to_uuid] = 0
+            self.nb_posted = self.nb_posted + 1
+            self.queue_cond.notify()
+
+
+    # to be called with queue_cond held
+    def takeDue(self, flush_all=False):
+        now = monotonic()
+        due = dict()
+        for to_uuid, deadline in list(self.deadlines.items()):
+            if flush_all or deadline <= now:
+                due[to_uuid] = self.queues.pop(to_uuid)
+                del self.deadlines[to_uuid]
+        return due
+
+    def nextTimeout(self):
+        if not self.deadlines:
+            return None
+        return max(0, min(self.deadlines.values()) - monotonic())
+
+
+    def run_out(self):
+        while True:
+            with self.queue_cond:
+                due = self.takeDue(not self.running)
+                while not due and self.running:
+                    self.queue_cond.wait(self.nextTimeout())
+                    due = self.takeDue(not self.running)
+                running = self.running
+            if due:
+                self.flush(due)
+            elif not running:
+                break
+
+
+    def flush(self, due):
+        # rounds of batches, at most one batch per peer and per round
+        rounds = list()
+        singles = list()
+        for to_uuid, messages in due.items():
+            batchable = [message for message in messages if not message.buffers]
+            if len(batchable) > 1 and self.communicator.wire.getPeerVersion(to_uuid) >= LTS_WIRE_BATCH:
+                for i in range(0, len(batchable), self.max_batch):
+                    content = {"messages": [message.toDict() for message in batchable[i:i + self.max_batch]]}
+                    batch = LTS_Message(LTS_MessageType.CORE_BATCH, content=content,
+                                        from_uuid=self.uuid, to_uuid=to_uuid)
+                    if len(rounds) <= i // self.max_batch:
+                        rounds.append(dict())
+                    rounds[i // self.max_batch][to_uuid] = batch
+                singles.extend([(to_uuid, message) for message in messages if message.buffers])
+            else:
+                singles.extend([(to_uuid, message) for message in messages])
+
+        for batches in rounds:
+            self.communicator.scatterMessages(batches)
+        for to_uuid, message in singles:
+            self.communicator.sendMessage(to_uuid, message)
+
+        with self.queue_cond:
+            self.nb_sent = self.nb_sent + sum([len(batches) for batches in rounds]) + len(singles)
+
+
+    # send what is left and stop the flushing thread
+    def terminate(self):
+        with self.queue_cond:
+            self.running = False
+            self.queue_cond.notify()
+        self.pid_out.join()
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    exit(0)
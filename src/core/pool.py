@@ -0,0 +1,145 @@
+import zmq
+import threading
+
+from time import monotonic
+
+from src.core.common import *
+
+# ------------------------------------------------------------------------------
+
+class LTS_PoolEntry(LTS_BaseClass):
+
+    def __init__(self, socket, zmq_address):
+        super().__init__("LTS_PoolEntry")
+        self.socket = socket
+        self.zmq_address = zmq_address
+        self.last_used = monotonic()
+
+# ------------------------------------------------------------------------------
+
+# long-lived outbound REQ sockets, keyed by peer uuid
+# a socket is checked out by a single thread for a full request/reply
+# exchange and checked back in afterwards, so that concurrent senders to
+# the same peer each get their own socket
+
+class LTS_ConnectionPool(LTS_BaseClass):
+
+    def __init__(self, pool_uuid, zmq_context, socket_type=zmq.REQ,
+                 max_idle_per_peer=4, idle_timeout_sec=60):
+        super().__init__("LTS_ConnectionPool")
+        self.uuid = pool_uuid
+        self.zmq_context = zmq_context
+        self.socket_type = socket_type
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle_timeout_sec = idle_timeout_sec
+
+        # peer uuid : str -> idle sockets : list(LTS_PoolEntry)
+        self.pool = dict()
+        self.pool_lock = threading.Lock()
+
+        self.nb_created = 0
+        self.nb_reused = 0
+        self.nb_discarded = 0
+
+
+    def toJSON(self):
+        res = '{"class_name": "LTS_ConnectionPool", "uuid": "'+self.uuid+'", "peers": '+str(len(self.pool))+', "created": '+str(self.nb_created)+', "reused": '+str(self.nb_reused)+', "discarded": '+str(self.nb_discarded)+'}'
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    def createSocket(self, zmq_address):
+        socket = self.zmq_context.socket(self.socket_type)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(zmq_address)
+        return LTS_PoolEntry(socket, zmq_address)
+
+    def acquire(self, uuid, zmq_address):
+        entry = None
+        stale = list()
+        self.pool_lock.acquire()
+        if uuid in self.pool:
+            idle = self.pool[uuid]
+            while idle and entry is None:
+                candidate = idle.pop()
+                if candidate.zmq_address == zmq_address:
+                    entry = candidate
+                else:
+                    # the peer came back with another address
+                    stale.append(candidate)
+            if not idle:
+                del self.pool[uuid]
+        if entry:
+            self.nb_reused = self.nb_reused + 1
+        else:
+            self.nb_created = self.nb_created + 1
+        self.pool_lock.release()
+        self.closeEntries(stale)
+        return entry or self.createSocket(zmq_address)
+
+    def release(self, uuid, entry):
+        entry.last_used = monotonic()
+        discard = None
+        self.pool_lock.acquire()
+        idle = self.pool.setdefault(uuid, list())
+        if len(idle) < self.max_idle_per_peer:
+            idle.append(entry)
+        else:
+            discard = entry
+        self.pool_lock.release()
+        if discard:
+            self.closeEntries([discard])
+
+    # a REQ socket that timed out is stuck waiting for a reply that may
+    # never come, it cannot be reused and is closed without lingering
+    def discard(self, uuid, entry):
+        self.closeEntries([entry])
+
+    def evict(self, uuid):
+        self.pool_lock.acquire()
+        entries = self.pool.pop(uuid, list())
+        self.pool_lock.release()
+        if entries:
+            logging.info("[POL] "+self.uuid+" Evicting " + str(len(entries)) + " connection(s) to " + uuid)
+        self.closeEntries(entries)
+
+    def evictIdle(self, idle_timeout_sec=None):
+        timeout = self.idle_timeout_sec if idle_timeout_sec is None else idle_timeout_sec
+        limit = monotonic() - timeout
+        entries = list()
+        self.pool_lock.acquire()
+        for uuid in list(self.pool.keys()):
+            idle = self.pool[uuid]
+            keep = [entry for entry in idle if entry.last_used >= limit]
+            entries.extend([entry for entry in idle if entry.last_used < limit])
+            if keep:
+                self.pool[uuid] = keep
+            else:
+                del self.pool[uuid]
+        self.pool_lock.release()
+        self.closeEntries(entries)
+        return len(entries)
+
+    def closeEntries(self, entries):
+        for entry in entries:
+            entry.socket.close(linger=0)
+        if entries:
+            self.pool_lock.acquire()
+            self.nb_discarded = self.nb_discarded + len(entries)
+            self.pool_lock.release()
+
+    def close(self):
+        self.pool_lock.acquire()
+        entries = list()
+        for idle in self.pool.values():
+            entries.extend(idle)
+        self.pool = dict()
+        self.pool_lock.release()
+        self.closeEntries(entries)
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    exit(0)
@@ -38,7 +38,7 @@ class LTS_RPC_Instance(LTS_BaseClass):
 class LTS_RPC(LTS_BaseClass):
 
     def __init__(self, rpc_uuid=None, rpc_timeout_sec=10, running=True,
-                 communicator=None):
+                 communicator=None, rpc_workers=4, rpc_max_pending=None):
 
         super().__init__("LTS_RPC")
         self.uuid = rpc_uuid or str(uuid.uuid4())
@@ -57,6 +57,14 @@ class LTS_RPC(LTS_BaseClass):
         self.rpc_local_dict = dict()
 
         # manage incoming and outgoing RPC : Queue(LTS_RPC_Instance)
+        # incoming RPC are run by rpc_workers threads, calls are rejected
+        # once rpc_max_pending of them are waiting or running (None for no
+        # bound). The queues are not bounded so that the None sentinels put
+        # by terminate never block
+        self.rpc_workers = rpc_workers
+        self.rpc_max_pending = rpc_max_pending
+        self.nb_pending = 0
+        self.pending_lock = threading.Lock()
         self.rpc_queue_in = queue.Queue()
         self.rpc_queue_out = queue.Queue()
 
@@ -65,15 +73,17 @@ class LTS_RPC(LTS_BaseClass):
         # get result json from RPC request uuid
         self.rpc_result_dict = dict()
 
-        self.pid_sch = None
+        self.pid_sch_list = list()
         self.pid_rsp = None
 
         self.running_lock = threading.Lock()
         self.setRunning(running)
 
         if self.getRunning():
-            self.pid_sch = threading.Thread(target=self.run_sch)
-            self.pid_sch.start()
+            for i in range(self.rpc_workers):
+                pid_sch = threading.Thread(target=self.run_sch)
+                pid_sch.start()
+                self.pid_sch_list.append(pid_sch)
             self.pid_rsp = threading.Thread(target=self.run_rsp)
             self.pid_rsp.start()
 
@@ -109,52 +119,133 @@ class LTS_RPC(LTS_BaseClass):
             self.rpc_remote_dict[name] = peer_list
 
 
+    # the queues are closed by a None sentinel put by terminate
     def run_sch(self):
         logging.info("[SCD] "+self.uuid+" RPC scheduler running")
-        while self.getRunning():
+        while True:
+            rpc_instance = self.rpc_queue_in.get()
+            if rpc_instance is None:
+                break
+            logging.info("[SCD] "+self.uuid+" Scheduling "+rpc_instance.uuid+" procedure " + rpc_instance.name + " for " + str(rpc_instance.from_uuid))
             try:
-                rpc_instance = self.rpc_queue_in.get(timeout=self.rpc_timeout_sec)
-            except queue.Empty:
-                rpc_instance = None
-            if rpc_instance:
-                logging.info("[SCD] "+self.uuid+" Scheduling "+rpc_instance.uuid+" procedure " + rpc_instance.name + " for " + str(rpc_instance.from_uuid))
-                pid_inst = threading.Thread(target=rpc_instance.call)
-                pid_inst.start()
+                self.runInstance(rpc_instance)
+            finally:
+                self.releasePending()
 
         logging.info("[SCD] "+self.uuid+" RPC scheduler terminating")
 
     def run_rsp(self):
         logging.info("[RSP] "+self.uuid+" RPC response running")
-        while self.getRunning():
+        while True:
+            rpc_instance = self.rpc_queue_out.get()
+            if rpc_instance is None:
+                break
             try:
-                rpc_instance = self.rpc_queue_out.get(timeout=self.rpc_timeout_sec)
-            except queue.Empty:
-                rpc_instance = None
-            if rpc_instance:
-                if rpc_instance.from_uuid and self.communicator:
-                    logging.info("[RSP] "+self.uuid+" Sending back results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " to " + str(rpc_instance.from_uuid))
-                    content = '{"rpc_uuid" : "'+rpc_instance.uuid+'", "procedure" : "'+rpc_instance.name+'", "results" : '+str(rpc_instance.results_json)+'}'
-                    message = LTS_Message(LTS_MessageType.RPC_RESULTS, content=content,
-                                          from_uuid=self.uuid, to_uuid=rpc_instance.from_uuid)
-                    self.communicator.sendMessage(rpc_instance.from_uuid, message)
-                else:
-                    logging.warning("[RSP] "+self.uuid+" Discarding results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " (unable to send back)")
+                self.sendResults(rpc_instance)
+            except Exception:
+                logging.exception("[RSP] "+self.uuid+" Sending back results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " failed")
 
         logging.info("[RSP] "+self.uuid+" RPC response terminating")
-        
 
+    # a handler that raises answers empty results, the caller is not left
+    # waiting for its timeout
+    def runInstance(self, rpc_instance):
+        try:
+            rpc_instance.call()
+        except Exception:
+            logging.exception("[SCD] "+self.uuid+" Procedure " + rpc_instance.name + " "+rpc_instance.uuid+" failed")
+            rpc_instance.results_json = "{}"
+            if rpc_instance.rpc_obj:
+                rpc_instance.rpc_obj.rpc_queue_out.put(rpc_instance)
+
+    def sendResults(self, rpc_instance):
+        if rpc_instance.from_uuid and self.communicator:
+            logging.info("[RSP] "+self.uuid+" Sending back results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " to " + str(rpc_instance.from_uuid))
+            message = self.resultsMessage(rpc_instance)
+            self.communicator.sendMessage(rpc_instance.from_uuid, message)
+        else:
+            logging.warning("[RSP] "+self.uuid+" Discarding results "+rpc_instance.uuid+" procedure " + rpc_instance.name + " (unable to send back)")
+
+
+    # a call waiting or running, False when rpc_max_pending are already
+    def acquirePending(self, name, from_uuid):
+        self.pending_lock.acquire()
+        res = self.rpc_max_pending is None or self.nb_pending < self.rpc_max_pending
+        if res:
+            self.nb_pending = self.nb_pending + 1
+        self.pending_lock.release()
+        if not res:
+            logging.warning("[RPC] "+self.uuid+" Rejecting procedure " + name + " for " + str(from_uuid) + ", " + str(self.rpc_max_pending) + " calls pending")
+        return res
+
+    def releasePending(self):
+        self.pending_lock.acquire()
+        self.nb_pending = self.nb_pending - 1
+        self.pending_lock.release()
+
+
+    # returns False when the call is rejected because too many are pending
     def addInstance(self, name, params_json, rpc_uuid=None, from_uuid=None):
+        res = True
         if name in self.rpc_local_dict:
-            rpc_instance = LTS_RPC_Instance(name=name, rpc_obj=self,
-                                            handler=self.rpc_local_dict[name],
-                                            params_json=params_json,
-                                            rpc_uuid=rpc_uuid,
-                                            from_uuid=from_uuid)
-            self.rpc_queue_in.put(rpc_instance)
+            res = self.acquirePending(name, from_uuid)
+            if res:
+                rpc_instance = LTS_RPC_Instance(name=name, rpc_obj=self,
+                                                handler=self.rpc_local_dict[name],
+                                                params_json=params_json,
+                                                rpc_uuid=rpc_uuid,
+                                                from_uuid=from_uuid)
+                self.rpc_queue_in.put(rpc_instance)
         else:
             logging.warning("[RPC] "+self.uuid+" Procedure " + name + " unknown")
+        return res
 
 
+    def callMessage(self, rpc_uuid, name, params_json, to_uuid):
+        content = {"rpc_uuid": rpc_uuid, "procedure": name,
+                   "parameters": json.loads(params_json)}
+        return LTS_Message(LTS_MessageType.RPC_CALL, content=content,
+                           from_uuid=self.uuid, to_uuid=to_uuid)
+
+    # results that are not JSON are sent back empty
+    def resultsMessage(self, rpc_instance):
+        try:
+            results = json.loads(rpc_instance.results_json)
+        except (TypeError, ValueError):
+            logging.warning("[RSP] "+self.uuid+" Procedure " + rpc_instance.name + " "+rpc_instance.uuid+" returned invalid results")
+            results = {}
+        content = {"rpc_uuid": rpc_instance.uuid, "procedure": rpc_instance.name,
+                   "results": results}
+        return LTS_Message(LTS_MessageType.RPC_RESULTS, content=content,
+                           from_uuid=self.uuid, to_uuid=rpc_instance.from_uuid)
+
+
+    # peers providing the procedure, the ones that did not ask us to back off
+    # first, then by smoothed latency, or the latency estimated from their
+    # coordinate when not measured yet. Peers whose latency is not known at
+    # all come first in random order so that they get measured. Peers whose
+    # breaker is open are skipped unless none is left
+    def choosePeers(self, name):
+        uuid_list = list(self.rpc_remote_dict[name])
+        random.shuffle(uuid_list)
+        uuid_list = [to_uuid for to_uuid in uuid_list if self.communicator.breaker.available(to_uuid)] or uuid_list
+        return sorted(uuid_list, key=lambda to_uuid: (self.communicator.backoff.getDelay(to_uuid), self.communicator.dht.getEstimate(to_uuid) or 0))
+
+    # try each peer once, then wait for the first one if all are busy
+    def callRemote(self, rpc_uuid, name, params_json):
+        uuid_list = self.choosePeers(name)
+        for to_uuid in uuid_list:
+            message = self.callMessage(rpc_uuid, name, params_json, to_uuid)
+            response = self.communicator.sendMessage(to_uuid, message, busy_retries=0)
+            if response.message_type != LTS_MessageType.CORE_BUSY:
+                return response
+        message = self.callMessage(rpc_uuid, name, params_json, uuid_list[0])
+        return self.communicator.sendMessage(uuid_list[0], message)
+
+
+    # a remote call without results after rpc_timeout_sec returns "{}" like a
+    # refused one, so that a callee that died after accepting the call does
+    # not block the caller
     def call(self, name, params_json="{}"):
         logging.info("[RPC] "+self.uuid+" Call procedure " + name)
         results_json = "{}"
@@ -162,19 +253,17 @@ class LTS_RPC(LTS_BaseClass):
             results_json = json.loads(self.rpc_local_dict[name](params_json))
         elif name in self.rpc_remote_dict:
             rpc_uuid = str(uuid.uuid4())
-            uuid_list = self.rpc_remote_dict[name]
-            to_uuid = random.choice(uuid_list)
-            content = '{"rpc_uuid" : "'+rpc_uuid+'", "procedure" : "'+name+'", "parameters" : '+params_json+'}'
-            message = LTS_Message(LTS_MessageType.RPC_CALL, content=content,
-                                  from_uuid=self.uuid, to_uuid=to_uuid)
-            self.communicator.sendMessage(to_uuid, message)
-            self.rpc_sync_dict[rpc_uuid] = threading.Condition()
-            with self.rpc_sync_dict[rpc_uuid]:
-                self.rpc_sync_dict[rpc_uuid].wait()
-            if rpc_uuid in self.rpc_result_dict:
-                results_json = self.rpc_result_dict[rpc_uuid]
-                del self.rpc_result_dict[rpc_uuid]
-            del self.rpc_sync_dict[rpc_uuid]
+            sync = threading.Condition()
+            self.rpc_sync_dict[rpc_uuid] = sync
+            response = self.callRemote(rpc_uuid, name, params_json)
+            with sync:
+                if response.message_type == LTS_MessageType.CORE_ACK:
+                    if not sync.wait_for(lambda: rpc_uuid in self.rpc_result_dict, timeout=self.rpc_timeout_sec):
+                        logging.warning("[RPC] "+self.uuid+" Procedure " + name + " no results after " + str(self.rpc_timeout_sec) + "s")
+                else:
+                    logging.warning("[RPC] "+self.uuid+" Procedure " + name + " not accepted (" + str(response.message_type) + ")")
+                del self.rpc_sync_dict[rpc_uuid]
+                results_json = self.rpc_result_dict.pop(rpc_uuid, results_json)
 
         return results_json
 
@@ -182,16 +271,29 @@ class LTS_RPC(LTS_BaseClass):
     def result(self, content_json):
         rpc_uuid = content_json['rpc_uuid']
         results_json = content_json['results']
-        self.rpc_result_dict[rpc_uuid] = results_json
-        if rpc_uuid in self.rpc_sync_dict:
-            with self.rpc_sync_dict[rpc_uuid]:
-                self.rpc_sync_dict[rpc_uuid].notifyAll()
+        sync = self.rpc_sync_dict.get(rpc_uuid)
+        if sync:
+            with sync:
+                # the caller may have given up in the meantime
+                if rpc_uuid in self.rpc_sync_dict:
+                    self.rpc_result_dict[rpc_uuid] = results_json
+                    sync.notify_all()
 
 
+    # results of the calls already running are still sent back, may be
+    # called several times
     def terminate(self):
-        self.setRunning(False)
-        self.pid_sch.join()
-        self.pid_rsp.join()
+        self.running_lock.acquire()
+        running = self.running
+        self.running = False
+        self.running_lock.release()
+        if running:
+            for pid_sch in self.pid_sch_list:
+                self.rpc_queue_in.put(None)
+            for pid_sch in self.pid_sch_list:
+                pid_sch.join()
+            self.rpc_queue_out.put(None)
+            self.pid_rsp.join()
         
 
 
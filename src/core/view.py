@@ -0,0 +1,284 @@
+import random
+import threading
+
+from src.core.common import *
+from src.core.message import *
+from src.core.wire import LTS_WIRE_VIEW
+
+# ------------------------------------------------------------------------------
+
+# HyParView overlay maintenance over an LTS_PartialViewDHT. Active views are
+# symmetric: a peer only enters the active view of an agent through a
+# subscribe it accepted or a join walk that ended on it, and a peer pushed out
+# of it is told with DHT_DISCONNECT.
+#
+#   join      the new agent subscribes to its seeds, each seed adds it to its
+#             active view and answers with its other active peers. From
+#             each of them the new agent follows a DHT_FORWARD_JOIN random
+#             walk of active_walk hops, the peer at passive_walk hops left
+#             adds it to its passive view and the last one to its active view
+#   repair    every heartbeat an active view that is not full subscribes to
+#             random passive peers, a passive peer only refuses a subscribe
+#             without priority when its own active view is full. An agent
+#             with an empty active view subscribes with priority
+#   shuffle   every heartbeat an agent follows a DHT_SHUFFLE random walk of
+#             shuffle_walk hops with some of its active and passive peers,
+#             the last peer answers with as many of its passive peers and both
+#             keep the peers received in their passive view
+#
+# As in DHT_SEARCH_PEER lookups, the random walks are driven by the agent that
+# starts them: each hop only answers with the next one, so that the handlers
+# never wait for another peer. The peers evicted from the active view by a
+# handler are told on the next heartbeat.
+
+class LTS_PartialView(LTS_BaseClass):
+
+    def __init__(self, view_uuid, communicator, active_walk=6, passive_walk=3,
+                 shuffle_active=3, shuffle_passive=4, shuffle_walk=3,
+                 timeout_ms=1000):
+        super().__init__("LTS_PartialView")
+        self.uuid = view_uuid
+        self.communicator = communicator
+        self.dht = communicator.dht
+        self.active_walk = active_walk
+        self.passive_walk = passive_walk
+        self.shuffle_active = shuffle_active
+        self.shuffle_passive = shuffle_passive
+        self.shuffle_walk = shuffle_walk
+        self.timeout_ms = timeout_ms
+
+        # (uuid, address) of the peers moved to the passive view and not
+        # told yet
+        self.evicted = list()
+        self.evicted_lock = threading.Lock()
+
+
+    def toJSON(self):
+        res = json.dumps({"class_name": "LTS_PartialView", "uuid": self.uuid,
+                          "active": self.dht.getUuidList(),
+                          "passive": [key for key, _ in self.dht.getPassive(self.dht.passive_size)]})
+        return json.dumps(json.loads(res), sort_keys=True, indent=4)
+
+
+    # the response of a peer that may not be in the DHT, None if it did not
+    # answer
+    def request(self, uuid, zmq_address, message):
+        if zmq_address is None:
+            return None
+        results, _ = self.communicator.scatterMessages({uuid: message}, self.timeout_ms,
+                                                       {uuid: zmq_address})
+        return results.get(uuid)
+
+    # active peers that know the messages of the partial view : list((uuid, address))
+    def getViewPeers(self, avoid):
+        wire = self.communicator.wire
+        res = list()
+        for key in self.dht.getUuidList():
+            zmq_address = self.dht.getAddress(key)
+            if key not in avoid and zmq_address and wire.getPeerVersion(key) >= LTS_WIRE_VIEW:
+                res.append((key, zmq_address))
+        return res
+
+    def peerList(self, peers):
+        return [{"uuid": key, "address": zmq_address} for key, zmq_address in peers]
+
+    def subscribeMessage(self, to_uuid, kind="join", priority=False):
+        return LTS_Message(LTS_MessageType.DHT_SUBSCRIBE,
+                           {"uuid": self.uuid, "address": self.communicator.zmq_address,
+                            "view": kind, "priority": priority},
+                           from_uuid=self.uuid, to_uuid=to_uuid)
+
+    # older agents accept any subscribe with a plain CORE_ACK
+    def isAccepted(self, response):
+        if response is None or response.message_type == LTS_MessageType.CORE_NONE:
+            return False
+        if response.message_type == LTS_MessageType.CORE_RESPONSE:
+            return (response.getContentObject() or dict()).get('accept', True)
+        return response.message_type == LTS_MessageType.CORE_ACK
+
+    def addActive(self, uuid, zmq_address):
+        evicted = self.dht.addActive(uuid, zmq_address)
+        if evicted:
+            logging.info("[VIW] "+self.uuid+" Agent moving " + evicted[0] + " to the passive view")
+            self.evicted_lock.acquire()
+            self.evicted.append(evicted)
+            self.evicted_lock.release()
+
+    def disconnect(self):
+        self.evicted_lock.acquire()
+        evicted = self.evicted
+        self.evicted = list()
+        self.evicted_lock.release()
+        messages = dict()
+        addresses = dict()
+        for uuid, zmq_address in evicted:
+            if not self.dht.getAddress(uuid) and self.communicator.wire.getPeerVersion(uuid) >= LTS_WIRE_VIEW:
+                messages[uuid] = LTS_Message(LTS_MessageType.DHT_DISCONNECT,
+                                             from_uuid=self.uuid, to_uuid=uuid)
+                addresses[uuid] = zmq_address
+        if messages:
+            self.communicator.scatterMessages(messages, self.timeout_ms, addresses)
+
+    # ask a peer to be in our active view, True if it accepted
+    def neighbor(self, uuid, zmq_address, priority=False):
+        response = self.request(uuid, zmq_address, self.subscribeMessage(uuid, "neighbor", priority))
+        if self.isAccepted(response):
+            self.addActive(uuid, zmq_address)
+            return True
+        if response is None:
+            self.dht.removePassive(uuid)
+        return False
+
+
+    # answer of a seed to the join subscribe of bootstrap()
+    def join(self, seed_uuid, seed_address, response):
+        if not self.isAccepted(response):
+            return
+        self.addActive(seed_uuid, seed_address)
+        if response.message_type == LTS_MessageType.CORE_RESPONSE:
+            for peer in response.getContentObject().get('walks', list()):
+                self.walkJoin(peer['uuid'], peer['address'], seed_uuid)
+        self.disconnect()
+
+    def walkJoin(self, uuid, zmq_address, previous_uuid):
+        ttl = self.active_walk
+        while uuid and uuid != self.uuid:
+            message = LTS_Message(LTS_MessageType.DHT_FORWARD_JOIN,
+                                  {"uuid": self.uuid, "address": self.communicator.zmq_address,
+                                   "ttl": ttl, "previous": previous_uuid},
+                                  from_uuid=self.uuid, to_uuid=uuid)
+            response = self.request(uuid, zmq_address, message)
+            if response is None or response.message_type != LTS_MessageType.CORE_RESPONSE:
+                break
+            content_json = response.getContentObject()
+            if content_json.get('accept'):
+                self.addActive(uuid, zmq_address)
+                break
+            previous_uuid = uuid
+            uuid = content_json['next']['uuid']
+            zmq_address = content_json['next']['address']
+            ttl = ttl - 1
+
+    # fill the active view from the passive one, then shuffle
+    def maintain(self):
+        tries = self.dht.active_size - self.dht.getActiveCount()
+        for uuid, zmq_address in self.dht.getPassive(max(tries, 0)):
+            priority = self.dht.getActiveCount() == 0
+            if self.neighbor(uuid, zmq_address, priority):
+                logging.info("[VIW] "+self.uuid+" Agent " + uuid + " promoted to the active view")
+        self.shuffle()
+        self.disconnect()
+
+    def shuffle(self):
+        peers = self.getViewPeers(list())
+        if not peers:
+            return
+        sample = [(self.uuid, self.communicator.zmq_address)]
+        sample.extend(random.sample(peers, min(self.shuffle_active, len(peers))))
+        sample.extend(self.dht.getPassive(self.shuffle_passive))
+        uuid, zmq_address = random.choice(peers)
+        previous_uuid = self.uuid
+        ttl = self.shuffle_walk
+        for hop in range(self.shuffle_walk + 1):
+            message = LTS_Message(LTS_MessageType.DHT_SHUFFLE,
+                                  {"ttl": ttl, "previous": previous_uuid, "peers": self.peerList(sample)},
+                                  from_uuid=self.uuid, to_uuid=uuid)
+            response = self.request(uuid, zmq_address, message)
+            if response is None or response.message_type != LTS_MessageType.CORE_RESPONSE:
+                break
+            content_json = response.getContentObject()
+            if 'next' not in content_json:
+                for peer in content_json.get('peers', list()):
+                    self.dht.addPassive(peer['uuid'], peer['address'])
+                break
+            previous_uuid = uuid
+            uuid = content_json['next']['uuid']
+            zmq_address = content_json['next']['address']
+            ttl = ttl - 1
+
+
+    # DHT_SUBSCRIBE
+    def dispatchSubscribe(self, message):
+        content_json = message.getContentObject()
+        uuid = content_json['uuid']
+        zmq_address = content_json['address']
+        kind = content_json.get('view')
+        response = {"accept": True}
+        if kind == "join":
+            logging.info("[VIW] "+self.uuid+" Agent " + uuid + " joining")
+            self.addActive(uuid, zmq_address)
+            response['walks'] = self.peerList(self.getViewPeers([uuid]))
+        elif kind == "neighbor":
+            response['accept'] = content_json.get('priority') or self.dht.getAddress(uuid) is not None or not self.dht.isFull()
+            if response['accept']:
+                self.addActive(uuid, zmq_address)
+            else:
+                self.dht.addPassive(uuid, zmq_address)
+        else:
+            self.dht.add(uuid, zmq_address)
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, response,
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+    # DHT_FORWARD_JOIN: the next hop of the walk, or accept the joining agent
+    # at the end of it
+    def dispatchForwardJoin(self, message):
+        content_json = message.getContentObject()
+        uuid = content_json['uuid']
+        ttl = content_json['ttl']
+        peers = self.getViewPeers([uuid, content_json.get('previous')])
+        response = {"accept": True}
+        if ttl <= 0 or not peers or self.dht.getAddress(uuid):
+            self.addActive(uuid, content_json['address'])
+        else:
+            if ttl == self.passive_walk:
+                self.dht.addPassive(uuid, content_json['address'])
+            response = {"next": self.peerList([random.choice(peers)])[0]}
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, response,
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+    # DHT_DISCONNECT: the sender moved us to its passive view
+    def dispatchDisconnect(self, message):
+        zmq_address = self.dht.getAddress(message.from_uuid)
+        if zmq_address:
+            self.dht.remove(message.from_uuid)
+            self.dht.addPassive(message.from_uuid, zmq_address)
+
+    # DHT_SHUFFLE: the next hop of the walk, or a sample of the passive view
+    # at the end of it
+    def dispatchShuffle(self, message):
+        content_json = message.getContentObject()
+        ttl = content_json['ttl']
+        peers = self.getViewPeers([message.from_uuid, content_json.get('previous')])
+        if ttl > 0 and peers:
+            response = {"next": self.peerList([random.choice(peers)])[0]}
+        else:
+            sample = self.dht.getPassive(len(content_json['peers']))
+            for peer in content_json['peers']:
+                self.dht.addPassive(peer['uuid'], peer['address'])
+            response = {"peers": self.peerList(sample)}
+        return LTS_Message(LTS_MessageType.CORE_RESPONSE, response,
+                           from_uuid=self.uuid, to_uuid=message.from_uuid)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    from time import sleep
+    from src.core.agents import LTS_Agent
+
+    agent_list = list()
+    for i in range(12):
+        seed = agent_list[random.randrange(i)] if i else None
+        agent_list.append(LTS_Agent(zmq_bind="inproc://view-" + str(i), zmq_address="inproc://view-" + str(i),
+                                    zmq_seed_uuid=seed.uuid if seed else None,
+                                    zmq_seed_address=seed.communicator.zmq_address if seed else None,
+                                    heartbeat_timer_sec=1, dht_active_size=3, dht_passive_size=6,
+                                    broadcast_terminate=False))
+    sleep(4)
+    for agent in agent_list:
+        print(agent.uuid, agent.view.toJSON())
+    for agent in agent_list:
+        agent.terminate()
+
+    exit(0)
@@ -0,0 +1,403 @@
+import zmq
+import base64
+import struct
+import threading
+
+from src.core.common import *
+from src.core.message import *
+from src.core.codec import lts_codecs, lts_compressors, LTS_CODEC_TEXT, LTS_COMPRESS_NONE
+
+# ------------------------------------------------------------------------------
+
+# wire version 0 is the legacy encoding: a single frame holding the message
+# as JSON. Version 1 sends a ZMQ multipart message made of a small binary
+# header frame followed by the content as an opaque payload frame:
+#
+#   header : magic (2s) version (B) flags (B) type (B) from_len (H) to_len (H)
+#            followed by the from and to uuids (utf-8)
+#   payload: content, utf-8 text or structured content encoded by a codec
+#   buffers: zero or more raw binary frames (LTS_Message.buffers), sent and
+#            received without copy and exposed as memoryviews
+#
+#   flags  : bit 0 no content, bits 1-3 code of the payload codec (0 for
+#            text), bits 4-7 mask of the codecs accepted by the sender
+#
+# version 2 adds a compression byte after the type: bits 0-3 code of the
+# compressor applied to the payload (0 for none), bits 4-7 mask of the
+# compressors accepted by the sender. It is also the first version that
+# guarantees the peer knows the CORE_BATCH message type, which was appended
+# after version 1 shipped: messages are only batched to peers of version 2 or
+# newer (LTS_WIRE_BATCH, see src.core.outbound).
+#
+# version 3 keeps the version 2 header, it only tells that the peer knows the
+# CORE_BUSY message type. Message types are sent as their index in
+# LTS_MessageType, new types are appended and bump the version.
+#
+# version 4 adds DHT_PING_REQ, the indirect probe of the membership protocol
+# (see src.core.membership).
+#
+# version 5 adds DHT_FORWARD_JOIN, DHT_DISCONNECT and DHT_SHUFFLE, the
+# messages of the partial view (see src.core.view).
+#
+# version 6 adds GOSSIP_PUSH, GOSSIP_IHAVE and GOSSIP_GRAFT, the messages of the
+# multi-hop broadcast (see src.core.gossip).
+#
+# version 7 appends the network coordinate of the sender to the header, after
+# the uuids: a count (B) followed by as many floats (f), 0 when the sender has
+# no coordinate (see src.core.coordinates).
+#
+# version 8 adds DSM_CHUNK_INVALIDATE and DSM_CHUNK_PUT, the messages of the
+# write-invalidate coherence of the shared memory (see src.core.dsm).
+#
+# a peer is addressed with the legacy encoding until it is known to support
+# a newer version, either because it sent us a multipart message or because
+# its JSON messages advertise a wire_version field. Replies always use the
+# encoding of the request.
+
+LTS_WIRE_LEGACY = 0
+LTS_WIRE_MULTIPART = 1
+LTS_WIRE_COMPRESS = 2
+LTS_WIRE_BATCH = LTS_WIRE_COMPRESS
+LTS_WIRE_BUSY = 3
+LTS_WIRE_MEMBER = 4
+LTS_WIRE_VIEW = 5
+LTS_WIRE_GOSSIP = 6
+LTS_WIRE_COORD = 7
+LTS_WIRE_DSM = 8
+LTS_WIRE_VERSION = LTS_WIRE_DSM
+
+LTS_WIRE_MAGIC = b'LT'
+LTS_WIRE_HEADER = struct.Struct("!2sBBBHH")
+LTS_WIRE_HEADER_COMPRESS = struct.Struct("!2sBBBBHH")
+LTS_WIRE_COORD_COUNT = struct.Struct("!B")
+LTS_WIRE_NONE = 0xFFFF
+
+LTS_WIRE_FLAG_NO_CONTENT = 0x01
+LTS_WIRE_CODEC_SHIFT = 1
+LTS_WIRE_CODEC_MASK = 0x07
+LTS_WIRE_ACCEPT_SHIFT = 4
+LTS_WIRE_COMPRESS_MASK = 0x0F
+
+# message types are sent as their index, new types must be appended
+LTS_WIRE_TYPES = [message_type.value for message_type in LTS_MessageType]
+LTS_WIRE_TYPE_CODES = {message_type: code for code, message_type in enumerate(LTS_WIRE_TYPES)}
+
+# ------------------------------------------------------------------------------
+
+class LTS_Wire(LTS_BaseClass):
+
+    def __init__(self, wire_uuid, version=LTS_WIRE_VERSION, codec="json",
+                 compress_threshold=None, compressor=None):
+        super().__init__("LTS_Wire")
+        self.uuid = wire_uuid
+        self.version = min(version, LTS_WIRE_VERSION)
+
+        # codec used for structured content, advertised to peers along with
+        # the other codecs this agent accepts
+        self.codec = lts_codecs.get(codec)
+        self.json_codec = lts_codecs.get("json")
+        self.accepted_codes = set([accepted.code for accepted in lts_codecs.accepted(self.codec)])
+        self.accept_mask = 0
+        for code in self.accepted_codes:
+            self.accept_mask = self.accept_mask | (1 << (code - 1))
+
+        # payloads of at least compress_threshold bytes are compressed, lz4
+        # is preferred when installed, None disables compression
+        self.compress_threshold = compress_threshold
+        if compressor is None:
+            compressor = "lz4" if "lz4" in lts_compressors.names() else "zlib"
+        self.compressor = lts_compressors.get(compressor)
+        self.compress_accept_mask = 0
+        for name in lts_compressors.names():
+            self.compress_accept_mask = self.compress_accept_mask | (1 << (lts_compressors.get(name).code - 1))
+
+        self.nb_compressed = 0
+        self.nb_bytes_raw = 0
+        self.nb_bytes_compressed = 0
+        self.stats_lock = threading.Lock()
+
+        # peer uuid : str -> negotiated wire version : int
+        self.peer_version = dict()
+        # peer uuid : str -> mask of the codecs accepted by the peer : int
+        self.peer_codecs = dict()
+        # peer uuid : str -> mask of the compressors accepted by the peer : int
+        self.peer_compressors = dict()
+        self.peer_lock = threading.Lock()
+
+        # LTS_Vivaldi of the agent, its coordinate is sent in the headers
+        self.vivaldi = None
+
+
+    def getPeerVersion(self, uuid):
+        self.peer_lock.acquire()
+        res = self.peer_version.get(uuid, LTS_WIRE_LEGACY)
+        self.peer_lock.release()
+        return res
+
+    # the version of a peer is only raised: replies are encoded with the
+    # version of the request and would otherwise downgrade it
+    def setPeerVersion(self, uuid, version):
+        if uuid is not None:
+            version = min(version, self.version)
+            self.peer_lock.acquire()
+            if self.peer_version.get(uuid, LTS_WIRE_LEGACY) < version:
+                self.peer_version[uuid] = version
+                if version > LTS_WIRE_LEGACY:
+                    logging.info("[WIR] "+self.uuid+" Peer " + uuid + " uses wire version " + str(version))
+            self.peer_lock.release()
+
+    def setPeerCodecs(self, uuid, mask):
+        if uuid is not None:
+            self.peer_lock.acquire()
+            self.peer_codecs[uuid] = mask
+            self.peer_lock.release()
+
+    def setPeerCompressors(self, uuid, mask):
+        if uuid is not None:
+            self.peer_lock.acquire()
+            self.peer_compressors[uuid] = mask
+            self.peer_lock.release()
+
+    # our compressor if compression is enabled and the peer accepts it
+    def getPeerCompressor(self, uuid):
+        if self.compress_threshold is None:
+            return None
+        self.peer_lock.acquire()
+        mask = self.peer_compressors.get(uuid, 0)
+        self.peer_lock.release()
+        if mask & (1 << (self.compressor.code - 1)):
+            return self.compressor
+        return None
+
+    def getCompressionStats(self):
+        self.stats_lock.acquire()
+        res = {"compressed": self.nb_compressed,
+               "bytes_raw": self.nb_bytes_raw,
+               "bytes_compressed": self.nb_bytes_compressed}
+        self.stats_lock.release()
+        return res
+
+    # our codec if the peer accepts it, json otherwise
+    def getPeerCodec(self, uuid):
+        self.peer_lock.acquire()
+        mask = self.peer_codecs.get(uuid, 0)
+        self.peer_lock.release()
+        if mask & (1 << (self.codec.code - 1)):
+            return self.codec
+        return self.json_codec
+
+
+    def encode(self, message, version, codec=None, compressor=None):
+        if version >= LTS_WIRE_MULTIPART:
+            return self.encodeMultipart(message, version, codec or self.json_codec, compressor)
+        return self.encodeLegacy(message)
+
+    # encode a request, using the version negotiated with the destination
+    def encodeRequest(self, to_uuid, message):
+        return self.encode(message, self.getPeerVersion(to_uuid),
+                           self.getPeerCodec(to_uuid),
+                           self.getPeerCompressor(to_uuid))
+
+    # encode a reply, using the version of the request
+    def encodeReply(self, response, request):
+        return self.encode(response, min(request.wire_version, self.version),
+                           self.getPeerCodec(request.from_uuid),
+                           self.getPeerCompressor(request.from_uuid))
+
+    def encodeLegacy(self, message):
+        content = message.content
+        if content is not None and not isinstance(content, str):
+            content = json.dumps(content)
+        obj = {"class_name": message.class_name,
+               "message_type": message.message_type,
+               "content": content,
+               "from_uuid": message.from_uuid,
+               "to_uuid": message.to_uuid,
+               "wire_version": self.version}
+        if message.buffers:
+            obj["buffers"] = [base64.b64encode(buffer).decode() for buffer in message.buffers]
+        return [json.dumps(obj).encode()]
+
+    def encodeUuid(self, uuid):
+        if uuid is None:
+            return b'', LTS_WIRE_NONE
+        data = uuid.encode()
+        return data, len(data)
+
+    def compress(self, payload, compressor):
+        if compressor is None or len(payload) < self.compress_threshold:
+            return payload, LTS_COMPRESS_NONE
+        compressed = compressor.dumps(payload)
+        if len(compressed) >= len(payload):
+            return payload, LTS_COMPRESS_NONE
+        self.stats_lock.acquire()
+        self.nb_compressed = self.nb_compressed + 1
+        self.nb_bytes_raw = self.nb_bytes_raw + len(payload)
+        self.nb_bytes_compressed = self.nb_bytes_compressed + len(compressed)
+        self.stats_lock.release()
+        return compressed, compressor.code
+
+    def encodeMultipart(self, message, version, codec, compressor=None):
+        flags = self.accept_mask << LTS_WIRE_ACCEPT_SHIFT
+        from_data, from_len = self.encodeUuid(message.from_uuid)
+        to_data, to_len = self.encodeUuid(message.to_uuid)
+        if message.content is None:
+            flags = flags | LTS_WIRE_FLAG_NO_CONTENT
+            payload = b''
+        elif isinstance(message.content, str):
+            payload = message.content.encode()
+        else:
+            flags = flags | (codec.code << LTS_WIRE_CODEC_SHIFT)
+            payload = codec.dumps(message.content)
+        if version >= LTS_WIRE_COMPRESS:
+            payload, compress_code = self.compress(payload, compressor)
+            compression = (self.compress_accept_mask << LTS_WIRE_ACCEPT_SHIFT) | compress_code
+            header = LTS_WIRE_HEADER_COMPRESS.pack(LTS_WIRE_MAGIC, version, flags,
+                                                   LTS_WIRE_TYPE_CODES[message.message_type],
+                                                   compression, from_len, to_len)
+        else:
+            header = LTS_WIRE_HEADER.pack(LTS_WIRE_MAGIC, LTS_WIRE_MULTIPART, flags,
+                                          LTS_WIRE_TYPE_CODES[message.message_type],
+                                          from_len, to_len)
+        header = header + from_data + to_data
+        if version >= LTS_WIRE_COORD:
+            header = header + self.encodeCoordinate()
+        return [header, payload] + list(message.buffers)
+
+    def encodeCoordinate(self):
+        if self.vivaldi is None:
+            return LTS_WIRE_COORD_COUNT.pack(0)
+        values = self.vivaldi.getList()
+        return LTS_WIRE_COORD_COUNT.pack(len(values)) + struct.pack("!" + str(len(values)) + "f", *values)
+
+    def decodeCoordinate(self, header, offset):
+        count = LTS_WIRE_COORD_COUNT.unpack_from(header, offset)[0]
+        if count == 0:
+            return None
+        return list(struct.unpack_from("!" + str(count) + "f", header, offset + LTS_WIRE_COORD_COUNT.size))
+
+
+    def isMultipart(self, frames):
+        return len(frames) >= 2 and lts_wire_bytes(frames[0])[:2] == LTS_WIRE_MAGIC
+
+    # a message whose type we do not know (sent by a newer peer) is decoded
+    # as CORE_NONE, which the agents answer with CORE_NONE
+    def decode(self, frames):
+        if self.isMultipart(frames):
+            message = self.decodeMultipart(frames)
+        else:
+            message = self.decodeLegacy(frames)
+        if message.message_type not in LTS_WIRE_TYPE_CODES:
+            logging.warning("[WIR] "+self.uuid+" Dropping message of unknown type " + str(message.message_type) + " from " + str(message.from_uuid))
+            message.message_type = LTS_MessageType.CORE_NONE
+            message.content = None
+            message.buffers = list()
+        self.setPeerVersion(message.from_uuid, message.wire_version)
+        return message
+
+    def decodeLegacy(self, frames):
+        message = LTS_Message(LTS_MessageType.CORE_NONE)
+        obj = json.loads(lts_wire_bytes(frames[0]))
+        message.fromDict(obj)
+        message.wire_version = obj.get('wire_version', LTS_WIRE_LEGACY)
+        buffers = obj.get('buffers')
+        if buffers:
+            message.buffers = [memoryview(base64.b64decode(buffer)) for buffer in buffers]
+        return message
+
+    # destination of a request, without decoding its content
+    def peekTo(self, frames):
+        if not self.isMultipart(frames):
+            return json.loads(lts_wire_bytes(frames[0])).get('to_uuid')
+        header = lts_wire_bytes(frames[0])
+        if header[2] >= LTS_WIRE_COMPRESS:
+            from_len, to_len = LTS_WIRE_HEADER_COMPRESS.unpack_from(header)[5:]
+            offset = LTS_WIRE_HEADER_COMPRESS.size
+        else:
+            from_len, to_len = LTS_WIRE_HEADER.unpack_from(header)[4:]
+            offset = LTS_WIRE_HEADER.size
+        _, offset = self.decodeUuid(header, offset, from_len)
+        to_uuid, _ = self.decodeUuid(header, offset, to_len)
+        return to_uuid
+
+    def decodeUuid(self, header, offset, length):
+        if length == LTS_WIRE_NONE:
+            return None, offset
+        return header[offset:offset + length].decode(), offset + length
+
+    def decodeMultipart(self, frames):
+        header = lts_wire_bytes(frames[0])
+        compression = LTS_COMPRESS_NONE
+        if header[2] >= LTS_WIRE_COMPRESS:
+            _, version, flags, type_code, compression, from_len, to_len = LTS_WIRE_HEADER_COMPRESS.unpack_from(header)
+            offset = LTS_WIRE_HEADER_COMPRESS.size
+        else:
+            _, version, flags, type_code, from_len, to_len = LTS_WIRE_HEADER.unpack_from(header)
+            offset = LTS_WIRE_HEADER.size
+        from_uuid, offset = self.decodeUuid(header, offset, from_len)
+        to_uuid, offset = self.decodeUuid(header, offset, to_len)
+        coordinate = None
+        if version >= LTS_WIRE_COORD:
+            coordinate = self.decodeCoordinate(header, offset)
+        content = None
+        if not flags & LTS_WIRE_FLAG_NO_CONTENT:
+            payload = lts_wire_bytes(frames[1])
+            if compression & LTS_WIRE_COMPRESS_MASK != LTS_COMPRESS_NONE:
+                payload = lts_compressors.getByCode(compression & LTS_WIRE_COMPRESS_MASK).loads(payload)
+            content = self.decodeContent(payload, (flags >> LTS_WIRE_CODEC_SHIFT) & LTS_WIRE_CODEC_MASK)
+        self.setPeerCodecs(from_uuid, flags >> LTS_WIRE_ACCEPT_SHIFT)
+        self.setPeerCompressors(from_uuid, compression >> LTS_WIRE_ACCEPT_SHIFT)
+        message_type = LTS_WIRE_TYPES[type_code] if type_code < len(LTS_WIRE_TYPES) else type_code
+        message = LTS_Message(message_type, content=content,
+                              from_uuid=from_uuid, to_uuid=to_uuid)
+        message.wire_version = version
+        message.coordinate = coordinate
+        message.buffers = [lts_wire_buffer(frame) for frame in frames[2:]]
+        return message
+
+    def decodeContent(self, payload, code):
+        if code == LTS_CODEC_TEXT:
+            return payload.decode()
+        if code not in self.accepted_codes:
+            # e.g. pickle content sent to an agent that did not opt in
+            logging.error("[WIR] "+self.uuid+" Discarding content encoded with unaccepted codec " + str(code))
+            return None
+        return lts_codecs.getByCode(code).loads(payload)
+
+
+# ------------------------------------------------------------------------------
+
+# frames are zmq.Frame objects when received with copy=False
+
+def lts_wire_bytes(frame):
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return bytes(frame)
+
+def lts_wire_buffer(frame):
+    if isinstance(frame, zmq.Frame):
+        return frame.buffer
+    return memoryview(frame)
+
+# split a message received on a ROUTER socket into the identity envelope,
+# up to and including the empty delimiter frame, and the message frames
+
+def lts_wire_split_envelope(frames):
+    for i in range(len(frames)):
+        if len(frames[i]) == 0:
+            return frames[:i + 1], frames[i + 1:]
+    return list(), frames
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    common = LTS_Common()
+
+    wire = LTS_Wire("wire")
+    m = LTS_Message(LTS_MessageType.USER_DEFINED, '{"hello": "world"}', from_uuid="alice")
+    for version in [LTS_WIRE_LEGACY, LTS_WIRE_MULTIPART]:
+        frames = wire.encode(m, version)
+        print(frames)
+        print(wire.decode(frames).toJSON())
+
+    exit(0)
@@ -0,0 +1,74 @@
+import argparse
+import timeit
+
+from src.core.common import LTS_Common
+from src.core.codec import lts_codecs, lts_compressors
+from src.core.memory import LTS_Chunk
+from src.core.message import LTS_Message, LTS_MessageType
+from src.core.wire import LTS_Wire, LTS_WIRE_VERSION
+
+
+# ------------------------------------------------------------------------------
+
+# current JSON path: the chunk is serialized by reflection into the content
+# string, then the message is serialized again by reflection
+
+def json_path(chunk):
+    message = LTS_Message(LTS_MessageType.DSM_CHUNK_GET, chunk.toJSON(),
+                          from_uuid="alice", to_uuid="bob")
+    received = LTS_Message(LTS_MessageType.CORE_NONE)
+    received.fromJSON(message.toJSON())
+    chunk_rt = LTS_Chunk()
+    chunk_rt.fromJSON(received.content)
+    return chunk_rt
+
+def wire_path(chunk, alice, bob, codec, compressor=None):
+    message = LTS_Message(LTS_MessageType.DSM_CHUNK_GET, chunk.toDict(),
+                          from_uuid="alice", to_uuid="bob")
+    received = bob.decode(alice.encode(message, LTS_WIRE_VERSION, codec, compressor))
+    chunk_rt = LTS_Chunk()
+    chunk_rt.fromDict(received.getContentObject())
+    return chunk_rt
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        prog = 'codec_bench.py',
+        description = 'Codec microbenchmark',
+        epilog = 'https://github.com/lcudenne/learntoshare')
+
+    parser.add_argument("-n", "--number", type=int, default=10000, required=False,
+                        help="number of round trips per codec")
+    parser.add_argument("-s", "--size", type=int, default=64, required=False,
+                        help="number of values in the chunk content")
+    parser.add_argument("-c", "--compress", type=int, default=1024, required=False,
+                        help="compression threshold in bytes of the payload")
+    args = parser.parse_args()
+
+    LTS_Common()
+
+    chunk = LTS_Chunk("chunk", agent_uuid="alice", version=1,
+                      content=[{"trial": i, "value": i / 3.0, "params": {"x": i, "y": "cat"}} for i in range(args.size)])
+
+    t = timeit.timeit(lambda: json_path(chunk), number=args.number)
+    print("{:>16} {:8.2f} us/msg".format("legacy json", t * 1e6 / args.number))
+
+    for name in lts_codecs.names():
+        alice = LTS_Wire("alice", codec=name)
+        bob = LTS_Wire("bob", codec=name)
+        t = timeit.timeit(lambda: wire_path(chunk, alice, bob, alice.codec), number=args.number)
+        print("{:>16} {:8.2f} us/msg".format("wire " + name, t * 1e6 / args.number))
+
+    for name in lts_compressors.names():
+        alice = LTS_Wire("alice", compress_threshold=args.compress, compressor=name)
+        bob = LTS_Wire("bob")
+        t = timeit.timeit(lambda: wire_path(chunk, alice, bob, alice.codec, alice.compressor), number=args.number)
+        stats = alice.getCompressionStats()
+        ratio = stats["bytes_compressed"] / stats["bytes_raw"] if stats["compressed"] else 1.0
+        print("{:>16} {:8.2f} us/msg {:5.2f} ratio".format("wire json+" + name, t * 1e6 / args.number, ratio))
+
+    exit(0)
@@ -0,0 +1,63 @@
+from src.core.common import LTS_Common
+from src.core.codec import lts_codecs
+from src.core.dht import LTS_DHTEntry
+from src.core.memory import LTS_Chunk
+from src.core.message import LTS_Message, LTS_MessageType
+from src.core.wire import LTS_Wire, LTS_WIRE_LEGACY, LTS_WIRE_MULTIPART
+
+
+# ------------------------------------------------------------------------------
+
+def check_objects(codec):
+    chunk = LTS_Chunk("chunk", agent_uuid="alice", version=3, content="64")
+    chunk_rt = LTS_Chunk()
+    chunk_rt.fromDict(codec.loads(codec.dumps(chunk.toDict())))
+    assert chunk_rt.toDict() == chunk.toDict()
+
+    entry = LTS_DHTEntry("bob", "tcp://localhost:5556", latency_us=1200)
+    entry_rt = LTS_DHTEntry(None, None)
+    entry_rt.fromDict(codec.loads(codec.dumps(entry.toDict())))
+    assert entry_rt.toDict() == entry.toDict()
+
+    params = {"x": 1.5, "y": [1, 2, 3], "name": "trial", "nested": {"a": None}}
+    assert codec.loads(codec.dumps(params)) == params
+
+    message = LTS_Message(LTS_MessageType.DSM_CHUNK_GET, chunk.toDict(),
+                          from_uuid="alice", to_uuid="bob")
+    message_rt = LTS_Message(LTS_MessageType.CORE_NONE)
+    message_rt.fromDict(codec.loads(codec.dumps(message.toDict())))
+    assert message_rt.toDict() == message.toDict()
+
+
+def check_wire(codec_name):
+    alice = LTS_Wire("alice", codec=codec_name)
+    bob = LTS_Wire("bob", codec=codec_name)
+    contents = ['{"best_value": 0.5}', {"uuid": "alice", "address": "tcp://localhost:5555"}, None]
+    for version in [LTS_WIRE_LEGACY, LTS_WIRE_MULTIPART]:
+        for content in contents:
+            message = LTS_Message(LTS_MessageType.USER_DEFINED, content,
+                                  from_uuid="alice", to_uuid="bob")
+            received = bob.decode(alice.encode(message, version, alice.codec))
+            assert received.message_type == message.message_type
+            assert received.from_uuid == "alice" and received.to_uuid == "bob"
+            if version == LTS_WIRE_LEGACY and isinstance(content, dict):
+                assert received.getContentObject() == content
+            else:
+                assert received.content == content
+    # bob now knows the codecs accepted by alice
+    assert bob.getPeerCodec("alice").name == alice.codec.name
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+
+    LTS_Common()
+
+    for name in lts_codecs.names():
+        check_objects(lts_codecs.get(name))
+        check_wire(name)
+        print("codec", name, "OK")
+
+    exit(0)
@@ -1,13 +1,25 @@
 import argparse
+import logging
 import random
 
 from time import sleep
 
 from src.core.common import LTS_Common
 from src.core.agents import LTS_Agent
+from src.core.host import LTS_AgentHost
 
 
 
+# ------------------------------------------------------------------------------
+
+class OverlayCounter:
+
+    def __init__(self):
+        self.received = 0
+
+    def dispatchMessage(self, message):
+        self.received = self.received + 1
+
 # ------------------------------------------------------------------------------
 
 
@@ -22,6 +34,18 @@ if __name__ == "__main__":
                         help="number of peers")
     parser.add_argument("-p", "--baseport", type=int, default=5555, required=False,
                         help="TCP base port")
+    parser.add_argument("-t", "--transport", choices=["tcp", "inproc", "host"], default="tcp", required=False,
+                        help="tcp binds one port per peer, inproc runs the overlay without any port, host runs the new peers on a single agent host")
+    parser.add_argument("-s", "--nseeds", type=int, default=1, required=False,
+                        help="number of random seeds contacted by each new peer")
+    parser.add_argument("-k", "--bucketsize", type=int, default=None, required=False,
+                        help="Kademlia bucket size, peers keep every other peer when not set")
+    parser.add_argument("-a", "--activesize", type=int, default=None, required=False,
+                        help="size of the active view of a partial view overlay, peers keep every other peer when not set")
+    parser.add_argument("--populate", action="store_true", required=False,
+                        help="peers ask for one more peer every heartbeat instead of running the gossip membership")
+    parser.add_argument("-g", "--gossip", action="store_true", required=False,
+                        help="broadcast a message through the gossip tree of the peers before stopping the overlay")
     args = parser.parse_args()
 
 
@@ -31,22 +55,60 @@ if __name__ == "__main__":
 
     net_address = "tcp://localhost:" + str(args.baseport)
     bind_address = "tcp://*:" + str(args.baseport)
-    peer = LTS_Agent(zmq_bind=bind_address, zmq_address=net_address)
+    if args.transport == "inproc":
+        net_address = bind_address = "inproc://overlay-0"
+    peer = LTS_Agent(zmq_bind=bind_address, zmq_address=net_address,
+                     dht_bucket_size=args.bucketsize, membership=not args.populate,
+                     dht_active_size=args.activesize, gossip=args.gossip,
+                     dispatch_handler=OverlayCounter())
     peer_list.append(peer)
 
     seed_uuid = peer.uuid
     seed_address = peer.communicator.zmq_address
     
+    host = None
+    if args.transport == "host":
+        host = LTS_AgentHost(zmq_bind="tcp://*:" + str(args.baseport + 1),
+                             zmq_address="tcp://localhost:" + str(args.baseport + 1),
+                             heartbeat_timer_sec=2)
+
     for i in range(args.npeers):
+        seeds = random.sample(peer_list, min(args.nseeds, len(peer_list)))
+        zmq_seeds = [(seed.uuid, seed.communicator.zmq_address) for seed in seeds]
+        if host:
+            peer_list.append(host.addAgent(zmq_seeds=zmq_seeds, dht_bucket_size=args.bucketsize,
+                                           membership=not args.populate,
+                                           dht_active_size=args.activesize,
+                                           gossip=args.gossip,
+                                           dispatch_handler=OverlayCounter()))
+            continue
         net_address = "tcp://localhost:" + str(args.baseport + i + 1)
         bind_address = "tcp://*:" + str(args.baseport + i + 1)
-        seed_index = random.randint(0, len(peer_list) - 1)
+        if args.transport == "inproc":
+            net_address = bind_address = "inproc://overlay-" + str(i + 1)
         peer = LTS_Agent(zmq_bind=bind_address, zmq_address=net_address,
-                         zmq_seed_uuid=peer_list[seed_index].uuid,
-                         zmq_seed_address=peer_list[seed_index].communicator.zmq_address)
+                         zmq_seeds=zmq_seeds, dht_bucket_size=args.bucketsize,
+                         membership=not args.populate,
+                         dht_active_size=args.activesize, gossip=args.gossip,
+                         dispatch_handler=OverlayCounter())
         peer_list.append(peer)
 
     sleep(20)
+    sizes = [len(peer.communicator.dht.getUuidList()) for peer in peer_list]
+    logging.info("[OVL] DHT size min " + str(min(sizes)) + " max " + str(max(sizes)) + " of " + str(len(peer_list) - 1) + " peers")
+    if args.bucketsize:
+        for i in range(10):
+            from_peer, to_peer = random.sample(peer_list, 2)
+            from_peer.communicator.searchPeer(to_peer.uuid)
+    if args.gossip:
+        peer_list[0].gossip.broadcast('{"overlay": "gossip"}')
+        sleep(5)
+        received = sum([peer.dispatch_handler.received for peer in peer_list])
+        pushed = sum([peer.gossip.nb_pushed for peer in peer_list])
+        hops = max([peer.gossip.max_hops for peer in peer_list])
+        logging.info("[OVL] Gossip delivered to " + str(received) + " of " + str(len(peer_list) - 1) + " peers with " + str(pushed) + " pushes in up to " + str(hops) + " hops")
+    if host:
+        host.terminate()
     peer.terminate()
 
         